@@ -1 +1 @@
-from . import data_sources, processing, custom_data
\ No newline at end of file
+from . import data_sources, processing, custom_data, runner, manifest, download, cache, scheduler
\ No newline at end of file
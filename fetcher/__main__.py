@@ -1,14 +1,15 @@
 import os
 import argparse
-import importlib
 import logging
 import shutil
 
 from dotenv import load_dotenv
 
 from fetcher import processing
+from fetcher import runner
+from fetcher.cache import RawCache
 from fetcher.custom_data.solar_radiation import xarray_integrated_toa_solar_radiation
-from fetcher.data_sources import imerg_early
+from fetcher.data_sources import ifs, era5, imerg_early
 
 load_dotenv() # development (API keys)
 
@@ -31,6 +32,10 @@ parser.add_argument('-c', '--cleanup', action='store_true',
                           'dataset, keeping only processed files. Using this '
                           'along with --skip-download will download the files '
                           'then immediately delete them.'))
+parser.add_argument('--cache-dir', default=None,
+                    help=('Directory in which the downloaded data is cached '
+                          'between runs. Data already in it is not downloaded '
+                          'again.'))
 
 args = parser.parse_args()
 
@@ -47,25 +52,22 @@ SOURCES = ['ifs', 'era5']
 RAW_SUFFIX = '_raw' # for the naming of the folders containing unprocessed data
 
 ifs_datetime = None
+results = None
 
 if not args.skip_download:
-    for source in SOURCES:
-        target = os.path.join(args.target_folder, f'{source}{RAW_SUFFIX}')
-        logger.info(f'Fetching the latest data from {source} into the folder {target}')
-        if not os.path.exists(target):
-            os.makedirs(target)
-        data_source = importlib.import_module(f'fetcher.data_sources.{source}')
-        datetime = data_source.download_latest(target)
-        logger.info(f'Successfuly downloaded data from timestamp {datetime}')
-        if source == 'ifs':
-            ifs_datetime = datetime
-    
-    # Download imerg
-    imerg_dir = os.path.join(args.target_folder, 'imerg')
-    if not os.path.exists(imerg_dir):
-        os.makedirs(imerg_dir, exist_ok=True)
-    imerg_early.get_total_precipitation(ifs_datetime, imerg_dir)
-    logger.info('All files downloaded')
+    # All sources are fetched concurrently, imerg once ifs is done (it is
+    # fetched at the ifs datetime). Their files are written for later runs
+    # with --skip-download.
+    targets = {source: os.path.join(args.target_folder, f'{source}{RAW_SUFFIX}') for source in SOURCES}
+    targets['imerg'] = os.path.join(args.target_folder, 'imerg')
+    logger.info(f'Fetching the latest data into the folders {list(targets.values())}')
+    results = runner.fetch_all(
+        {'ifs': ifs, 'era5': era5, 'imerg': imerg_early},
+        targets,
+        options={'write_files': True, 'cache': None if args.cache_dir is None else RawCache(args.cache_dir)}
+    )
+    ifs_datetime = results['ifs']['datetime']
+    logger.info(f'All files downloaded (ifs timestamp: {ifs_datetime})')
 
 if ifs_datetime is None:
     logger.info('Skipping download...')
@@ -78,13 +80,25 @@ toa_radiation = xarray_integrated_toa_solar_radiation(ifs_datetime, 1)
 
 if not args.skip_processing:
     logger.info('Processing the data')
-    processing.process_data(
-        os.path.join(args.target_folder, f'era5{RAW_SUFFIX}'),
-        os.path.join(args.target_folder, f'ifs{RAW_SUFFIX}'),
-        os.path.join(args.target_folder, 'imerg'),
-        toa_radiation,
-        os.path.join(args.target_folder, 'processed')
-    )
+    if results is not None:
+        # Just downloaded: processed from memory
+        processing.process_datasets(
+            ifs_datetime,
+            results['ifs']['pressure'],
+            results['ifs']['single'],
+            [ds for ds in (results['era5']['pressure'], results['era5']['single']) if ds is not None],
+            results['imerg']['precipitation'],
+            toa_radiation,
+            os.path.join(args.target_folder, 'processed')
+        )
+    else:
+        processing.process_data(
+            os.path.join(args.target_folder, f'era5{RAW_SUFFIX}'),
+            os.path.join(args.target_folder, f'ifs{RAW_SUFFIX}'),
+            os.path.join(args.target_folder, 'imerg'),
+            toa_radiation,
+            os.path.join(args.target_folder, 'processed')
+        )
 else:
     logger.info('Skipping the processing step')
     
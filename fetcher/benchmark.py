@@ -0,0 +1,312 @@
+# Benchmarks of the fetcher's processing steps.
+#
+# decode: decodes an IFS GRIB file with the previous path (`cfgrib.open_datasets`
+# then `xr.merge`) and with `fetcher.processing.decode_grib`, for several numbers
+# of worker threads, and checks that both give the same values. Without a
+# file, a synthetic one of production size is written (the variables and
+# pressure levels of the model on the 0.25° grid, CCSDS-packed as the IFS open
+# data). A real file is kept in the `ifs_raw` folder by
+# `python -m fetcher --skip-processing`.
+#
+# process: processes synthetic inputs of production size into a zarr file with
+# the previous path (eager, with the default chunks of zarr) and with
+# `fetcher.processing.process_datasets` (lazy, one chunk per variable and level)
+# for several compressors, then reads the file back as the encoder does (the
+# whole globe of each variable and level), checking that the values are the
+# same. The peak memory allocated by the processing is measured in a separate
+# run, with `tracemalloc`.
+#
+# Usage: python -m fetcher.benchmark decode [-h] [--grib PATH] [--workers N,N,...]
+#                                           [--repeat N]
+#        python -m fetcher.benchmark process [-h] [--compressors NAME,NAME,...]
+#                                            [--repeat N]
+
+from pathlib import Path
+
+from datetime import datetime, timezone
+
+import tracemalloc
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+import numcodecs
+import numpy as np
+import xarray as xr
+
+import model_variables
+from fetcher.manifest import MANIFEST, Manifest, IFS, ERA5, IMERG
+from fetcher.processing import shift_longitude
+from fetcher.processing.decode_grib import decode_grib
+from fetcher.processing.process_data import process_datasets, DEFAULT_COMPRESSOR
+
+# IFS surface variables: (shortName, typeOfFirstFixedSurface, level)
+SURFACE_FIELDS = [('2t', 103, 2), ('10u', 103, 10), ('10v', 103, 10), ('msl', 101, 0)]
+LEVEL_FIELDS = ['gh', 'q', 't', 'u', 'v']
+# Compressors of the process benchmark, by name
+COMPRESSORS = {
+    'default': DEFAULT_COMPRESSOR,
+    'none': None,
+    'lz4': numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE),
+    'zstd': numcodecs.Blosc(cname='zstd', clevel=3, shuffle=numcodecs.Blosc.SHUFFLE),
+    'zstd-bitshuffle': numcodecs.Blosc(cname='zstd', clevel=3, shuffle=numcodecs.Blosc.BITSHUFFLE),
+}
+CTX_FIELDS = ['lsm', 'anor', 'isor', 'slor', 'sdor']
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the processing steps of the fetcher.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    decode = subparsers.add_parser('decode', help='GRIB decoding: cfgrib against decode_grib')
+    decode.add_argument('--grib', default=None, help='IFS GRIB file [default: synthetic]')
+    decode.add_argument('--workers', default=f'1,{os.cpu_count()}',
+                        help='Comma-separated numbers of decoding threads [default: 1,CPUs]')
+    decode.add_argument('--repeat', type=int, default=3, help='Runs of each configuration [default: 3]')
+    process = subparsers.add_parser('process', help='Processing into zarr: eager against lazy and chunked')
+    process.add_argument('--compressors', default='default,none,zstd',
+                         help=f'Comma-separated compressors, among {", ".join(COMPRESSORS)} [default: default,none,zstd]')
+    process.add_argument('--repeat', type=int, default=3, help='Runs of each configuration [default: 3]')
+    args = parser.parse_args()
+
+    if args.benchmark == 'decode':
+        benchmark_decode(args.grib, [int(n) for n in args.workers.split(',')], args.repeat)
+    elif args.benchmark == 'process':
+        benchmark_process(args.compressors.split(','), args.repeat)
+
+def benchmark_decode(grib_path: os.PathLike, workers: list[int], repeat: int):
+    with tempfile.TemporaryDirectory() as directory:
+        if grib_path is None:
+            grib_path = Path(directory) / 'synthetic.grib2'
+            start = time.perf_counter()
+            write_synthetic_grib(grib_path)
+            print(f'Wrote {grib_path.stat().st_size / 1e6:.0f} MB of synthetic GRIB '
+                  f'in {time.perf_counter() - start:.1f} s')
+        print(f'{"decoder":<24} {"best (s)":>10} {"mean (s)":>10}')
+
+        reference = None
+        for name, decode in [('cfgrib + xr.merge', _decode_cfgrib)] + [
+            (f'decode_grib, {n} workers', lambda path, n=n: decode_grib(path, scale={'gh': 9.81}, max_workers=n))
+            for n in workers
+        ]:
+            durations = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                pressure, single = decode(str(grib_path))
+                durations.append(time.perf_counter() - start)
+            print(f'{name:<24} {min(durations):>10.2f} {sum(durations) / len(durations):>10.2f}')
+
+            if reference is None:
+                reference = (pressure, single)
+            else:
+                for expected, actual in zip(reference, (pressure, single)):
+                    for variable in expected.data_vars:
+                        if not np.array_equal(expected[variable].to_numpy(), actual[variable].to_numpy(), equal_nan=True):
+                            print(f'  {variable} differs from cfgrib')
+
+def _decode_cfgrib(grib_path: str) -> tuple[xr.Dataset, xr.Dataset]:
+    '''
+    The previous decoding path of `ifs._grib_to_netcdf4`, with the values
+    loaded in memory.
+    '''
+    import cfgrib
+
+    dss = cfgrib.open_datasets(grib_path, decode_timedelta=True, indexpath='')
+    dss = [ds.drop_vars('heightAboveGround') if 'heightAboveGround' in ds.coords else ds for ds in dss]
+    pressures = xr.merge([ds for ds in dss if 'isobaricInhPa' in ds.coords]).load()
+    singles = xr.merge([ds for ds in dss if 'isobaricInhPa' not in ds.coords]).load()
+    pressures['gh'] = pressures['gh'] * 9.81
+    return pressures, singles
+
+def benchmark_process(compressors: list[str], repeat: int):
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        ctx_path = directory / 'ctx_variables.nc'
+        inputs = synthetic_inputs(ctx_path)
+        print(f'{"processing":<28} {"write (s)":>10} {"read (s)":>10} {"peak (MB)":>10} {"size (MB)":>10}')
+
+        reference = None
+        for name, process in [('eager, default chunks', lambda target: _process_eager(*inputs, target, ctx_path))] + [
+            (f'lazy, {compressor}', lambda target, compressor=compressor: process_datasets(
+                *inputs, target, compressor=COMPRESSORS[compressor], ctx_variables_path=ctx_path
+            ))
+            for compressor in compressors
+        ]:
+            writes, reads = [], []
+            for _ in range(repeat):
+                target = directory / 'out'
+                shutil.rmtree(target, ignore_errors=True)
+                start = time.perf_counter()
+                path = process(target)
+                writes.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                values = read_like_encoder(path)
+                reads.append(time.perf_counter() - start)
+            size = sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+
+            shutil.rmtree(target)
+            tracemalloc.start()
+            process(target)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{name:<28} {min(writes):>10.2f} {min(reads):>10.2f} {peak / 1e6:>10.0f} {size / 1e6:>10.0f}')
+
+            if reference is None:
+                reference = values
+            else:
+                for key, expected in reference.items():
+                    if not np.array_equal(expected, values[key], equal_nan=True):
+                        print(f'  {key[0]} (level {key[1]}) differs from the eager path')
+
+def read_like_encoder(path: os.PathLike) -> dict[tuple[str, int | None], np.ndarray]:
+    '''
+    Read a processed zarr file as `ERA5Dataset` does: the whole globe of each
+    variable and level, one at a time.
+    '''
+    ds = xr.open_zarr(path, consolidated=True).isel(time=0)
+    values = {}
+    for variable in ds.data_vars:
+        if 'level' in ds[variable].dims:
+            for i, level in enumerate(ds['level'].to_numpy()):
+                values[variable, int(level)] = ds[variable].isel(level=i).to_numpy()
+        else:
+            values[variable, None] = ds[variable].to_numpy()
+    return values
+
+def synthetic_inputs(ctx_path: os.PathLike, manifest: Manifest = MANIFEST, seed: int = 0) -> tuple:
+    '''
+    Inputs of `process_datasets` of production size, as returned by the
+    sources (the 0.25° grid, with longitudes in [-180, 180) for IFS and
+    [0, 360) for the others), and the context variables written to `ctx_path`.
+
+    Returns:
+        tuple: dt, IFS pressure and single levels, ERA5 datasets, IMERG and
+            TOA solar radiation, in the order of `process_datasets`
+    '''
+    rng = np.random.default_rng(seed)
+    dt = datetime(2025, 7, 24, 6, tzinfo=timezone.utc)
+    latitudes = np.linspace(90, -90, 721)
+    longitudes = np.arange(1440) * 0.25
+
+    pattern = np.sin(np.radians(latitudes))[:, None] * np.cos(np.radians(longitudes))[None]
+
+    def field(*leading: int) -> np.ndarray:
+        # Smooth plus noise, with the precision of the 16-bit packing of IFS
+        noise = rng.normal(0, 0.05, (*leading, 721, 1440))
+        return (np.round((pattern + noise) * 2 ** 12) / 2 ** 12).astype(np.float32)
+
+    def dataset(data_vars: dict, lon: np.ndarray = longitudes, **coords) -> xr.Dataset:
+        return xr.Dataset(data_vars, coords={'latitude': latitudes, 'longitude': lon, **coords})
+
+    levels = np.array(sorted(manifest.levels, reverse=True), dtype=np.float64)
+    ifs_longitudes = (longitudes + 180) % 360 - 180
+    ifs_pressure = dataset({
+        entry.file_name: (('isobaricInhPa', 'latitude', 'longitude'), field(len(levels)))
+        for entry in manifest.variables(IFS, is_level=True)
+    }, ifs_longitudes, isobaricInhPa=levels)
+    ifs_single = dataset({
+        entry.file_name: (('latitude', 'longitude'), field())
+        for entry in manifest.variables(IFS, is_level=False)
+    }, ifs_longitudes)
+    era5 = [dataset({
+        entry.file_name: (('valid_time', 'latitude', 'longitude'), field(1))
+        for entry in manifest.variables(ERA5)
+    }, valid_time=[np.datetime64('2025-07-23T00', 'ns')])]
+    imerg = dataset({
+        entry.file_name: (('time', 'latitude', 'longitude'), field(1))
+        for entry in manifest.variables(IMERG)
+    }, time=[np.datetime64('2025-07-24T05:30', 'ns')])
+    toa = xr.DataArray(field(), coords={'latitude': latitudes, 'longitude': longitudes},
+                       dims=('latitude', 'longitude'), name='toa_incident_solar_radiation')
+    dataset({
+        name: (('valid_time', 'latitude', 'longitude'), field(1)) for name in CTX_FIELDS
+    }, valid_time=[np.datetime64('2025-01-01T00', 'ns')]).to_netcdf(ctx_path)
+    return dt, ifs_pressure, ifs_single, era5, imerg, toa
+
+def _process_eager(dt: datetime, ifs_pressure: xr.Dataset, ifs_single: xr.Dataset, era5: list[xr.Dataset],
+                   imerg: xr.Dataset, toa_solar_radiation: xr.DataArray, target_dir: os.PathLike,
+                   ctx_path: os.PathLike, manifest: Manifest = MANIFEST) -> Path:
+    '''
+    The previous path of `process_datasets`: every step on in-memory copies of
+    the data, written with the default chunks of zarr.
+    '''
+    dt_np = np.datetime64(dt.replace(tzinfo=None), 'ns')
+    ds_ifs_p = shift_longitude.shift_longitude(ifs_pressure.copy(), '0-360')
+    ds_ifs_s = shift_longitude.shift_longitude(ifs_single.copy(), '0-360')
+    ds_era5 = xr.merge([
+        shift_longitude.shift_longitude(ds.copy(), '0-360').squeeze('valid_time', drop=True) for ds in era5
+    ])
+    ds_ctx = shift_longitude.shift_longitude(xr.load_dataset(ctx_path), '0-360').squeeze('valid_time', drop=True)
+    ds_imerg = shift_longitude.shift_longitude(imerg.copy(), '0-360')
+
+    ds = xr.merge([ds_ifs_s, ds_ifs_p, ds_ctx])
+    for entry in manifest.variables(ERA5):
+        ds[entry.variable] = ds_era5[entry.file_name]
+    ds['toa_incident_solar_radiation'] = toa_solar_radiation
+    ds = ds.rename({
+        'isobaricInhPa': 'level',
+        **manifest.renames(IFS),
+        'anor': 'angle_of_sub_gridscale_orography',
+        'isor': 'anisotropy_of_sub_gridscale_orography',
+        'lsm': 'land_sea_mask',
+        'slor': 'slope_of_sub_gridscale_orography',
+        'sdor': 'standard_deviation_of_orography',
+    })
+    for entry in manifest.variables(IMERG):
+        ds[entry.variable] = ds_imerg[entry.file_name].squeeze('time', drop=True).astype('float32')
+    ds = ds.assign_coords(longitude=ds.longitude.astype('float32'), latitude=ds.latitude.astype('float32'))
+    for var in ds.data_vars:
+        ds[var] = ds[var].expand_dims(time=[dt_np])
+        ds[var] = ds[var].transpose('time', ...)
+    ds = ds.drop_vars(['step', 'valid_time', 'meanSea', 'surface', 'number', 'expver'], errors='ignore')
+    ds.attrs = {}
+
+    target_path = Path(target_dir) / f'{dt.isoformat(timespec="seconds").replace("+00:00", "Z")}.zarr'
+    os.makedirs(target_dir, exist_ok=True)
+    ds.to_zarr(target_path, mode='w', zarr_format=2, consolidated=True)
+    return target_path
+
+def write_synthetic_grib(path: os.PathLike, seed: int = 0):
+    '''
+    Write a GRIB file with the IFS variables of the model on the 0.25° grid,
+    with smooth fields plus noise so that the packing is realistic.
+    '''
+    import eccodes
+
+    rng = np.random.default_rng(seed)
+    latitudes = np.linspace(90, -90, 721)[:, None]
+    longitudes = np.arange(1440)[None] * 0.25 + 180
+    pattern = np.sin(np.radians(latitudes)) * np.cos(np.radians(longitudes))
+    grid = {
+        'Ni': 1440, 'Nj': 721,
+        'latitudeOfFirstGridPointInDegrees': 90.0, 'latitudeOfLastGridPointInDegrees': -90.0,
+        'longitudeOfFirstGridPointInDegrees': 180.0, 'longitudeOfLastGridPointInDegrees': 179.75,
+        'iDirectionIncrementInDegrees': 0.25, 'jDirectionIncrementInDegrees': 0.25,
+        'dataDate': 20250724, 'dataTime': 600, 'bitsPerValue': 16,
+    }
+
+    def write(out, sample: str, keys: dict):
+        handle = eccodes.codes_grib_new_from_samples(sample)
+        try:
+            for key, value in {**grid, **keys}.items():
+                eccodes.codes_set(handle, key, value)
+            eccodes.codes_set_values(handle, (pattern + rng.normal(0, 0.05, pattern.shape)).ravel())
+            eccodes.codes_set(handle, 'packingType', 'grid_ccsds')
+            eccodes.codes_write(handle, out)
+        finally:
+            eccodes.codes_release(handle)
+
+    with open(path, 'wb') as out:
+        for short_name in LEVEL_FIELDS:
+            for level in model_variables.PRESSURE_LEVELS:
+                write(out, 'regular_ll_pl_grib2', {'shortName': short_name, 'level': level})
+        for short_name, surface, level in SURFACE_FIELDS:
+            keys = {'typeOfFirstFixedSurface': surface}
+            if surface == 103:
+                keys['scaledValueOfFirstFixedSurface'] = level
+            # Set last, as it depends on the type of level
+            keys['shortName'] = short_name
+            write(out, 'regular_ll_sfc_grib2', keys)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Persistent cache of the raw data downloaded by the sources, shared by the runs
+# of the pipeline, so that data which hasn't changed since the last run (e.g.
+# the ERA5 sea surface temperature, published once a day) isn't downloaded
+# again.
+#
+# An entry is a folder of files, addressed by a hash of what was requested:
+# the source, variables, pressure levels, valid time, and any other parameter
+# of the request. It is written in a temporary folder then renamed into place,
+# so that an entry is either complete or absent, and its `entry.json` records
+# the size and SHA-256 of each file, which are checked when it is read. The
+# total size of the cache is capped by evicting the least recently used
+# entries, the last use of an entry being the modification time of its
+# `entry.json`.
+
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import hashlib
+import logging
+import shutil
+import json
+import time
+import os
+
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+ENTRY_FILE = 'entry.json'
+# Folder of the entries being downloaded
+TMP_DIR = 'tmp'
+CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+def cache_key(source: str, variables: list[str], levels: list[int], valid_time: datetime,
+              request: dict = None) -> str:
+    '''
+    Key of the data of a request.
+
+    Parameters:
+        source (str): Name of the source
+        variables (list[str]): Requested variables, in the names of the source
+        levels (list[int]): Requested pressure levels (empty for single levels)
+        valid_time (datetime): Time of the data
+        request (dict): Any other parameter that changes the data (dataset,
+            URL, ...), JSON-serializable
+    Returns:
+        str: Hexadecimal SHA-256 of the request
+    '''
+    description = {
+        'source': source,
+        'variables': list(variables),
+        'levels': [int(level) for level in levels],
+        'valid_time': valid_time.isoformat(),
+        'request': request or {},
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class RawCache:
+    '''
+    Cache of raw data files in a folder, bounded in size.
+
+    Parameters:
+        directory (os.PathLike): Folder of the cache, created if needed
+        max_bytes (int): Maximum total size of the entries. The least recently
+            used ones are removed beyond it.
+        verify (bool): Whether to check the SHA-256 of the files when an entry
+            is read (their sizes are always checked)
+    '''
+    def __init__(self, directory: os.PathLike, max_bytes: int = DEFAULT_MAX_BYTES, verify: bool = True):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Path | None:
+        '''
+        Folder of the files of an entry, or None if it isn't cached. An entry
+        whose files don't match its `entry.json` is removed.
+        '''
+        path = self._path(key)
+        try:
+            with open(path / ENTRY_FILE) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for name, expected in entry['files'].items():
+            file = path / name
+            if not file.is_file() or file.stat().st_size != expected['size'] or (
+                self.verify and _sha256(file) != expected['sha256']
+            ):
+                logger.warning(f'Corrupted cache entry {key} ({name}), removing it')
+                self._remove(path)
+                return None
+        os.utime(path / ENTRY_FILE)
+        return path
+
+    def put(self, key: str, directory: os.PathLike, info: dict = None) -> Path:
+        '''
+        Move the files of a folder into a new entry. The folder must be in the
+        same file system as the cache (see `get_or_download`).
+
+        Parameters:
+            key (str): Key of the entry (see `cache_key`)
+            directory (os.PathLike): Folder of the files, moved into the entry
+            info (dict): Description of the entry, kept in its `entry.json`
+        Returns:
+            Path: Folder of the entry
+        '''
+        directory = Path(directory)
+        files = {
+            file.name: {'size': file.stat().st_size, 'sha256': _sha256(file)}
+            for file in sorted(directory.iterdir()) if file.is_file()
+        }
+        if not files:
+            raise ValueError(f'No file to cache in {directory}')
+        entry = {'key': key, 'created': time.time(), 'info': info or {}, 'files': files}
+        with open(directory / ENTRY_FILE, 'w') as f:
+            json.dump(entry, f, indent=2, default=str)
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(directory, path)
+        except OSError:
+            # Added in the meantime by another run
+            if self.get(key) is None:
+                raise
+            shutil.rmtree(directory, ignore_errors=True)
+        self.evict(keep=path)
+        return path
+
+    def get_or_download(self, key: str, download: Callable[[Path], object], info: dict = None) -> Path:
+        '''
+        Folder of an entry, downloading it on a miss.
+
+        Parameters:
+            key (str): Key of the entry (see `cache_key`)
+            download (Callable[[Path], object]): Function writing the files of
+                the entry into the folder it is given
+            info (dict): Description of the entry, kept in its `entry.json`
+        Returns:
+            Path: Folder of the entry
+        '''
+        path = self.get(key)
+        if path is not None:
+            logger.info(f'Using cached data {key[:12]} ({_describe(info)})')
+            return path
+        tmp_root = self.directory / TMP_DIR
+        tmp_root.mkdir(exist_ok=True)
+        tmp = tmp_root / f'{key}.{os.getpid()}.{time.monotonic_ns()}'
+        tmp.mkdir()
+        try:
+            download(tmp)
+            path = self.put(key, tmp, info)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        logger.info(f'Cached data {key[:12]} ({_describe(info)})')
+        return path
+
+    def entries(self) -> list[tuple[float, int, Path]]:
+        '''
+        Entries of the cache, as (last use, size in bytes, folder), from the
+        least recently used.
+        '''
+        entries = []
+        for entry_file in self.directory.glob(f'*/*/{ENTRY_FILE}'):
+            if entry_file.parent.parent.name == TMP_DIR:
+                continue
+            try:
+                last_use = entry_file.stat().st_mtime
+                size = sum(file.stat().st_size for file in entry_file.parent.iterdir())
+            except OSError:
+                # Removed in the meantime
+                continue
+            entries.append((last_use, size, entry_file.parent))
+        return sorted(entries)
+
+    def evict(self, keep: Path = None):
+        '''
+        Remove the least recently used entries until the cache fits in
+        `max_bytes`, except `keep`.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            logger.info(f'Evicting cache entry {path.name[:12]} ({size / 1e6:.1f} MB)')
+            self._remove(path)
+            total -= size
+        if total > self.max_bytes:
+            logger.warning(f'The raw data cache holds {total / 1e9:.1f} GB, more than its '
+                           f'{self.max_bytes / 1e9:.1f} GB limit')
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def _remove(self, path: Path):
+        # The entry file first, so that a partly removed entry is never used
+        try:
+            (path / ENTRY_FILE).unlink()
+        except OSError:
+            pass
+        shutil.rmtree(path, ignore_errors=True)
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _describe(info: dict | None) -> str:
+    return ', '.join(f'{k}: {v}' for k, v in (info or {}).items())
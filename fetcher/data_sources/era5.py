@@ -2,13 +2,52 @@
 # https://cds.climate.copernicus.eu/datasets/reanalysis-era5-pressure-levels
 
 import os
-import requests
 import cdsapi
+import asyncio
 import logging
+import shutil
 from datetime import datetime
-import zipfile
+from pathlib import Path
+from typing import Callable
+import xarray as xr
 
-def download_latest(target: str) -> datetime:
+from ..manifest import MANIFEST, Manifest, ERA5
+from .. import download
+from ..cache import RawCache, cache_key
+
+# Interface of fetcher.runner. Requests may wait for a long time in the CDS
+# queue.
+DEPENDS_ON = ()
+TIMEOUT = 3 * 3600
+RETRIES = 1
+
+CATALOGUE_URL = 'https://cds.climate.copernicus.eu/api/catalogue/v1/collections/'
+
+async def fetch(target: Path, dependencies: dict, write_files: bool = False,
+                cache: RawCache = None, analysis_time: datetime = None) -> dict:
+    '''
+    Download the latest ERA5 data in memory, for fetcher.runner. The pressure
+    and single levels are requested concurrently, so that they wait in the CDS
+    queue at the same time. With a cache, data already downloaded by a previous
+    run (ERA5 is only updated once a day) isn't requested again. The latest
+    ERA5 data is used whatever the `analysis_time`, as it is days behind.
+
+    Returns:
+        dict: `datetime` of the data, and `pressure` and `single` level
+            datasets (None if no variable of the manifest is on them)
+    '''
+    await asyncio.to_thread(_store_api_key)
+    dt = await asyncio.to_thread(latest_datetime)
+    logger = logging.getLogger(__name__)
+    logger.info(f'Found latest datetime: {dt}')
+    downloads = _downloads(MANIFEST)
+    datasets = await asyncio.gather(*[
+        asyncio.to_thread(download_levels, str(target), dt, MANIFEST, write_files, cache)
+        for download_levels in downloads.values()
+    ])
+    return {'datetime': dt, 'pressure': None, 'single': None, **dict(zip(downloads, datasets))}
+
+def download_latest(target: str, manifest: Manifest = MANIFEST) -> datetime:
     '''
     Download the latest relevant files given by the era5 model.
     In order for this function to work, a CDS API key must be provided as an
@@ -16,31 +55,54 @@ def download_latest(target: str) -> datetime:
         
     Parameters:
         target (str): The target output **folder**.
+        manifest (Manifest): Manifest of the variables to download
     Returns:
         datetime: The date and time of the downloaded data
     '''
     
-    CDS_API_KEY = os.environ['CDS_API_KEY']
+    _store_api_key()
     
-    # Save the API key (env var) to the ~/.cdsapirc file (as required by the spec)
-    with open(os.path.expandvars("$HOME/.cdsapirc"), "w+") as f:
-        f.write(f'url: https://cds.climate.copernicus.eu/api\nkey: {CDS_API_KEY}')
-    
-    dt = _latest_datetime()
+    dt = latest_datetime()
     
     logger = logging.getLogger(__name__)
     logger.info(f'Found latest datetime: {dt}')
-    logger.info(f'Downloading pressure levels for {dt}...')
-    _download_pressure_levels(target, dt)
-    logger.info(f'Downloading single levels for {dt}...')
-    _download_single_levels(target, dt)
+    for download_levels in _downloads(manifest).values():
+        download_levels(target, dt, manifest)
     return dt
 
-def _download_pressure_levels(target: str, dt: datetime):
+def _downloads(manifest: Manifest) -> dict:
+    '''
+    Download functions of the datasets (`pressure` and `single` levels) from
+    which the manifest requires variables. A dataset without variables isn't
+    requested at all.
+    '''
+    downloads = {}
+    if manifest.variables(ERA5, is_level=True):
+        downloads['pressure'] = _download_pressure_levels
+    if manifest.variables(ERA5, is_level=False):
+        downloads['single'] = _download_single_levels
+    return downloads
+
+def _store_api_key():
+    '''
+    Save the API key (CDS_API_KEY env var) to the ~/.cdsapirc file (as
+    required by the spec).
+    '''
+    CDS_API_KEY = os.environ['CDS_API_KEY']
+    with open(os.path.expandvars("$HOME/.cdsapirc"), "w+") as f:
+        f.write(f'url: https://cds.climate.copernicus.eu/api\nkey: {CDS_API_KEY}')
+
+def _download_pressure_levels(target: str, dt: datetime, manifest: Manifest = MANIFEST,
+                           write_files: bool = True, cache: RawCache = None) -> xr.Dataset:
     '''
     Download the latest pressure levels. See
     [here](https://cds.climate.copernicus.eu/datasets/reanalysis-era5-pressure-levels)
-    for more info. The selected variables are the same as in the APPA paper.
+    for more info. Only the variables and levels that the manifest assigns to
+    ERA5 are requested.
+    
+    The data is returned in memory, and also written into a `.nc` file if
+    `write_files` is set. With a cache, the request is only sent if it isn't
+    cached.
     
     Will not work if called externally (requires the API key to first be stored).
     '''
@@ -48,46 +110,34 @@ def _download_pressure_levels(target: str, dt: datetime):
     dataset = "reanalysis-era5-pressure-levels"
     request = {
         "product_type": ["reanalysis"],
-        "variable": [
-            "geopotential",
-            "specific_humidity",
-            "temperature",
-            "u_component_of_wind",
-            "v_component_of_wind"
-        ],
+        "variable": manifest.request_names(ERA5, is_level=True),
         "year": [dt.year],
         "month": [dt.month],
         "day": [dt.day],
         "time": [dt.strftime("%H:%M:%S")],
-        "pressure_level": [
-            "50", "100", "150",
-            "200", "250", "300",
-            "400", "500", "600",
-            "700", "850", "925",
-            "1000"
-        ],
+        "pressure_level": [str(level) for level in manifest.levels],
         "data_format": "netcdf",
         "download_format": "zip"
     }
 
-    path = os.path.join(target, f'{dt.strftime("%Y-%m-%dT%H:%M:%SZ")}-pressure.zip')
+    logger = logging.getLogger(__name__)
+    logger.info(f'Downloading pressure levels ({", ".join(request["variable"])}) for {dt}...')
 
-    client = cdsapi.Client()
-    client.retrieve(dataset, request).download(target=path)
-    
-    filename_in_zip = 'data_stream-oper_stepType-instant.nc'
-    
-    with zipfile.ZipFile(path, 'r') as z:
-        z.extract(filename_in_zip,
-                  path=target)
-    
-    os.rename(os.path.join(target, filename_in_zip), os.path.splitext(path)[0] + '.nc')
+    path = os.path.join(target, f'{dt.strftime("%Y-%m-%dT%H:%M:%SZ")}-pressure.nc')
+
+    return _load(dataset, request, dt, path, write_files, cache)
 
-def _download_single_levels(target: str, dt: datetime):
+def _download_single_levels(target: str, dt: datetime, manifest: Manifest = MANIFEST,
+                            write_files: bool = True, cache: RawCache = None) -> xr.Dataset:
     '''
     Download the latest single levels. See
     [here](https://cds.climate.copernicus.eu/datasets/reanalysis-era5-pressure-levels)
-    for more info. The selected variables are the same as in the APPA paper.
+    for more info. Only the variables that the manifest assigns to ERA5 are
+    requested.
+    
+    The data is returned in memory, and also written into a `.nc` file if
+    `write_files` is set. With a cache, the request is only sent if it isn't
+    cached.
     
     Will not work if called externally (requires the API key to first be stored).
     '''
@@ -95,14 +145,7 @@ def _download_single_levels(target: str, dt: datetime):
     dataset = "reanalysis-era5-single-levels"
     request = {
         "product_type": ["reanalysis"],
-        "variable": [
-            "10m_u_component_of_wind",
-            "10m_v_component_of_wind",
-            "2m_temperature",
-            "mean_sea_level_pressure",
-            "sea_surface_temperature",
-            "total_precipitation"
-        ],
+        "variable": manifest.request_names(ERA5, is_level=False),
         "year": [dt.year],
         "month": [dt.month],
         "day": [dt.day],
@@ -111,34 +154,72 @@ def _download_single_levels(target: str, dt: datetime):
         "download_format": "zip"
     }
 
-    path = os.path.join(target, f'{dt.strftime("%Y-%m-%dT%H:%M:%SZ")}-single.zip')
+    logger = logging.getLogger(__name__)
+    logger.info(f'Downloading single levels ({", ".join(request["variable"])}) for {dt}...')
 
-    client = cdsapi.Client()
-    client.retrieve(dataset, request).download(target=path)
-    
+    path = os.path.join(target, f'{dt.strftime("%Y-%m-%dT%H:%M:%SZ")}-single.nc')
+
+    return _load(dataset, request, dt, path, write_files, cache)
+
+def _load(dataset: str, request: dict, dt: datetime, path: str, write_files: bool,
+          cache: RawCache = None) -> xr.Dataset:
+    '''
+    Load the NetCDF file of a request in memory, downloading it or reading it
+    from the cache, and keep it in `path` if `write_files` is set.
+    '''
+    if cache is None:
+        _retrieve(dataset, request, path)
+        nc_path = path
+    else:
+        key = cache_key(ERA5, request['variable'], request.get('pressure_level', []), dt,
+                        {'dataset': dataset, 'request': request})
+        entry = cache.get_or_download(
+            key,
+            lambda directory: _retrieve(dataset, request, directory / 'data.nc'),
+            {'source': ERA5, 'dataset': dataset, 'datetime': dt}
+        )
+        nc_path = entry / 'data.nc'
+        if write_files:
+            shutil.copyfile(nc_path, path)
+    ds = xr.load_dataset(nc_path, engine='netcdf4')
+    if cache is None and not write_files:
+        os.remove(nc_path)
+    return ds
+
+def _retrieve(dataset: str, request: dict, path: os.PathLike):
+    '''
+    Submit a request to the CDS, wait for its result, stream it (a zip file)
+    next to `path`, resuming the transfer if it is interrupted, and extract
+    its NetCDF file into `path`.
+    '''
     filename_in_zip = 'data_stream-oper_stepType-instant.nc'
-    
-    with zipfile.ZipFile(path, 'r') as z:
-        z.extract(filename_in_zip,
-                  path=target)
-    
-    os.rename(os.path.join(target, filename_in_zip), os.path.splitext(path)[0] + '.nc')
+    zip_path = os.path.splitext(path)[0] + '.zip'
 
+    client = cdsapi.Client()
+    result = client.retrieve(dataset, request)
+    download.download(result.location, zip_path, size=result.content_length)
+    download.extract_member(zip_path, filename_in_zip, path)
+    os.remove(zip_path)
 
-def _latest_datetime() -> datetime:
+def latest_datetime(get_json: Callable[[str], dict] = None) -> datetime:
     '''
-    Get the latest datetime available for the era5 hourly dataset.
+    Get the latest datetime available for the era5 hourly dataset, from the
+    temporal extent of the CDS catalogue.
+
+    Parameters:
+        get_json (Callable[[str], dict]): Function returning the JSON document
+            of a URL. Defaults to a GET request with the pooled session of the
+            host.
     Returns:
-        datetime(str): Latest date and time available (YYYY-mm-ddTHH-MMZ)
+        datetime: Latest date and time available
     '''
-    r = requests.get("https://cds.climate.copernicus.eu/api/catalogue/v1/collections/reanalysis-era5-single-levels")
-    json = r.json()
-    latest_single = json['extent']['temporal']['interval'][0][1]
+    if get_json is None:
+        get_json = _get_json
+    
+    latest_single = get_json(CATALOGUE_URL + 'reanalysis-era5-single-levels')['extent']['temporal']['interval'][0][1]
     latest_single_dt = datetime.fromisoformat(latest_single.replace('Z','+00:00'))
     
-    r = requests.get("https://cds.climate.copernicus.eu/api/catalogue/v1/collections/reanalysis-era5-pressure-levels")
-    json = r.json()
-    latest_pressure = json['extent']['temporal']['interval'][0][1]
+    latest_pressure = get_json(CATALOGUE_URL + 'reanalysis-era5-pressure-levels')['extent']['temporal']['interval'][0][1]
     latest_pressure_dt = datetime.fromisoformat(latest_pressure.replace('Z','+00:00'))
     
     # Just as an extra safety, we make sure we take the last datetime that is
@@ -146,6 +227,11 @@ def _latest_datetime() -> datetime:
     # should normally be equal.
     return min(latest_pressure_dt, latest_single_dt)
 
+def _get_json(url: str) -> dict:
+    r = download.session(url).get(url, timeout=download.HTTP_TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
 if __name__ == '__main__':
-    dt = _latest_datetime()
+    dt = latest_datetime()
     print(dt)
\ No newline at end of file
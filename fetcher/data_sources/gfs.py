@@ -11,17 +11,24 @@
 # THIS FILE IS NOT SUPPOSED TO BE USED AND PROBABLY DOES NOT WORK
 
 import re
-import requests
 import logging
 import os
+import shutil
 
-def download_latest(target: str) -> str:
+from datetime import datetime as Datetime
+
+from .. import download
+from ..cache import RawCache, cache_key
+
+def download_latest(target: str, cache: RawCache = None) -> str:
     '''
     Download the latest relevant files given by the GFS model. No API key is
     required for this model.
         
     Parameters:
         target (str): The target output **folder**.
+        cache (RawCache): Cache of the downloaded files, looked up before
+            downloading
     Returns:
         datetime (str): The date and time of the downloaded data, in ISO
             8601 format (YYYY-mm-ddTHH-MMZ).
@@ -45,12 +52,13 @@ def download_latest(target: str) -> str:
     logger = logging.getLogger(__name__)
     
     # Get the latest date
-    r = requests.get(base)
+    session = download.session(base)
+    r = session.get(base, timeout=download.HTTP_TIMEOUT)
     latest_date = max(re.findall(r"gfs\.(\d{8})", r.text))
     
     # Get the latest available hour
     hours_url = f"{base}gfs.{latest_date}/"
-    r = requests.get(hours_url)
+    r = session.get(hours_url, timeout=download.HTTP_TIMEOUT)
     hours = re.findall(r'href="(\d{2})/"', r.text)  # just "00", "06", "12", "18"
     hour = max(hours)
     
@@ -84,7 +92,7 @@ def download_latest(target: str) -> str:
     
     # return datetime
     
-    r = requests.head(file_url)
+    r = session.head(file_url, timeout=download.HTTP_TIMEOUT)
     size_bytes = int(r.headers["Content-Length"])
     size_mb = size_bytes / (1024 * 1024)
 
@@ -92,8 +100,16 @@ def download_latest(target: str) -> str:
     
     destination_file = os.path.join(target, f'{datetime}.grib2')
 
-    with open(destination_file, 'wb') as f:
-        f.write(requests.get(file_url).content)
+    if cache is None:
+        download.download(file_url, destination_file, size=size_bytes)
+    else:
+        key = cache_key('gfs', [], [], Datetime.fromisoformat(datetime), {'url': file_url})
+        entry = cache.get_or_download(
+            key,
+            lambda directory: download.download(file_url, directory / 'data.grib2', size=size_bytes),
+            {'source': 'gfs', 'datetime': datetime}
+        )
+        shutil.copyfile(entry / 'data.grib2', destination_file)
       
     # TODO: NetCDF conversion  
     # ds = xr.open_dataset(destination_file, engine='cfgrib')
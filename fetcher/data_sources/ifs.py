@@ -5,96 +5,270 @@
 #   https://data.ecmwf.int/forecasts/
 #   https://confluence.ecmwf.int/display/DAC/ECMWF+open+data%3A+real-time+forecasts+from+IFS+and+AIFS
 #   https://github.com/ecmwf/ecmwf-opendata - List of available params
+#
+# Each run is published as a single GRIB file, with an `.index` sidecar listing
+# the byte range of every message (one field at one level). Only the messages of
+# the variables and levels of the manifest are downloaded, with concurrent HTTP
+# Range requests over the pooled session of the host (`fetcher.download`), and
+# written straight into one GRIB file.
 
-from ecmwf.opendata import Client
+from concurrent.futures import ThreadPoolExecutor
 import os
-import xarray as xr
-import cfgrib
+import json
+import asyncio
 import logging
-from datetime import datetime, timezone
+import requests
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Callable
 
-def download_latest(target: str) -> datetime:
+from ..manifest import MANIFEST, Manifest, IFS
+from ..processing.decode_grib import decode_grib
+from .. import download
+from ..cache import RawCache, cache_key
+
+# Interface of fetcher.runner
+DEPENDS_ON = ()
+TIMEOUT = 1800
+RETRIES = 2
+
+BASE_URL = 'https://data.ecmwf.int/forecasts'
+RESOLUTION = '0p25'
+# Runs are published every 6 hours, a few hours after their time
+RUN_INTERVAL_HOURS = 6
+MAX_RUNS_BACK = 8
+# Messages separated by less than this are fetched with a single request, the
+# bytes in between being discarded
+MAX_GAP = 256 * 1024
+# Concurrent Range requests, as many as the pooled connections per host
+MAX_CONNECTIONS = download.MAX_CONNECTIONS
+HTTP_TIMEOUT = 60
+
+async def fetch(target: Path, dependencies: dict, write_files: bool = False,
+                cache: RawCache = None, analysis_time: datetime = None) -> dict:
+    '''
+    Download and decode the IFS data of the run at `analysis_time` (the latest
+    one if None), for fetcher.runner (see `download_datasets`).
+    '''
+    return await asyncio.to_thread(download_datasets, str(target), write_files=write_files, cache=cache,
+                                   run_time=analysis_time)
+
+def download_latest(target: str, manifest: Manifest = MANIFEST, base_url: str = BASE_URL) -> datetime:
     '''
     Download the latest relevant files given by the IFS model. No API key is
     required for this model.
         
     Parameters:
         target (str): The target output **folder**.
+        manifest (Manifest): Manifest of the variables to download
+        base_url (str): Root of the ECMWF open data
     Returns:
         datetime: The date and time of the downloaded data
     '''
-    data_file = os.path.join(target, 'data.grib2')
-    client = Client(model="ifs")
-    result = client.retrieve(
-        type='fc',
-        step=0,
-        param=[
-                # Single level fields
-                
-                '10u',  # 10 metre U wind component
-                '10v',  # 10 metre V wind component
-                '2t',   # 2 metre temperature
-                'msl',  # Mean sea level pressure
-                #'ro',   # Runoff
-                #'skt',  # Skin temperature
-                #'sp',   # Surface pressure
-                #'st',   # Soil Temperature - Not found?!
-                #'stl1', # Soil temperature level 1 - Not found?!
-                #'tcwv', # Total column vertically-integrated water vapour 	
-                'tp',   # Total Precipitation
-                #'ssr', # Doesn't work
-                
-                # Atmospheric fields on pressure levels
-                
-                #'d',   # Divergence
-                'gh', 	# Geopotential height
-                'q',	# Specific humidity
-                #'r',	# Relative humidity
-                't',	# Temperature 	K
-                'u',	# U component of wind
-                'v',	# V component of wind
-                #'vo', 	# Vorticity (relative)
-            ],
-        target=data_file,
-    )
-        
-    iso_format = result.datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
-    os.rename(data_file, os.path.join(target, f'{iso_format}.grib2'))
-    data_file = os.path.join(target, f'{iso_format}.grib2')
-    
+    return download_datasets(target, manifest, base_url, write_files=True)['datetime']
+
+def download_datasets(target: str,
+                      manifest: Manifest = MANIFEST,
+                      base_url: str = BASE_URL,
+                      write_files: bool = False,
+                      cache: RawCache = None,
+                      run_time: datetime = None) -> dict:
+    '''
+    Download the IFS data of a run (the latest one by default) and decode it
+    in memory. With a cache, the GRIB file of a run is only downloaded once.
+
+    Parameters:
+        target (str): The target output **folder** of the GRIB file
+        manifest (Manifest): Manifest of the variables to download
+        base_url (str): Root of the ECMWF open data
+        write_files (bool): Also write the decoded data into `-pressure.nc`
+            and `-single.nc` files, for `--skip-download` or debugging
+        cache (RawCache): Cache of the GRIB files, looked up before
+            downloading
+        run_time (datetime): Time of the run (e.g. the one found by the
+            scheduler). Defaults to the latest published run.
+    Returns:
+        dict: `datetime` of the data, and `pressure` and `single` level
+            datasets
+    '''
     logger = logging.getLogger(__name__)
-    logger.info('Converting the obtained .grib2 file into NetCDF4')
-    _grib_to_netcdf4(data_file)
-    
-    return result.datetime.replace(tzinfo=timezone.utc)
+    session = download.session(base_url)
+    if run_time is None:
+        dt, url = latest_run(base_url)
+        logger.info(f'Found latest IFS run: {dt}')
+    else:
+        dt, url = run_time, run_url(base_url, run_time)
+        logger.info(f'Using the IFS run of {dt}')
+    iso_format = dt.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-def _grib_to_netcdf4(grib_path: str) -> None:
-    dss = cfgrib.open_datasets(grib_path, decode_timedelta=True)
+    def download_run(data_file: str):
+        entries = select_messages(read_index(session, url), manifest)
+        size = download_messages(session, url, entries, data_file)
+        logger.info(f'Downloaded {len(entries)} IFS messages ({size / 1e6:.1f} MB)')
+
+    if cache is None:
+        data_file = os.path.join(target, f'{iso_format}.grib2')
+        download_run(data_file)
+    else:
+        key = cache_key(IFS, manifest.request_names(IFS), manifest.levels, dt, {'url': url})
+        entry = cache.get_or_download(
+            key,
+            lambda directory: download_run(str(directory / 'data.grib2')),
+            {'source': IFS, 'datetime': dt}
+        )
+        data_file = str(entry / 'data.grib2')
+    
+    # The geopotential height is converted to geopotential while decoding
+    pressure, single = decode_grib(data_file, scale={'gh': 9.81})
+    if write_files:
+        logger.info('Writing the decoded data into NetCDF4 files')
+        pressure.to_netcdf(os.path.join(target, f'{iso_format}-pressure.nc'))
+        single.to_netcdf(os.path.join(target, f'{iso_format}-single.nc'))
     
-    # Remove the 'heightAboveGround' coordinate that's messing up the merging
-    # of all single-layer variables into a single file.
-    for i in range(len(dss)):
-        if 'heightAboveGround' in dss[i].coords:
-            dss[i] = dss[i].drop_vars('heightAboveGround')
-            
-    pressures = []
-    singles= []
-
-    for ds in dss:
-        if 'isobaricInhPa' in ds.coords:
-            pressures.append(ds)
+    return {'datetime': dt, 'pressure': pressure, 'single': single}
+
+def run_url(base_url: str, dt: datetime) -> str:
+    '''
+    URL of the GRIB file of the analysis (step 0) of an IFS run.
+    '''
+    # The 06 and 18 UTC runs are in the short cut-off stream
+    stream = 'oper' if dt.hour in (0, 12) else 'scda'
+    return (f'{base_url}/{dt:%Y%m%d}/{dt:%H}z/ifs/{RESOLUTION}/{stream}/'
+            f'{dt:%Y%m%d%H}0000-0h-{stream}-fc.grib2')
+
+def read_index(session: requests.Session, url: str) -> list[dict]:
+    '''
+    Read the `.index` sidecar of a GRIB file: one JSON object per line, with
+    the keys of a message (`param`, `levtype`, `levelist`, ...) and its byte
+    range (`_offset`, `_length`).
+    '''
+    r = session.get(os.path.splitext(url)[0] + '.index', timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    return [json.loads(line) for line in r.text.splitlines() if line.strip()]
+
+def select_messages(entries: list[dict], manifest: Manifest = MANIFEST) -> list[dict]:
+    '''
+    Select the index entries of the variables and levels of the manifest.
+
+    Parameters:
+        entries (list[dict]): Entries of the index
+        manifest (Manifest): Manifest of the variables to download
+    Returns:
+        list[dict]: Selected entries, in the order of the file
+    Raises:
+        ValueError: If a variable or level is missing from the index
+    '''
+    singles = set(manifest.request_names(IFS, is_level=False))
+    levels = set(manifest.request_names(IFS, is_level=True))
+    wanted = {(param, None) for param in singles}
+    wanted |= {(param, level) for param in levels for level in manifest.levels}
+
+    selected = []
+    for entry in entries:
+        if entry.get('levtype') == 'pl':
+            key = (entry['param'], int(entry['levelist']))
         else:
-            singles.append(ds)
+            key = (entry['param'], None)
+        if key in wanted:
+            wanted.discard(key)
+            selected.append(entry)
+    if wanted:
+        missing = ', '.join(p if l is None else f'{p}@{l}' for p, l in sorted(wanted, key=str))
+        raise ValueError(f'Not in the IFS index: {missing}')
+    return sorted(selected, key=lambda e: e['_offset'])
 
-    pressures = xr.merge(pressures)
-    singles = xr.merge(singles)
+def coalesce_ranges(entries: list[dict], max_gap: int = MAX_GAP) -> list[tuple[int, int, list[dict]]]:
+    '''
+    Group messages into byte ranges, merging messages separated by at most
+    `max_gap` bytes.
+
+    Parameters:
+        entries (list[dict]): Index entries, sorted by offset
+        max_gap (int): Maximum number of unused bytes between two merged
+            messages
+    Returns:
+        list[tuple[int, int, list[dict]]]: (start, end, entries) of each
+            range, `end` being exclusive
+    '''
+    ranges = []
+    for entry in entries:
+        start, end = entry['_offset'], entry['_offset'] + entry['_length']
+        if ranges and start - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = max(ranges[-1][1], end)
+            ranges[-1][2].append(entry)
+        else:
+            ranges.append([start, end, [entry]])
+    return [tuple(r) for r in ranges]
+
+def download_messages(session: requests.Session, url: str, entries: list[dict], path: str,
+                      max_gap: int = MAX_GAP, max_connections: int = MAX_CONNECTIONS) -> int:
+    '''
+    Download messages of a GRIB file into a new GRIB file holding only them,
+    with concurrent Range requests. Each message is written at its final
+    position as soon as its range is received.
+
+    Parameters:
+        session (requests.Session): Session, whose connections are reused
+        url (str): URL of the GRIB file
+        entries (list[dict]): Index entries of the messages, sorted by offset
+        path (str): Destination GRIB file
+        max_gap (int): See `coalesce_ranges`
+        max_connections (int): Maximum number of concurrent requests
+    Returns:
+        int: Size of the written file, in bytes
+    '''
+    # Position of each message in the output file
+    positions, size = {}, 0
+    for entry in entries:
+        positions[entry['_offset']] = size
+        size += entry['_length']
+
+    def fetch_range(start: int, end: int, range_entries: list[dict]):
+        r = session.get(url, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+        if r.status_code != 206 or len(r.content) != end - start:
+            raise IOError(f'Invalid response to the range {start}-{end - 1} of {url}')
+        data = memoryview(r.content)
+        for entry in range_entries:
+            offset = entry['_offset'] - start
+            os.pwrite(fd, data[offset:offset + entry['_length']], positions[entry['_offset']])
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_connections) as pool:
+            # list() raises the first failure
+            list(pool.map(lambda r: fetch_range(*r), coalesce_ranges(entries, max_gap)))
+    finally:
+        os.close(fd)
+    return size
+
+def latest_run(base_url: str = BASE_URL, exists: Callable[[str], bool] = None) -> tuple[datetime, str]:
+    '''
+    Find the latest run whose analysis is published, by looking for the index
+    of the last runs.
+
+    Parameters:
+        base_url (str): Root of the ECMWF open data
+        exists (Callable[[str], bool]): Whether a URL exists. Defaults to a
+            HEAD request with the pooled session of the host.
+    Returns:
+        (datetime, str): Time of the run, and URL of its GRIB file
+    Raises:
+        IOError: If none of the last runs is published
+    '''
+    if exists is None:
+        session = download.session(base_url)
+        exists = lambda url: session.head(url, timeout=HTTP_TIMEOUT).status_code == 200
+    now = datetime.now(timezone.utc)
+    dt = now.replace(hour=now.hour - now.hour % RUN_INTERVAL_HOURS, minute=0, second=0, microsecond=0)
+    for _ in range(MAX_RUNS_BACK):
+        url = run_url(base_url, dt)
+        if exists(os.path.splitext(url)[0] + '.index'):
+            return dt, url
+        dt -= timedelta(hours=RUN_INTERVAL_HOURS)
+    raise IOError(f'No IFS run found in the last {MAX_RUNS_BACK * RUN_INTERVAL_HOURS} hours at {base_url}')
 
-    if 'gh' in pressures.variables:
-        pressures['gh'] = pressures['gh'] * 9.81
-    
-    pressures.to_netcdf(os.path.splitext(grib_path)[0] + '-pressure.nc')
-    singles.to_netcdf(os.path.splitext(grib_path)[0] + '-single.nc')
-    
 if __name__ == '__main__':
     dt = download_latest('tmp')
     print(dt)
\ No newline at end of file
@@ -17,43 +17,82 @@
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from pathlib import Path
+from typing import Callable
 
 import matplotlib.pyplot as plt
 import xarray as xr
 import numpy as np
-import requests
 import tempfile
+import asyncio
 import logging
 import dotenv
 import os
 
+from ..processing.regrid import regrid
+from .. import download
+from ..cache import RawCache, cache_key
+from ..manifest import IMERG
+
 dotenv.load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Interface of fetcher.runner: the precipitation is fetched at the datetime of
+# the IFS data.
+DEPENDS_ON = ('ifs',)
+TIMEOUT = 900
+RETRIES = 2
+
+# Half-hourly IMERG Early run, version 07
+PRODUCT = 'GPM_3IMERGHHE.07'
+
+# Cache of the weights from the IMERG grid to the 0.25° grid
+REGRID_CACHE_DIR = Path(tempfile.gettempdir()) / 'appa-live-regrid'
+
+async def fetch(target: Path, dependencies: dict, write_files: bool = False,
+                cache: RawCache = None, analysis_time: datetime = None) -> dict:
+    # At the datetime of the IFS data, which is `analysis_time` if given
+    dt = dependencies['ifs']['datetime']
+    ds = await asyncio.to_thread(total_precipitation_dataset, dt, cache)
+    if write_files:
+        await asyncio.to_thread(ds.to_netcdf, Path(target) / (dt.isoformat() + '.nc'))
+    return {'datetime': dt, 'precipitation': ds}
+
 def get_total_precipitation(dt: datetime, output_dir: os.PathLike) -> Path:
     output_dir = Path(output_dir)
-    start_dt = dt - timedelta(minutes=30)
     out_path = output_dir / (dt.isoformat() + '.nc')
-    
-    with tempfile.TemporaryDirectory() as tempdir:
-        nc4 = _get_nc4_at_starthour(start_dt, tempdir)
-        ds = xr.open_dataset(nc4)
-        ds = reformat_to_era5(ds)
-        ds.to_netcdf(out_path)
-
+    total_precipitation_dataset(dt).to_netcdf(out_path)
     return out_path
 
-def _get_nc4_at_starthour(start_dt: datetime, output_dir: os.PathLike):
-    update_netrc_credentials()
+def total_precipitation_dataset(dt: datetime, cache: RawCache = None) -> xr.Dataset:
+    '''
+    Download the precipitation of the half hour before `dt`, regridded to the
+    0.25° grid, in memory. With a cache, the file is only downloaded once.
+    '''
+    start_dt = dt - timedelta(minutes=30)
     
+    if cache is not None:
+        key = cache_key(IMERG, ['precipitation'], [], start_dt, {'product': PRODUCT})
+        entry = cache.get_or_download(
+            key,
+            lambda directory: _get_nc4_at_starthour(start_dt, directory),
+            {'source': IMERG, 'datetime': start_dt}
+        )
+        with xr.open_dataset(entry / (start_dt.isoformat() + '.nc4')) as ds:
+            return reformat_to_era5(ds).load()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        nc4 = _get_nc4_at_starthour(start_dt, tempdir)
+        with xr.open_dataset(nc4) as ds:
+            return reformat_to_era5(ds).load()
+
+def granule_url(start_dt: datetime) -> str:
+    '''
+    OPeNDAP URL of the IMERG Early granule of the half hour starting at
+    `start_dt`.
+    '''
     year = start_dt.year
     day_of_year = start_dt.timetuple().tm_yday
 
-    date_str = f"{year}{day_of_year:03d}"
-
-    start_hour = start_dt.hour
-    start_minute = start_dt.minute
-
     end_dt = start_dt + timedelta(minutes=29, seconds=59)
 
     start_time_str = start_dt.strftime("%H%M%S")
@@ -62,33 +101,59 @@ def _get_nc4_at_starthour(start_dt: datetime, output_dir: os.PathLike):
     minutes_since_midnight = start_dt.hour * 60 + start_dt.minute
 
     # Build the filename
-    filename = f"3B-HHR-E.MS.MRG.3IMERG.{start_dt.strftime('%Y%m%d')}-S{start_time_str}-E{end_time_str}.{minutes_since_midnight:04d}.V07B.HDF5.dap.nc4"
+    filename = f"3B-HHR-E.MS.MRG.3IMERG.{start_dt.strftime('%Y%m%d')}-S{start_time_str}-E{end_time_str}.{minutes_since_midnight:04d}.V07B.HDF5"
 
     # Base URL with year and day_of_year folders
-    url = f"https://gpm1.gesdisc.eosdis.nasa.gov/opendap/hyrax/GPM_L3/GPM_3IMERGHHE.07/{year}/{day_of_year:03d}/{filename}"
+    return f"https://gpm1.gesdisc.eosdis.nasa.gov/opendap/hyrax/GPM_L3/{PRODUCT}/{year}/{day_of_year:03d}/{filename}"
+
+def granule_available(dt: datetime, exists: Callable[[str, tuple], bool] = None,
+                      auth: tuple[str, str] = None) -> bool:
+    '''
+    Whether the precipitation of the half hour before `dt` is published, from
+    the existence of the (small) DMR document of its granule.
+
+    Parameters:
+        dt (datetime): Time of the data, as in `total_precipitation_dataset`
+        exists (Callable[[str, tuple], bool]): Whether a URL exists, given the
+            URL and the Earthdata credentials. Defaults to a GET request with
+            the pooled session of the host, whose body isn't read.
+        auth (tuple[str, str]): Earthdata credentials. Defaults to
+            `credentials()`.
+    '''
+    auth = auth or credentials()
+    url = granule_url(dt - timedelta(minutes=30)) + '.dmr.xml'
+    if exists is None:
+        with download.session(url).get(url, auth=auth, stream=True, timeout=download.HTTP_TIMEOUT) as r:
+            return r.status_code == 200
+    return exists(url, auth)
+
+def _get_nc4_at_starthour(start_dt: datetime, output_dir: os.PathLike):
+    update_netrc_credentials()
     
+    url = granule_url(start_dt) + ".dap.nc4"
     url += "?dap4.ce=/lat[0:1:1799];/lon[0:1:3599];/precipitation[0:1:0][0:1:3599][0:1:1799]"
 
     username = os.environ["EARTHDATA_USERNAME"]
     password = os.environ["EARTHDATA_PASSWORD"]
 
-    session = requests.Session()
-    session.auth = (username, password)
-    session.headers.update({"User-Agent": "python-requests"})
-
-    logger.info(f'Downloading IMERG Early data from {url}')
-    r = session.get(url)
-    r.raise_for_status()
-    
     out_filename = start_dt.isoformat() + '.nc4'
     out_path = os.path.join(output_dir, out_filename)
-    
-    with open(out_path, "wb") as f:
-        f.write(r.content)
+
+    logger.info(f'Downloading IMERG Early data from {url}')
+    download.download(
+        url,
+        out_path,
+        auth=(username, password),
+        headers={"User-Agent": "python-requests"}
+    )
     
     return out_path
 
 def reformat_to_era5(ds: xr.Dataset):
+    '''
+    Regrid the 0.1° IMERG precipitation conservatively to the 0.25° grid of
+    ERA5, in m/hr.
+    '''
     N_LON = 1440
     N_LAT = 721
     
@@ -102,13 +167,26 @@ def reformat_to_era5(ds: xr.Dataset):
     
     ds = ds.transpose("time", "latitude", "longitude")
 
-    return ds.interp(latitude=new_lats, longitude=new_lons)
+    return regrid(ds, new_lats, new_lons, REGRID_CACHE_DIR)
 
 def add_together(a: xr.Dataset, b: xr.Dataset):
     pass
 
 from pathlib import Path
 
+def credentials() -> tuple[str, str]:
+    '''
+    Earthdata username and password, from the environment.
+
+    Raises:
+        RuntimeError: If they are missing
+    '''
+    username = os.getenv("EARTHDATA_USERNAME")
+    password = os.getenv("EARTHDATA_PASSWORD")
+    if not username or not password:
+        raise RuntimeError("EARTHDATA_USERNAME or EARTHDATA_PASSWORD missing")
+    return username, password
+
 def update_netrc_credentials():
     username = os.getenv("EARTHDATA_USERNAME")
     password = os.getenv("EARTHDATA_PASSWORD")
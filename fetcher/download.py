@@ -0,0 +1,192 @@
+# Shared HTTP download layer of the data sources. Responses are streamed to
+# disk in chunks, so that memory use doesn't grow with the size of the files,
+# into a `.part` file which is renamed once complete. An interrupted transfer
+# is resumed from where it stopped with a Range request (if the server allows
+# it, otherwise it starts again), even by a later call: the ETag (or
+# Last-Modified date) of the file is kept next to the `.part` file and sent with
+# the request (`If-Range`), so that a file changed in between is downloaded
+# again from the start. The size of the result is checked against
+# the one announced by the server. Every host has one pooled session, shared by
+# all the sources and threads, so that connections are reused between requests.
+
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathlib import Path
+
+import threading
+import requests
+import zipfile
+import logging
+import shutil
+import time
+import os
+
+# Connections kept open per host
+MAX_CONNECTIONS = 8
+HTTP_TIMEOUT = 60
+CHUNK_SIZE = 1024 * 1024
+# Additional attempts after an interrupted transfer, each one resuming it
+RETRIES = 3
+# Seconds before the first resume, doubled for each following one
+RETRY_DELAY = 2
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def session(url: str) -> requests.Session:
+    '''
+    Pooled session of the host of a URL, created on first use. Failed
+    connections and temporary server errors (502, 503, 504) are retried.
+
+    Parameters:
+        url (str): Any URL of the host
+    Returns:
+        requests.Session: The session, shared by every caller and thread
+    '''
+    parts = urlsplit(url)
+    host = f'{parts.scheme}://{parts.netloc}'
+    with _sessions_lock:
+        if host not in _sessions:
+            retry = Retry(
+                total=3,
+                read=0,
+                backoff_factor=1,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=('GET', 'HEAD'),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONNECTIONS, max_retries=retry)
+            s = requests.Session()
+            s.mount(host, adapter)
+            _sessions[host] = s
+        return _sessions[host]
+
+def download(url: str,
+             path: os.PathLike,
+             size: int = None,
+             auth: tuple[str, str] = None,
+             headers: dict = None,
+             retries: int = RETRIES,
+             timeout: float = HTTP_TIMEOUT,
+             chunk_size: int = CHUNK_SIZE) -> int:
+    '''
+    Stream a URL into a file, resuming the transfer if it is interrupted.
+
+    Parameters:
+        url (str): URL to download
+        path (os.PathLike): Destination file, only written once complete
+            (the data goes into `<path>.part` until then, which a later call
+            resumes if its validator, in `<path>.part.etag`, is known)
+        size (int): Expected size, in bytes. Defaults to the size announced by
+            the server, if any.
+        auth (tuple[str, str]): Credentials of the request
+        headers (dict): Additional headers of the request
+        retries (int): Additional attempts after an interrupted transfer
+        timeout (float): Seconds without data after which a transfer is
+            considered interrupted
+        chunk_size (int): Size of the chunks written to disk, in bytes
+    Returns:
+        int: Size of the file, in bytes
+    Raises:
+        IOError: If the transfer could not be completed, or the size of the
+            file is not the expected one
+    '''
+    logger = logging.getLogger(__name__)
+    path = Path(path)
+    part = path.with_name(path.name + '.part')
+    validator_path = path.with_name(path.name + '.part.etag')
+    # Sizes are only comparable without a content encoding
+    headers = {'Accept-Encoding': 'identity', **(headers or {})}
+    validator = validator_path.read_text() if validator_path.exists() else None
+    error = None
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            delay = RETRY_DELAY * 2 ** (attempt - 1)
+            logger.warning(f'Download of {url} interrupted ({error!r}), resuming in {delay}s')
+            time.sleep(delay)
+        if part.exists() and validator is None:
+            # Can't tell whether the file changed since it was started
+            logger.info(f'Discarding {part}, whose validator is unknown')
+            part.unlink()
+        done = part.stat().st_size if part.exists() else 0
+        request_headers = dict(headers)
+        if done:
+            request_headers['Range'] = f'bytes={done}-'
+            # The whole file is sent again if it changed in between
+            request_headers['If-Range'] = validator
+        try:
+            with session(url).get(url, headers=request_headers, auth=auth, stream=True, timeout=timeout) as r:
+                if r.status_code == 416 and done:
+                    # Nothing left after `done`: the file was already complete
+                    total = _content_range(r)[1]
+                else:
+                    r.raise_for_status()
+                    if done and r.status_code == 206:
+                        start, total = _content_range(r)
+                        if start != done:
+                            raise IOError(f'{url} resumed at byte {start} instead of {done}')
+                        mode = 'ab'
+                    else:
+                        if done:
+                            logger.info(f'{url} can\'t be resumed, downloading it again')
+                        done, mode = 0, 'wb'
+                        total = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                        # Kept for the resumes, including by later calls
+                        etag = r.headers.get('ETag')
+                        validator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified')
+                        if validator is None:
+                            validator_path.unlink(missing_ok=True)
+                        else:
+                            validator_path.write_text(validator)
+                    with open(part, mode) as f:
+                        for chunk in r.iter_content(chunk_size):
+                            f.write(chunk)
+                            done += len(chunk)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+            continue
+
+        expected = size if size is not None else total
+        if expected is None or done == expected:
+            os.replace(part, path)
+            validator_path.unlink(missing_ok=True)
+            return done
+        if done > expected:
+            part.unlink()
+            validator_path.unlink(missing_ok=True)
+            raise IOError(f'Downloaded {done} bytes from {url} instead of {expected}')
+        error = IOError(f'Transfer stopped after {done} of {expected} bytes')
+
+    raise IOError(f'Failed to download {url} after {retries + 1} attempts') from error
+
+def extract_member(zip_path: os.PathLike, member: str, path: os.PathLike,
+                   chunk_size: int = CHUNK_SIZE) -> Path:
+    '''
+    Decompress a member of a zip file into `path`, in chunks.
+
+    Parameters:
+        zip_path (os.PathLike): Zip file
+        member (str): Name of the member in the zip file
+        path (os.PathLike): Destination file
+        chunk_size (int): Size of the decompressed chunks, in bytes
+    Returns:
+        Path: The destination file
+    '''
+    path = Path(path)
+    with zipfile.ZipFile(zip_path) as z, z.open(member) as source, open(path, 'wb') as destination:
+        shutil.copyfileobj(source, destination, chunk_size)
+    return path
+
+def _content_range(r: requests.Response) -> tuple[int | None, int | None]:
+    '''
+    First byte and total size of a `Content-Range: bytes a-b/n` header
+    (None when unknown).
+    '''
+    value = r.headers.get('Content-Range', '')
+    if not value.startswith('bytes '):
+        raise IOError(f'Invalid Content-Range in the response of {r.url}: {value!r}')
+    span, _, total = value[6:].partition('/')
+    start = None if span == '*' else int(span.split('-')[0])
+    return start, None if total in ('', '*') else int(total)
@@ -0,0 +1,139 @@
+# Declares which data source supplies each variable of the model, and under
+# which names. The manifest is derived from the variables and pressure levels of
+# the model (`model_variables`), and every data source only requests what it
+# assigns to it, so that changing the variables of the model changes what is
+# downloaded (and a variable that no source supplies is an error rather than a
+# silent over- or under-fetch).
+
+import model_variables
+
+IFS = 'ifs'
+ERA5 = 'era5'
+IMERG = 'imerg'
+# Computed locally (fetcher.custom_data) rather than downloaded
+COMPUTED = 'computed'
+
+# Source of each variable that the model may use, with its name in the requests
+# of the source and in the downloaded files.
+SUPPLIERS = {
+    # variable: (source, request name, file name)
+    '2m_temperature': (IFS, '2t', 't2m'),
+    '10m_u_component_of_wind': (IFS, '10u', 'u10'),
+    '10m_v_component_of_wind': (IFS, '10v', 'v10'),
+    'mean_sea_level_pressure': (IFS, 'msl', 'msl'),
+    'temperature': (IFS, 't', 't'),
+    'u_component_of_wind': (IFS, 'u', 'u'),
+    'v_component_of_wind': (IFS, 'v', 'v'),
+    # Geopotential height, converted to geopotential by the ifs source
+    'geopotential': (IFS, 'gh', 'gh'),
+    'specific_humidity': (IFS, 'q', 'q'),
+    # Not provided by the IFS open data
+    'sea_surface_temperature': (ERA5, 'sea_surface_temperature', 'sst'),
+    # The IFS precipitation at step 0 is always zero
+    'total_precipitation': (IMERG, 'precipitation', 'precipitation'),
+    'toa_incident_solar_radiation': (COMPUTED, 'toa_incident_solar_radiation', 'toa_incident_solar_radiation'),
+}
+
+class SourceVariable:
+    '''
+    A variable of the model, as supplied by a data source.
+
+    Parameters:
+        variable (str): Name of the variable in the model
+        source (str): Name of the data source supplying it
+        request_name (str): Name of the variable in the requests of the source
+        file_name (str): Name of the variable in the files of the source
+        is_level (bool): Whether the variable is defined on pressure levels
+    '''
+    def __init__(self, variable: str, source: str, request_name: str, file_name: str, is_level: bool):
+        self.variable = variable
+        self.source = source
+        self.request_name = request_name
+        self.file_name = file_name
+        self.is_level = is_level
+
+    def __repr__(self) -> str:
+        return f'SourceVariable({self.variable!r}, {self.source!r}, {self.request_name!r})'
+
+class Manifest:
+    '''
+    Variables of the model and the sources that supply them.
+
+    Parameters:
+        entries (list[SourceVariable]): Variables of the model
+        levels (list[int]): Pressure levels of the model, in hPa
+    '''
+    def __init__(self, entries: list[SourceVariable], levels: list[int]):
+        self.entries = entries
+        self.levels = levels
+
+    @property
+    def sources(self) -> set[str]:
+        '''
+        Names of the sources supplying at least one variable.
+        '''
+        return {entry.source for entry in self.entries}
+
+    def variables(self, source: str, is_level: bool = None) -> list[SourceVariable]:
+        '''
+        Variables supplied by a source.
+
+        Parameters:
+            source (str): Name of the source
+            is_level (bool): If given, only return the pressure level (True)
+                or single level (False) variables.
+        Returns:
+            list[SourceVariable]: The variables, in the order of the model
+        '''
+        return [
+            entry for entry in self.entries
+            if entry.source == source and (is_level is None or entry.is_level == is_level)
+        ]
+
+    def request_names(self, source: str, is_level: bool = None) -> list[str]:
+        '''
+        Names to request from a source (see `variables`).
+        '''
+        return [entry.request_name for entry in self.variables(source, is_level)]
+
+    def renames(self, source: str) -> dict[str, str]:
+        '''
+        Mapping from the names in the files of a source to the names of the
+        model.
+        '''
+        return {entry.file_name: entry.variable for entry in self.variables(source)}
+
+def build_manifest(variables: list[str] = model_variables.VARIABLES,
+                   context_variables: list[str] = model_variables.CONTEXT_VARIABLES,
+                   levels: list[int] = model_variables.PRESSURE_LEVELS,
+                   atmospheric_variables: list[str] = model_variables.ATMOSPHERIC_VARIABLES) -> Manifest:
+    '''
+    Build the manifest of a set of model variables.
+
+    Parameters:
+        variables (list[str]): Variables of the model
+        context_variables (list[str]): Context variables of the model that
+            change with time (the static ones are read from
+            `ctx_variables.nc`)
+        levels (list[int]): Pressure levels of the model, in hPa
+        atmospheric_variables (list[str]): Variables among `variables` that
+            are defined on pressure levels
+    Returns:
+        Manifest: The manifest
+    Raises:
+        ValueError: If no source supplies one of the variables
+    '''
+    missing = [v for v in [*variables, *context_variables] if v not in SUPPLIERS]
+    if missing:
+        raise ValueError(f'No data source supplies {", ".join(missing)}')
+    entries = [
+        SourceVariable(v, *SUPPLIERS[v], v in atmospheric_variables)
+        for v in [*variables, *context_variables]
+    ]
+    return Manifest(entries, list(levels))
+
+MANIFEST = build_manifest()
+
+if __name__ == '__main__':
+    for source in sorted(MANIFEST.sources):
+        print(f'{source}: {", ".join(e.variable for e in MANIFEST.variables(source))}')
@@ -1,2 +1,5 @@
 from .process_data import process_data as process_data
-from .process_data import latest_datetime as latest_datetime
\ No newline at end of file
+from .process_data import process_datasets as process_datasets
+from .process_data import latest_datetime as latest_datetime
+from .decode_grib import decode_grib as decode_grib
+from .regrid import regrid as regrid
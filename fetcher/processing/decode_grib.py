@@ -0,0 +1,231 @@
+# Decodes a GRIB file into pressure level and single level datasets, in
+# parallel. The offsets of the messages are found with a single scan of the
+# file, and their headers (variable, level, grid) are read to lay out all the
+# fields in one preallocated float32 buffer, as (level, latitude, longitude)
+# arrays. The values of the messages, the expensive part, are then decoded with
+# eccodes in a pool of threads (eccodes releases the GIL while decoding), each
+# one writing its fields straight into their place in the buffer, so that
+# nothing is merged or copied afterwards. Threads rather than processes, as the
+# decoding runs next to the threads of the other sources: a forked process
+# could inherit a lock held by one of them.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import tempfile
+import shutil
+import logging
+import mmap
+import os
+
+import numpy as np
+import xarray as xr
+
+LEVEL_TYPE = 'isobaricInhPa'
+
+class _Field:
+    '''
+    A message of a GRIB file and the place of its values in the buffer.
+    '''
+    def __init__(self, offset: int, length: int, name: str, level_type: str, level: int,
+                 shape: tuple[int, int], attrs: dict):
+        self.offset = offset
+        self.length = length
+        self.name = name
+        self.level_type = level_type
+        self.level = level
+        self.shape = shape
+        self.attrs = attrs
+        # Position of the values in the buffer, in bytes
+        self.position = None
+
+def scan_messages(path: os.PathLike) -> list[tuple[int, int]]:
+    '''
+    Find the messages of a GRIB (edition 1 or 2) file.
+
+    Parameters:
+        path (os.PathLike): Path to the GRIB file
+    Returns:
+        list[tuple[int, int]]: (offset, length) of each message, in bytes
+    '''
+    messages = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = data.find(b'GRIB')
+        while position != -1 and position + 16 <= len(data):
+            edition = data[position + 7]
+            if edition == 2:
+                length = int.from_bytes(data[position + 8:position + 16], 'big')
+            else:
+                length = int.from_bytes(data[position + 4:position + 7], 'big')
+            if length < 16 or position + length > len(data) or data[position + length - 4:position + length] != b'7777':
+                raise ValueError(f'Invalid GRIB message at offset {position} of {path}')
+            messages.append((position, length))
+            position = data.find(b'GRIB', position + length)
+    return messages
+
+def decode_grib(path: os.PathLike,
+                scale: dict[str, float] = None,
+                max_workers: int = None) -> tuple[xr.Dataset, xr.Dataset]:
+    '''
+    Decode a GRIB file on a regular latitude/longitude grid into the same
+    pressure level and single level datasets as `cfgrib.open_datasets` followed
+    by `xr.merge` (without the coordinates of the single level types, such as
+    `heightAboveGround`).
+
+    Parameters:
+        path (os.PathLike): Path to the GRIB file
+        scale (dict[str, float]): Factors by which variables are multiplied
+            while decoding, by name (e.g. `{'gh': 9.81}`)
+        max_workers (int): Number of decoding threads. Defaults to the number
+            of CPUs.
+    Returns:
+        (pressure, single) (xr.Dataset, xr.Dataset): Pressure level variables,
+            with an `isobaricInhPa` dimension, and single level variables
+    '''
+    import eccodes
+
+    logger = logging.getLogger(__name__)
+    path = str(path)
+    scale = scale or {}
+    messages = scan_messages(path)
+    if not messages:
+        raise ValueError(f'No GRIB message in {path}')
+
+    # Headers are cheap to read, the values are only decoded by the workers
+    fields = []
+    with open(path, 'rb') as f:
+        for offset, length in messages:
+            f.seek(offset)
+            handle = eccodes.codes_new_from_message(f.read(length))
+            try:
+                if eccodes.codes_get(handle, 'gridType') != 'regular_ll' or eccodes.codes_get(handle, 'iScansNegatively'):
+                    raise ValueError(f'Unsupported grid in {path}')
+                fields.append(_Field(
+                    offset,
+                    length,
+                    eccodes.codes_get(handle, 'cfVarName'),
+                    eccodes.codes_get(handle, 'typeOfLevel'),
+                    eccodes.codes_get(handle, 'level'),
+                    (eccodes.codes_get(handle, 'Nj'), eccodes.codes_get(handle, 'Ni')),
+                    {
+                        'units': eccodes.codes_get(handle, 'units'),
+                        'long_name': eccodes.codes_get(handle, 'name'),
+                    }
+                ))
+                if len(fields) == 1:
+                    # Same coordinates as cfgrib
+                    latitudes = eccodes.codes_get_array(handle, 'distinctLatitudes')
+                    longitudes = eccodes.codes_get_array(handle, 'distinctLongitudes')
+                    date = str(eccodes.codes_get(handle, 'dataDate'))
+                    hhmm = int(eccodes.codes_get(handle, 'dataTime'))
+                    time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=hhmm // 100, minutes=hhmm % 100)
+                    step = timedelta(hours=int(eccodes.codes_get(handle, 'step')))
+            finally:
+                eccodes.codes_release(handle)
+
+    if any(field.shape != fields[0].shape for field in fields):
+        raise ValueError(f'The messages of {path} are on different grids')
+    shape = fields[0].shape
+
+    # Layout of the buffer: one (level, latitude, longitude) block per
+    # pressure level variable, with levels in decreasing pressure, then one
+    # (latitude, longitude) block per single level variable
+    levels = {}
+    singles = {}
+    for field in fields:
+        if field.level_type == LEVEL_TYPE:
+            levels.setdefault(field.name, {})[field.level] = field
+        elif field.name in singles:
+            raise ValueError(f'{field.name} appears several times in {path}')
+        else:
+            singles[field.name] = field
+    pressure_levels = sorted({field.level for by_level in levels.values() for field in by_level.values()}, reverse=True)
+    for name, by_level in levels.items():
+        if len(by_level) != len(pressure_levels):
+            raise ValueError(f'{name} is not on all the pressure levels of {path}')
+
+    field_size = shape[0] * shape[1] * 4
+    blocks = [[by_level[level] for level in pressure_levels] for by_level in levels.values()]
+    blocks += [[field] for field in singles.values()]
+    position = 0
+    for block in blocks:
+        for field in block:
+            field.position = position
+            position += field_size
+
+    with tempfile.TemporaryFile(dir=_buffer_dir(position)) as buffer:
+        buffer.truncate(position)
+        tasks = [
+            (path, field.offset, field.length, buffer.fileno(), field.position, scale.get(field.name, 1.0))
+            for field in fields
+        ]
+        with ThreadPoolExecutor(max_workers or os.cpu_count()) as pool:
+            for future in [pool.submit(_decode_into, *task) for task in tasks]:
+                future.result()
+        # The arrays are views of the buffer, which stays mapped after the
+        # file is closed
+        values = np.memmap(buffer, dtype=np.float32, mode='r+', shape=(position // 4,))
+    logger.info(f'Decoded {len(fields)} GRIB messages from {path}')
+
+    coords = {
+        'time': np.datetime64(time, 'ns'),
+        'step': np.timedelta64(step, 'ns'),
+        'valid_time': np.datetime64(time + step, 'ns'),
+        'latitude': latitudes,
+        'longitude': longitudes,
+    }
+    pressure = xr.Dataset(coords={**coords, LEVEL_TYPE: np.array(pressure_levels, dtype=np.float64)})
+    for name, by_level in levels.items():
+        start = by_level[pressure_levels[0]].position // 4
+        data = values[start:start + len(pressure_levels) * shape[0] * shape[1]]
+        pressure[name] = xr.Variable(
+            (LEVEL_TYPE, 'latitude', 'longitude'),
+            data.reshape(len(pressure_levels), *shape),
+            by_level[pressure_levels[0]].attrs
+        )
+    single = xr.Dataset(coords=coords)
+    for name, field in singles.items():
+        start = field.position // 4
+        single[name] = xr.Variable(
+            ('latitude', 'longitude'),
+            values[start:start + shape[0] * shape[1]].reshape(shape),
+            field.attrs
+        )
+    return pressure, single
+
+def _decode_into(path: str, offset: int, length: int, fd: int, position: int, factor: float):
+    '''
+    Decode the values of a message, multiplied by `factor`, and write them at
+    `position` in the buffer `fd`.
+    '''
+    import eccodes
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        handle = eccodes.codes_new_from_message(f.read(length))
+    try:
+        values = eccodes.codes_get_values(handle)
+        missing = eccodes.codes_get(handle, 'missingValue') if eccodes.codes_get(handle, 'bitmapPresent') else None
+        shape = (eccodes.codes_get(handle, 'Nj'), eccodes.codes_get(handle, 'Ni'))
+    finally:
+        eccodes.codes_release(handle)
+
+    values = values.astype(np.float32).reshape(shape)
+    if missing is not None:
+        values[values == np.float32(missing)] = np.nan
+    if factor != 1.0:
+        values *= np.float32(factor)
+    os.pwrite(fd, values.data, position)
+
+def _buffer_dir(size: int) -> str:
+    '''
+    Directory of the decoding buffer: shared memory if it has room for it (it
+    is often small, e.g. 64 MB in Docker containers), the temporary folder
+    otherwise.
+    '''
+    try:
+        if shutil.disk_usage('/dev/shm').free > 2 * size:
+            return '/dev/shm'
+    except OSError:
+        pass
+    return tempfile.gettempdir()
@@ -3,22 +3,33 @@ import xarray as xr
 from datetime import datetime, timezone
 import logging
 from . import shift_longitude
+from ..manifest import MANIFEST, Manifest, IFS, ERA5, IMERG
 from pathlib import Path
 import re
 import numpy as np
+import numcodecs
+import dask.array as da
+import uuid
 
 CTX_VARIABLES_PATH = Path(__file__).resolve().parent.parent / "ctx_variables.nc"
 
+# Chunks of the zarr file: the encoder (`ERA5Dataset`) reads a whole globe of
+# each variable and level at a time, so every chunk is one of them (about 4 MB
+# in float32 on the 0.25° grid). Any other dimension (e.g. `isobaricInhPa` in
+# the inputs) is split in chunks of 1 too.
+ZARR_CHUNKS = {'time': 1, 'level': 1, 'latitude': -1, 'longitude': -1}
+DEFAULT_COMPRESSOR = numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+
 def process_data(era5_data_dir: os.PathLike, 
                  ifs_data_dir: os.PathLike,
                  imerg_data_dir: os.PathLike,
                  toa_solar_radiation: xr.DataArray,
-                 target_dir: os.PathLike) -> Path:
-    """Imports the latest data files from relevant sources, and concatenates
-    them so that the latest ERA5 sea surface temperature is given along with the
-    rest. Makes everything into a zarr file ready to be sent for inference. The
-    output file may or may not contain units information for each variable, so 
-    it is best not to try to retrieve this information.
+                 target_dir: os.PathLike,
+                 manifest: Manifest = MANIFEST) -> Path:
+    """Imports the latest data files from relevant sources, and processes them
+    with `process_datasets`. This is used when the data was downloaded
+    beforehand with its files written (e.g. `python -m fetcher`), the pipeline
+    passing the downloaded datasets to `process_datasets` directly.
 
     Args:
         era5_data_dir (os.PathLike): Path to the directory containing raw ERA5
@@ -34,49 +45,100 @@ def process_data(era5_data_dir: os.PathLike,
             radiation values for the timestep corresponding to the latest IFS and
             IMERG data samples.
         target_dir (os.PathLike): Target output directory
+        manifest (Manifest, optional): Manifest of the variables, which must be
+            the one the data was downloaded with. Defaults to MANIFEST.
 
     Returns:
         Path: Path to the output `.zarr` file
     """
-    logger = logging.getLogger(__name__)
-    
     path_era5_p, path_era5_s = _get_latest_era5(era5_data_dir)
     path_ifs_p, path_ifs_s = _get_latest_ifs(ifs_data_dir)
     path_latest_imerg = _get_latest_imerg(imerg_data_dir)
     
-    # Retrieve the date and time of the IFS data
-    dt = latest_datetime(ifs_data_dir)
+    return process_datasets(
+        latest_datetime(ifs_data_dir),
+        _open(path_ifs_p),
+        _open(path_ifs_s),
+        # Only the ERA5 datasets from which variables were requested exist
+        [_open(path) for path in (path_era5_p, path_era5_s) if path is not None],
+        _open(path_latest_imerg),
+        toa_solar_radiation,
+        target_dir,
+        manifest
+    )
+
+def process_datasets(dt: datetime,
+                     ifs_pressure: xr.Dataset,
+                     ifs_single: xr.Dataset,
+                     era5: list[xr.Dataset],
+                     imerg: xr.Dataset,
+                     toa_solar_radiation: xr.DataArray,
+                     target_dir: os.PathLike,
+                     manifest: Manifest = MANIFEST,
+                     compressor: numcodecs.abc.Codec | None = DEFAULT_COMPRESSOR,
+                     ctx_variables_path: os.PathLike = CTX_VARIABLES_PATH) -> Path:
+    """Concatenates the data of the relevant sources, as returned by their
+    `fetch`, so that each variable of the model is taken from the source that
+    supplies it according to the manifest (e.g. the sea surface temperature
+    from ERA5). Makes everything into a zarr file ready to be sent for
+    inference. The output file may or may not contain units information for
+    each variable, so it is best not to try to retrieve this information.
+
+    The processing is a lazy dask graph, computed while the zarr file is
+    written, one `ZARR_CHUNKS` chunk (a whole globe of a variable at a level)
+    at a time, so that no full copy of the data is made. Datasets read from
+    files should thus be backed by dask (as opened by `process_data`), any
+    other one being loaded in memory.
+
+    Args:
+        dt (datetime): Date and time of the IFS data
+        ifs_pressure (xr.Dataset): IFS pressure level variables
+        ifs_single (xr.Dataset): IFS single level variables
+        era5 (list[xr.Dataset]): ERA5 pressure and/or single level datasets,
+            depending on the variables of the manifest
+        imerg (xr.Dataset): IMERG precipitation, on the 0.25° grid
+        toa_solar_radiation (xr.DataArray): Array containing the TOA solar
+            radiation values for the timestep corresponding to the latest IFS and
+            IMERG data samples.
+        target_dir (os.PathLike): Target output directory
+        manifest (Manifest, optional): Manifest of the variables, which must be
+            the one the data was downloaded with. Defaults to MANIFEST.
+        compressor (numcodecs.abc.Codec | None, optional): Compressor of the
+            zarr chunks, None for none. Defaults to DEFAULT_COMPRESSOR.
+        ctx_variables_path (os.PathLike, optional): File of the static context
+            variables. Defaults to CTX_VARIABLES_PATH.
+
+    Returns:
+        Path: Path to the output `.zarr` file
+    """
+    logger = logging.getLogger(__name__)
+    
     dt_str = dt.isoformat(timespec='seconds').replace('+00:00', 'Z')
     dt_np = np.datetime64(dt.replace(tzinfo=None), 'ns')
     
-    ds_ifs_p = shift_longitude.shift_longitude(
-        xr.open_dataset(path_ifs_p, engine='netcdf4'), '0-360')
-    ds_ifs_s = shift_longitude.shift_longitude(
-        xr.open_dataset(path_ifs_s, engine='netcdf4'), '0-360')
-    ds_era5_s = shift_longitude.shift_longitude(
-        xr.open_dataset(
-            path_era5_s,
-            engine='netcdf4'),
-        '0-360').squeeze("valid_time", drop=True)
+    ds_ifs_p = shift_longitude.shift_longitude(_lazy(ifs_pressure), '0-360')
+    ds_ifs_s = shift_longitude.shift_longitude(_lazy(ifs_single), '0-360')
+    ds_era5 = xr.merge([
+        shift_longitude.shift_longitude(_lazy(ds), '0-360').squeeze("valid_time", drop=True)
+        for ds in era5
+    ])
+    if 'pressure_level' in ds_era5.coords:
+        ds_era5 = ds_era5.rename({'pressure_level': 'isobaricInhPa'})
     ds_ctx = shift_longitude.shift_longitude(
-        xr.open_dataset(
-            CTX_VARIABLES_PATH,
-            engine='netcdf4'),
+        _open(ctx_variables_path),
         '0-360').squeeze("valid_time", drop=True)
-    ds_imerg = shift_longitude.shift_longitude(
-        xr.open_dataset(path_latest_imerg, engine='netcdf4'), '0-360')
+    ds_imerg = shift_longitude.shift_longitude(_lazy(imerg), '0-360')
 
-    logger.info('Loaded all required netCDF files for processing')
-    
     logger.info('Shifting longitudes to a common range')
     
-    logger.info('Merging ERA5 SST, IFS, TOA solar radiation, and context vars into a single dataset')
+    logger.info('Merging ERA5, IFS, TOA solar radiation, and context vars into a single dataset')
     ds = xr.merge([
         ds_ifs_s,
         ds_ifs_p,
         ds_ctx
     ])
-    ds['sea_surface_temperature'] = ds_era5_s['sst']
+    for entry in manifest.variables(ERA5):
+        ds[entry.variable] = ds_era5[entry.file_name]
     ds['toa_incident_solar_radiation'] = toa_solar_radiation
 
     logger.info('Adding TOA solar radiation to the dataset')
@@ -88,19 +150,7 @@ def process_data(era5_data_dir: os.PathLike,
         'isobaricInhPa': 'level',
         
         # Variables from IFS
-        'u10': '10m_u_component_of_wind',
-        'v10': '10m_v_component_of_wind',
-        't2m': '2m_temperature',
-        'msl': 'mean_sea_level_pressure',
-        'gh': 'geopotential',
-        'q': 'specific_humidity',
-        't': 'temperature',
-        'u': 'u_component_of_wind',
-        'v': 'v_component_of_wind',
-        'tp': 'total_precipitation',
-        # 'skt': 'sea_surface_temperature' TODO: Change if using skt
-        # Warning: sea_surface_temperature is incl. by era5.
-        # Must drop it prior to using the skt.
+        **manifest.renames(IFS),
         
         # Context variables from ERA5
         'anor': 'angle_of_sub_gridscale_orography',
@@ -115,8 +165,8 @@ def process_data(era5_data_dir: os.PathLike,
     
     logger.info('Adding total precipitation from IMERG')
     
-    precipitation = ds_imerg['precipitation'].squeeze("time", drop=True)
-    ds['total_precipitation'] = precipitation.astype('float32')
+    for entry in manifest.variables(IMERG):
+        ds[entry.variable] = ds_imerg[entry.file_name].squeeze("time", drop=True).astype('float32')
     
     # Change to float32 (from float64)
     ds = ds.assign_coords(
@@ -124,12 +174,10 @@ def process_data(era5_data_dir: os.PathLike,
         latitude=ds.latitude.astype('float32')
     )
     
-    # Assign the time variable to all variables
-    for var in ds.data_vars:
-        ds[var] = ds[var].expand_dims(time=[dt_np])
-        ds[var] = ds[var].transpose('time', ...) # puts time first
+    # Assign the time variable to all variables, first
+    ds = ds.expand_dims(time=[dt_np]).transpose('time', ...)
 
-    # Then drop unused coords
+    # Then drop unused coords (which depend on the downloaded variables)
     ds = ds.drop_vars([
         'step',
         'valid_time',
@@ -137,20 +185,58 @@ def process_data(era5_data_dir: os.PathLike,
         'surface',
         'number',
         'expver'
-    ])
+    ], errors='ignore')
         
     target_path = os.path.join(target_dir, f'{dt_str}.zarr')
     
     ds.attrs = {}
     
-    # Save to file
+    # One chunk per variable, time and level, with the encodings of the
+    # sources dropped
+    ds = ds.chunk({dim: ZARR_CHUNKS.get(dim, 1) for dim in ds.dims})
+    encoding = {}
+    for var in ds.data_vars:
+        ds[var].encoding = {}
+        encoding[var] = {'chunks': ds[var].data.chunksize, 'compressor': compressor}
+    
+    # Save to file, computing the graph chunk by chunk
     logger.info(f'Saving to {target_path}')
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
         
-    ds.to_zarr(target_path, mode='w', zarr_format=2, consolidated=True)
+    ds.to_zarr(target_path, mode='w', zarr_format=2, consolidated=True, encoding=encoding)
     return Path(target_path)
 
+def _open(path: os.PathLike) -> xr.Dataset:
+    """Opens a NetCDF file as dask arrays in chunks of a whole globe, each one
+    only read when the graph is computed.
+    """
+    ds = xr.open_dataset(path, engine='netcdf4')
+    return ds.chunk({dim: ZARR_CHUNKS.get(dim, 1) for dim in ds.dims})
+
+def _lazy(ds: xr.Dataset) -> xr.Dataset:
+    """Dask-backed view of a dataset, in chunks of a whole globe, without
+    copying the in-memory data. Variables already backed by dask (e.g. opened
+    with `_open`) are kept as they are.
+    """
+    chunks = {dim: ZARR_CHUNKS.get(dim, 1) for dim in ds.dims}
+    ds = ds.copy()
+    for name, var in ds.data_vars.items():
+        if var.chunks is None:
+            ds[name] = var.copy(data=_dask_view(var.to_numpy(), tuple(chunks[dim] for dim in var.dims)))
+    return ds
+
+def _dask_view(array: np.ndarray, chunks: tuple[int, ...]) -> da.Array:
+    """Dask array whose chunks are views of a NumPy array, sliced when
+    computed (`da.from_array` copies the whole array first). The name is
+    random, rather than a hash of the whole array.
+    """
+    def block(_, block_info=None):
+        return array[tuple(slice(*location) for location in block_info[0]['array-location'])]
+    # The zeros are broadcast, and never allocated
+    placeholder = da.zeros(array.shape, chunks=chunks, dtype=array.dtype)
+    return placeholder.map_blocks(block, dtype=array.dtype, name=f'view-{uuid.uuid4().hex}')
+
 def latest_datetime(ifs_data_folder : str) -> datetime:
     path_pressure = _get_latest_ifs(ifs_data_folder)[0]
     return datetime.strptime(
@@ -158,19 +244,20 @@ def latest_datetime(ifs_data_folder : str) -> datetime:
         "%Y-%m-%dT%H:%M:%SZ"
     ).replace(tzinfo=timezone.utc)
 
-def _get_latest_era5(data_folder: os.PathLike) -> tuple[str, str]:
+def _get_latest_era5(data_folder: os.PathLike) -> tuple[str | None, str | None]:
     '''
-    Gets the latest ifs data file that has been downloaded.
+    Gets the latest era5 data file that has been downloaded. Only the datasets
+    from which the manifest requires variables are downloaded.
 
     Returns:
-        (pressure_path, single_path) (str, str): A tuple of paths to a pressure and
-            single level file.
+        (pressure_path, single_path) (str | None, str | None): A tuple of paths
+            to a pressure and single level file, None if there is none.
     '''
     pressure_files = [f for f in os.listdir(data_folder) if f.endswith("pressure.nc")]
     single_files = [f for f in os.listdir(data_folder) if f.endswith("single.nc")]
     
-    pressure_file = os.path.join(data_folder, max(pressure_files))
-    single_file = os.path.join(data_folder, max(single_files))
+    pressure_file = os.path.join(data_folder, max(pressure_files)) if pressure_files else None
+    single_file = os.path.join(data_folder, max(single_files)) if single_files else None
     
     return pressure_file, single_file
 
@@ -0,0 +1,216 @@
+# First-order conservative regridding between regular latitude/longitude grids.
+# The value of a destination cell is the area-weighted mean of the source cells
+# it overlaps, so that area-weighted totals (e.g. of precipitation) are kept.
+#
+# On regular grids, cells are products of a latitude band and a longitude
+# band, so the overlap areas factor into a latitude part (in sin(latitude), for
+# the area on the sphere) and a longitude part (periodic). The weights are
+# built from the two 1D overlap matrices as one sparse (destination cells,
+# source cells) matrix, cached on disk by the signature of both grids, and
+# every field is then regridded with a single sparse matrix product.
+
+from os import PathLike
+from pathlib import Path
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+# Weights already used by this process, by cache key
+_WEIGHTS = {}
+
+def cell_edges(centers: np.ndarray, lower: float = None, upper: float = None) -> np.ndarray:
+    '''
+    Edges of the cells of a regular axis, half-way between the centers.
+
+    Parameters:
+        centers (np.ndarray): Centers of the cells, increasing or decreasing
+        lower (float): If given, lowest possible edge (e.g. -90 for latitudes)
+        upper (float): If given, highest possible edge (e.g. 90 for latitudes)
+    Returns:
+        np.ndarray: The len(centers) + 1 edges, in the order of the centers
+    '''
+    centers = np.asarray(centers, dtype=np.float64)
+    if len(centers) < 2:
+        raise ValueError('An axis needs at least 2 cells')
+    middles = (centers[1:] + centers[:-1]) / 2
+    edges = np.concatenate([
+        [centers[0] - (middles[0] - centers[0])],
+        middles,
+        [centers[-1] + (centers[-1] - middles[-1])],
+    ])
+    return np.clip(edges, lower if lower is not None else -np.inf, upper if upper is not None else np.inf)
+
+def overlap_matrix(source_edges: np.ndarray, destination_edges: np.ndarray,
+                   period: float = None) -> scipy.sparse.csr_matrix:
+    '''
+    Lengths of the overlaps between the cells of two 1D axes.
+
+    Parameters:
+        source_edges (np.ndarray): Edges of the source cells, monotonic
+        destination_edges (np.ndarray): Edges of the destination cells,
+            monotonic
+        period (float): If given, the axes are periodic (e.g. 360 for
+            longitudes), and cells overlap across the period
+    Returns:
+        scipy.sparse.csr_matrix: (destination cells, source cells) overlap
+            lengths
+    '''
+    source_edges = np.asarray(source_edges, dtype=np.float64)
+    destination_edges = np.asarray(destination_edges, dtype=np.float64)
+    n_source = len(source_edges) - 1
+    source_low = np.minimum(source_edges[:-1], source_edges[1:])
+    source_high = np.maximum(source_edges[:-1], source_edges[1:])
+    # Sorted source cells, to find the ones overlapping a destination cell by
+    # bisection
+    order = np.argsort(source_low)
+    source_low, source_high = source_low[order], source_high[order]
+    shifts = [0.0] if period is None else [-period, 0.0, period]
+
+    rows, cols, lengths = [], [], []
+    for i, (a, b) in enumerate(zip(destination_edges[:-1], destination_edges[1:])):
+        low, high = min(a, b), max(a, b)
+        for shift in shifts:
+            first = max(np.searchsorted(source_high + shift, low, side='right'), 0)
+            last = np.searchsorted(source_low + shift, high, side='left')
+            if last <= first:
+                continue
+            overlap = (np.minimum(source_high[first:last] + shift, high)
+                       - np.maximum(source_low[first:last] + shift, low))
+            keep = overlap > 0
+            rows.append(np.full(keep.sum(), i))
+            cols.append(order[first:last][keep])
+            lengths.append(overlap[keep])
+
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(lengths), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(destination_edges) - 1, n_source)
+    )
+
+def conservative_weights(source_latitudes: np.ndarray, source_longitudes: np.ndarray,
+                         latitudes: np.ndarray, longitudes: np.ndarray) -> scipy.sparse.csr_matrix:
+    '''
+    First-order conservative remapping weights between two regular grids.
+    Cells extend half-way to their neighbours, and the cells at the poles stop
+    at ±90° (e.g. the ±90° rows of the 0.25° grid are half cells). Longitudes
+    are periodic, in any range.
+
+    Parameters:
+        source_latitudes (np.ndarray): Latitudes of the source grid, in degrees
+        source_longitudes (np.ndarray): Longitudes of the source grid, in
+            degrees
+        latitudes (np.ndarray): Latitudes of the destination grid, in degrees
+        longitudes (np.ndarray): Longitudes of the destination grid, in degrees
+    Returns:
+        scipy.sparse.csr_matrix: (destination cells, source cells) weights,
+            for (latitude, longitude) fields flattened in C order. Every row
+            sums to 1 where the destination cell is covered by the source grid.
+    '''
+    lat_overlaps = overlap_matrix(
+        np.sin(np.radians(cell_edges(source_latitudes, -90, 90))),
+        np.sin(np.radians(cell_edges(latitudes, -90, 90)))
+    )
+    lon_overlaps = overlap_matrix(cell_edges(source_longitudes), cell_edges(longitudes), period=360)
+    # Normalised by the covered part of each destination band, so that the
+    # product of the two is normalised by the covered area of the cell
+    lat_weights = _normalize_rows(lat_overlaps)
+    lon_weights = _normalize_rows(lon_overlaps)
+    weights = scipy.sparse.kron(lat_weights, lon_weights, format='csr')
+    weights.data = weights.data.astype(np.float32)
+    return weights
+
+def cached_conservative_weights(source_latitudes: np.ndarray, source_longitudes: np.ndarray,
+                                latitudes: np.ndarray, longitudes: np.ndarray,
+                                cache_dir: PathLike = None) -> scipy.sparse.csr_matrix:
+    '''
+    Same as `conservative_weights`, cached in `cache_dir` by a hash of both
+    grids, and kept in memory for the next calls of the process.
+
+    Parameters:
+        cache_dir (PathLike): Cache directory. If not given, the weights are
+            only kept in memory.
+    '''
+    logger = logging.getLogger(__name__)
+    key = hashlib.sha1(b'conservative')
+    for array in (source_latitudes, source_longitudes, latitudes, longitudes):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        key.update(np.int64(len(array)).tobytes())
+        key.update(array.tobytes())
+    key = key.hexdigest()
+    if key in _WEIGHTS:
+        return _WEIGHTS[key]
+
+    cache_path = None if cache_dir is None else Path(cache_dir) / f'{key}.npz'
+    if cache_path is not None and cache_path.is_file():
+        logger.info(f'Loading the regridding weights from {cache_path}')
+        weights = scipy.sparse.load_npz(cache_path).tocsr()
+    else:
+        logger.info(f'Computing the regridding weights from {len(source_latitudes)}x{len(source_longitudes)} '
+                    f'to {len(latitudes)}x{len(longitudes)} cells')
+        weights = conservative_weights(source_latitudes, source_longitudes, latitudes, longitudes)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(f'{cache_path.stem}.{os.getpid()}.tmp.npz')
+            scipy.sparse.save_npz(tmp_path, weights, compressed=False)
+            os.replace(tmp_path, cache_path)
+    _WEIGHTS[key] = weights
+    return weights
+
+def regrid(ds: xr.Dataset, latitudes: np.ndarray, longitudes: np.ndarray,
+           cache_dir: PathLike = None) -> xr.Dataset:
+    '''
+    Regrid the variables of a dataset with `latitude` and `longitude`
+    dimensions conservatively (see `conservative_weights`). Other variables are
+    kept as they are. Missing (NaN) source values are left out of the means;
+    destination cells without any valid source value are NaN.
+
+    Parameters:
+        ds (xr.Dataset): Dataset on a regular grid, with `latitude` and
+            `longitude` coordinates in degrees
+        latitudes (np.ndarray): Latitudes of the destination grid, in degrees
+        longitudes (np.ndarray): Longitudes of the destination grid, in degrees
+        cache_dir (PathLike): Cache directory of the weights
+    Returns:
+        xr.Dataset: The dataset on the destination grid, in float32, with the
+            latitude and longitude as the last dimensions
+    '''
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    weights = cached_conservative_weights(
+        ds['latitude'].to_numpy(), ds['longitude'].to_numpy(), latitudes, longitudes, cache_dir
+    )
+    shape = (len(latitudes), len(longitudes))
+
+    regridded = ds.drop_dims(['latitude', 'longitude'])
+    for name, variable in ds.data_vars.items():
+        if 'latitude' not in variable.dims or 'longitude' not in variable.dims:
+            continue
+        variable = variable.transpose(..., 'latitude', 'longitude')
+        leading = variable.shape[:-2]
+        # (fields, source cells) -> (destination cells, fields)
+        values = variable.to_numpy().reshape(-1, weights.shape[1]).astype(np.float32).T
+        missing = np.isnan(values)
+        if missing.any():
+            coverage = weights @ (~missing).astype(np.float32)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = (weights @ np.where(missing, 0, values)) / coverage
+        else:
+            result = weights @ values
+        regridded[name] = xr.Variable(
+            variable.dims,
+            np.ascontiguousarray(result.T).reshape(*leading, *shape),
+            variable.attrs
+        )
+    return regridded.assign_coords(latitude=latitudes, longitude=longitudes)
+
+def _normalize_rows(matrix: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    '''
+    Divide the rows of a sparse matrix by their sums (empty rows stay empty).
+    '''
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(1.0, sums, out=np.zeros_like(sums), where=sums > 0)
+    return scipy.sparse.diags(scale) @ matrix
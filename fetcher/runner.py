@@ -0,0 +1,251 @@
+# Runs the downloads of several data sources concurrently. Every module of
+# `fetcher.data_sources` exposes the same async interface:
+#
+#   DEPENDS_ON (tuple[str, ...]): Names of the sources whose results are needed
+#       before fetching (e.g. IMERG needs the datetime of the IFS data)
+#   TIMEOUT (float | None): Seconds after which an attempt is abandoned
+#   RETRIES (int): Number of additional attempts after a failure
+#   async def fetch(target: Path, dependencies: dict[str, object],
+#                   write_files: bool = False, cache: RawCache = None,
+#                   analysis_time: datetime = None) -> dict:
+#       Download the data into the `target` folder, given the results of its
+#       dependencies, and return its `datetime` and decoded datasets. The
+#       datasets are also written as NetCDF files in `target` if
+#       `write_files` is set. With a `fetcher.cache.RawCache`, the data is
+#       looked up in the cache before being downloaded, and added to it. With
+#       an `analysis_time`, the data of that IFS run is fetched rather than
+#       the latest.
+#
+# Each source starts as soon as its dependencies are done, so the total time is
+# about that of the longest chain of dependent sources rather than the sum of
+# all sources.
+#
+# The blocking parts of the sources run in threads (`asyncio.to_thread`), which
+# can't be interrupted: an attempt that times out is abandoned, not stopped.
+# Its thread is a daemon one, which the end of the run doesn't wait for, and
+# every attempt writes into a folder of its own, next to the target folder,
+# whose files are only moved into the target folder if the attempt succeeds.
+
+from pathlib import Path
+from types import ModuleType
+
+import concurrent.futures
+import threading
+import asyncio
+import logging
+import shutil
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = None
+DEFAULT_RETRIES = 0
+# Seconds before the first retry, doubled for each following one
+RETRY_DELAY = 30
+
+class SourceError(Exception):
+    '''
+    Raised when at least one data source could not be fetched.
+    '''
+
+class _DaemonExecutor(concurrent.futures.ThreadPoolExecutor):
+    '''
+    Default executor of the runs (used by `asyncio.to_thread`): every call runs
+    in a new daemon thread, and shutting the executor down doesn't wait for
+    them, so that abandoned attempts don't delay the end of a run.
+    '''
+    def submit(self, fn, /, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        threading.Thread(target=run, name=f'fetch-{getattr(fn, "__name__", "call")}', daemon=True).start()
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        pass
+
+class SourceResult:
+    '''
+    Outcome of the fetch of a data source.
+
+    Parameters:
+        name (str): Name of the source
+        value (object): Value returned by the source's `fetch`, or None if it
+            failed
+        error (BaseException | None): Error of the last attempt, or None if it
+            succeeded
+        attempts (int): Number of attempts made (0 if a dependency failed)
+        started (float): Start of the first attempt, in seconds since the
+            start of the run
+        seconds (float): Time spent fetching, retries included
+    '''
+    def __init__(self, name: str, value: object = None, error: BaseException | None = None,
+                 attempts: int = 0, started: float = 0.0, seconds: float = 0.0):
+        self.name = name
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+        self.started = started
+        self.seconds = seconds
+
+async def run_sources(sources: dict[str, ModuleType],
+                      targets: dict[str, os.PathLike],
+                      timeouts: dict[str, float | None] = None,
+                      retries: dict[str, int] = None,
+                      retry_delay: float = RETRY_DELAY,
+                      options: dict = None) -> dict[str, SourceResult]:
+    '''
+    Fetch data sources concurrently, each one as soon as its dependencies are
+    done. Sources whose dependencies failed are not fetched. Each attempt
+    writes into its own folder (`<target>.attempt-<n>`), whose files are moved
+    into the target folder once it succeeds.
+
+    Parameters:
+        sources (dict[str, ModuleType]): Data source modules (or any object
+            with the same interface), by name
+        targets (dict[str, os.PathLike]): Output folder of each source
+        timeouts (dict[str, float | None]): Timeouts overriding the sources'
+            `TIMEOUT`, by name.
+        retries (dict[str, int]): Retries overriding the sources' `RETRIES`, by
+            name.
+        retry_delay (float): Seconds before the first retry of a source,
+            doubled for each following one.
+        options (dict): Keyword arguments passed to the `fetch` of every
+            source (e.g. `write_files`, `cache`)
+    Returns:
+        dict[str, SourceResult]: Outcome of each source, by name
+    '''
+    _check_dependencies(sources)
+    timeouts = timeouts or {}
+    retries = retries or {}
+    options = options or {}
+    start = time.perf_counter()
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def run(name: str) -> SourceResult:
+        source = sources[name]
+        dependencies = {}
+        for dependency in getattr(source, 'DEPENDS_ON', ()):
+            result = await tasks[dependency]
+            if result.error is not None:
+                return SourceResult(name, error=SourceError(f'dependency {dependency} failed'))
+            dependencies[dependency] = result.value
+
+        timeout = timeouts.get(name, getattr(source, 'TIMEOUT', DEFAULT_TIMEOUT))
+        max_attempts = 1 + retries.get(name, getattr(source, 'RETRIES', DEFAULT_RETRIES))
+        target = Path(targets[name])
+        started = time.perf_counter()
+        error = None
+        for attempt in range(1, max_attempts + 1):
+            if attempt > 1:
+                delay = retry_delay * 2 ** (attempt - 2)
+                logger.warning(f'{name}: attempt {attempt - 1} failed ({error!r}), retrying in {delay:.0f}s')
+                await asyncio.sleep(delay)
+            # A folder of its own: an abandoned attempt (after a timeout) may
+            # still be writing into its folder
+            attempt_dir = target.with_name(f'{target.name}.attempt-{attempt}')
+            shutil.rmtree(attempt_dir, ignore_errors=True)
+            attempt_dir.mkdir(parents=True)
+            logger.info(f'{name}: fetching (attempt {attempt}/{max_attempts})')
+            try:
+                value = await asyncio.wait_for(source.fetch(attempt_dir, dependencies, **options), timeout)
+            except asyncio.TimeoutError:
+                error = TimeoutError(f'no result after {timeout}s')
+            except Exception as e:
+                error = e
+            else:
+                target.mkdir(parents=True, exist_ok=True)
+                for file in attempt_dir.iterdir():
+                    os.replace(file, target / file.name)
+                attempt_dir.rmdir()
+                seconds = time.perf_counter() - started
+                logger.info(f'{name}: done in {seconds:.1f}s')
+                return SourceResult(name, value, None, attempt, started - start, seconds)
+            # The files of an abandoned attempt are removed too, which also
+            # makes its later writes fail
+            shutil.rmtree(attempt_dir, ignore_errors=True)
+        logger.error(f'{name}: failed after {max_attempts} attempts ({error!r})')
+        return SourceResult(name, None, error, max_attempts, started - start, time.perf_counter() - started)
+
+    for name in sources:
+        tasks[name] = asyncio.ensure_future(run(name))
+    await asyncio.gather(*tasks.values())
+    return {name: task.result() for name, task in tasks.items()}
+
+def fetch_all(sources: dict[str, ModuleType],
+              targets: dict[str, os.PathLike],
+              timeouts: dict[str, float | None] = None,
+              retries: dict[str, int] = None,
+              options: dict = None) -> dict[str, object]:
+    '''
+    Fetch data sources concurrently (see `run_sources`), log the timing of
+    each one, and return their results. Attempts abandoned after a timeout
+    are left running in the background rather than waited for.
+
+    Parameters:
+        sources (dict[str, ModuleType]): Data source modules, by name
+        targets (dict[str, os.PathLike]): Output folder of each source
+        timeouts (dict[str, float | None]): Timeouts overriding the sources'
+            `TIMEOUT`, by name.
+        retries (dict[str, int]): Retries overriding the sources' `RETRIES`, by
+            name.
+        options (dict): Keyword arguments passed to the `fetch` of every
+            source
+    Returns:
+        dict[str, object]: Value returned by each source, by name
+    Raises:
+        SourceError: If any source failed
+    '''
+    start = time.perf_counter()
+    with asyncio.Runner() as loop_runner:
+        loop_runner.get_loop().set_default_executor(_DaemonExecutor())
+        results = loop_runner.run(run_sources(sources, targets, timeouts, retries, options=options))
+    log_timings(results, time.perf_counter() - start)
+
+    failed = [r for r in results.values() if r.error is not None]
+    if failed:
+        raise SourceError('Failed to fetch ' + ', '.join(f'{r.name} ({r.error!r})' for r in failed))
+    return {name: r.value for name, r in results.items()}
+
+def log_timings(results: dict[str, SourceResult], total: float):
+    '''
+    Log the start time, duration and outcome of each source.
+    '''
+    lines = [f'Fetched {len(results)} sources in {total:.1f}s:']
+    for r in sorted(results.values(), key=lambda r: r.started):
+        status = 'ok' if r.error is None else 'failed'
+        lines.append(f'  {r.name:<12} {status:<6} start {r.started:7.1f}s  '
+                     f'duration {r.seconds:7.1f}s  attempts {r.attempts}')
+    logger.info('\n'.join(lines))
+
+def _check_dependencies(sources: dict[str, ModuleType]):
+    '''
+    Raise a ValueError if a dependency is unknown or dependencies are circular.
+    '''
+    visiting, done = set(), set()
+
+    def visit(name: str):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f'Circular dependency involving {name}')
+        visiting.add(name)
+        for dependency in getattr(sources[name], 'DEPENDS_ON', ()):
+            if dependency not in sources:
+                raise ValueError(f'{name} depends on unknown source {dependency}')
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+
+    for name in sources:
+        visit(name)
@@ -0,0 +1,292 @@
+# Runs the pipeline as soon as the data of a new analysis time is published,
+# rather than at fixed times. The availability of the data sources is polled
+# with cheap requests:
+#
+#   ifs: existence of the `.index` file of the latest runs
+#   era5: temporal extent of the CDS catalogue (informative: the sea surface
+#       temperature of the latest day is used, whichever it is)
+#   imerg: existence of the granule of the half hour before the IFS run
+#
+# The analysis time of a forecast is the time of the latest IFS run: a job is
+# queued once a new run and its IMERG precipitation are both published. Jobs
+# are deduplicated by analysis time (only the latest pending one is run, with
+# the data of its analysis time), the analysis times already done
+# are kept in a state file across restarts, and jobs are run under a lock
+# file, so that several schedulers sharing a state file don't run the pipeline
+# at the same time. The state file is read again and merged under the lock,
+# so that an analysis time done by another scheduler isn't run again.
+#
+# Conditional requests (`If-None-Match` / `If-Modified-Since`) are used for
+# the documents that are polled repeatedly, and a URL found to exist isn't
+# requested again.
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import requests
+import logging
+import fcntl
+import json
+import time
+import os
+
+from . import download
+from .data_sources import ifs, era5, imerg_early
+
+# Seconds between two polls
+POLL_INTERVAL = 120
+# Attempts of a job before its analysis time is given up
+MAX_ATTEMPTS = 3
+# Seconds before a failed job is attempted again
+RETRY_DELAY = 600
+# Analysis times kept in the state file
+MAX_DONE = 100
+
+logger = logging.getLogger(__name__)
+
+class AvailabilityPoller:
+    '''
+    Cheap requests about the availability of the data sources, with the
+    results of previous requests reused when they can't have changed.
+
+    Raises:
+        RuntimeError: If the Earthdata credentials (for IMERG) are missing
+    '''
+    def __init__(self):
+        self.imerg_auth = imerg_early.credentials()
+        # url -> (validators, parsed document)
+        self._documents: dict[str, tuple[dict, dict]] = {}
+        self._existing: set[str] = set()
+        self.requests = 0
+        self.not_modified = 0
+
+    def get_json(self, url: str) -> dict:
+        '''
+        JSON document of a URL, requested conditionally if it was already
+        received.
+        '''
+        headers = {}
+        validators, document = self._documents.get(url, ({}, None))
+        if 'ETag' in validators:
+            headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators:
+            headers['If-Modified-Since'] = validators['Last-Modified']
+        r = download.session(url).get(url, headers=headers, timeout=download.HTTP_TIMEOUT)
+        self.requests += 1
+        if r.status_code == 304 and document is not None:
+            self.not_modified += 1
+            return document
+        r.raise_for_status()
+        document = r.json()
+        validators = {k: r.headers[k] for k in ('ETag', 'Last-Modified') if k in r.headers}
+        self._documents[url] = (validators, document)
+        return document
+
+    def exists(self, url: str, auth: tuple[str, str] = None) -> bool:
+        '''
+        Whether a URL exists (status 200, after redirects), without reading its
+        body. Published files don't disappear, so a URL that exists isn't
+        requested again.
+        '''
+        if url in self._existing:
+            return True
+        with download.session(url).get(url, auth=auth, stream=True, timeout=download.HTTP_TIMEOUT) as r:
+            self.requests += 1
+            if r.status_code == 200:
+                self._existing.add(url)
+                return True
+            if r.status_code not in (403, 404):
+                r.raise_for_status()
+            return False
+
+    def ifs_time(self) -> datetime:
+        '''
+        Time of the latest published IFS run.
+        '''
+        return ifs.latest_run(ifs.BASE_URL, self.exists)[0]
+
+    def era5_time(self) -> datetime:
+        '''
+        Latest time of the ERA5 data.
+        '''
+        return era5.latest_datetime(self.get_json)
+
+    def imerg_available(self, dt: datetime) -> bool:
+        '''
+        Whether the IMERG precipitation used with the analysis time `dt` is
+        published.
+        '''
+        return imerg_early.granule_available(dt, self.exists, self.imerg_auth)
+
+class Job:
+    '''
+    A run of the pipeline for an analysis time.
+
+    Parameters:
+        analysis_time (datetime): Time of the IFS run
+        era5_time (datetime | None): Latest time of the ERA5 data when the job
+            was queued
+    '''
+    def __init__(self, analysis_time: datetime, era5_time: datetime | None = None):
+        self.analysis_time = analysis_time
+        self.era5_time = era5_time
+        self.queued = time.time()
+        self.attempts = 0
+        # Time before which the job isn't attempted (after a failure)
+        self.not_before = 0.0
+
+class Scheduler:
+    '''
+    Polls the data sources and runs the pipeline for each new analysis time.
+
+    Parameters:
+        run (Callable[[datetime], bool]): Runs the pipeline, given the analysis
+            time that triggered it, and returns whether it succeeded
+        state_path (os.PathLike): JSON file of the analysis times already done.
+            The lock file is next to it, with a `.lock` suffix.
+        poller (AvailabilityPoller): Availability requests. Defaults to a new
+            one, which checks the credentials of the sources.
+        poll_interval (float): Seconds between two polls
+        max_attempts (int): Attempts of a job before its analysis time is
+            given up
+        retry_delay (float): Seconds before a failed job is attempted again
+    '''
+    def __init__(self,
+                 run: Callable[[datetime], bool],
+                 state_path: os.PathLike,
+                 poller: AvailabilityPoller = None,
+                 poll_interval: float = POLL_INTERVAL,
+                 max_attempts: int = MAX_ATTEMPTS,
+                 retry_delay: float = RETRY_DELAY):
+        self.run = run
+        self.state_path = Path(state_path)
+        self.lock_path = self.state_path.with_name(self.state_path.name + '.lock')
+        self.poller = poller or AvailabilityPoller()
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pending: dict[datetime, Job] = {}
+        self.done: list[datetime] = self._load_done()
+        # Analysis time whose IMERG data is awaited, logged once
+        self._waiting_for = None
+
+    def poll(self) -> Job | None:
+        '''
+        Check the availability of the data, and queue a job if a new analysis
+        time is fully available.
+
+        Returns:
+            Job | None: The queued job, if any
+        '''
+        analysis_time = self.poller.ifs_time()
+        if analysis_time in self.done or analysis_time in self.pending:
+            return None
+        if self.done and analysis_time < max(self.done):
+            return None
+        if not self.poller.imerg_available(analysis_time):
+            if analysis_time != self._waiting_for:
+                logger.info(f'IFS run {analysis_time:%Y-%m-%dT%HZ} published, waiting for its IMERG precipitation')
+                self._waiting_for = analysis_time
+            return None
+        try:
+            era5_time = self.poller.era5_time()
+        except (requests.RequestException, KeyError, ValueError) as e:
+            # Not needed to start: the pipeline uses the latest ERA5 data
+            logger.warning(f'Could not get the latest ERA5 time ({e!r})')
+            era5_time = None
+        job = Job(analysis_time, era5_time)
+        self.pending[analysis_time] = job
+        logger.info(f'Queued the pipeline for {analysis_time:%Y-%m-%dT%HZ} (ERA5 data up to {era5_time})')
+        return job
+
+    def run_pending(self) -> bool:
+        '''
+        Run the latest pending job, dropping the older ones, unless it is
+        waiting before a retry, another process holds the lock, or another
+        process already did it.
+
+        Returns:
+            bool: Whether a job was run
+        '''
+        if not self.pending:
+            return False
+        latest = max(self.pending)
+        for analysis_time in [t for t in self.pending if t < latest]:
+            logger.info(f'Skipping {analysis_time:%Y-%m-%dT%HZ}, superseded by {latest:%Y-%m-%dT%HZ}')
+            del self.pending[analysis_time]
+        job = self.pending[latest]
+        if time.time() < job.not_before:
+            return False
+
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info('The pipeline is already running in another process, waiting')
+                return False
+            # Done by another scheduler sharing the state file in the meantime
+            self.done = sorted({*self.done, *self._load_done()})[-MAX_DONE:]
+            if latest in self.done:
+                logger.info(f'{latest:%Y-%m-%dT%HZ} was already done by another process')
+                del self.pending[latest]
+                return False
+
+            job.attempts += 1
+            delay = time.time() - job.queued
+            logger.info(f'Running the pipeline for {latest:%Y-%m-%dT%HZ} (attempt {job.attempts}, '
+                        f'queued {delay:.0f}s ago)')
+            start = time.perf_counter()
+            try:
+                success = self.run(latest)
+            except Exception:
+                logger.exception('The pipeline raised an exception')
+                success = False
+            duration = time.perf_counter() - start
+
+            # Still under the lock, so that the state file is updated by one
+            # process at a time
+            if success:
+                logger.info(f'Pipeline for {latest:%Y-%m-%dT%HZ} done in {duration:.0f}s')
+                self._mark_done(latest)
+            elif job.attempts >= self.max_attempts:
+                logger.error(f'Giving up {latest:%Y-%m-%dT%HZ} after {job.attempts} attempts')
+                self._mark_done(latest)
+            else:
+                job.not_before = time.time() + self.retry_delay
+                logger.warning(f'Pipeline for {latest:%Y-%m-%dT%HZ} failed, retrying in {self.retry_delay:.0f}s')
+        return True
+
+    def run_forever(self):
+        '''
+        Poll and run jobs until interrupted.
+        '''
+        logger.info(f'Polling the data sources every {self.poll_interval:.0f}s')
+        while True:
+            try:
+                self.poll()
+            except (requests.RequestException, IOError) as e:
+                logger.warning(f'Polling failed ({e!r})')
+            if not self.run_pending():
+                time.sleep(self.poll_interval)
+
+    def _load_done(self) -> list[datetime]:
+        try:
+            with open(self.state_path) as f:
+                return [datetime.fromisoformat(t) for t in json.load(f)['done']]
+        except FileNotFoundError:
+            return []
+
+    def _mark_done(self, analysis_time: datetime):
+        # Merged with the analysis times done by the other processes
+        del self.pending[analysis_time]
+        self.done = sorted({*self.done, *self._load_done(), analysis_time})[-MAX_DONE:]
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(f'{self.state_path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'done': [t.isoformat() for t in self.done],
+                'updated': datetime.now(timezone.utc).isoformat(),
+            }, f, indent=2)
+        os.replace(tmp_path, self.state_path)
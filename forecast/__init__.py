@@ -6,6 +6,7 @@ from forecast import forecast_ar
 from forecast import constants
 from forecast import latents
 from forecast import decode_trajectory
+from forecast import stations
 from forecast import custom_datasets
 
 from forecast.latents import compute_and_save_latents
@@ -0,0 +1,267 @@
+# This file extracts point forecasts at a set of stations from a decoded
+# forecast .zarr file (as written by `decode_trajectory.decode_to_zarr`), and
+# writes them to a Parquet file with one row per station and lead time.
+#
+# The bilinear interpolation indices and weights of the stations are computed
+# once per station set and grid, and cached on disk. The forecast is then read
+# one zarr time chunk at a time, and all stations are interpolated at once with
+# vectorized indexing, so the extraction runs at the speed of reading the zarr
+# file regardless of the number of stations.
+
+from os import PathLike
+from typing import Iterator, Sequence
+from pathlib import Path
+
+import hashlib
+import logging
+import os
+import xarray as xr
+import numpy as np
+import pandas as pd
+
+def read_stations(
+    path_stations: PathLike,
+    id_column: str = 'station_id',
+    lat_column: str = 'latitude',
+    lon_column: str = 'longitude'
+) -> pd.DataFrame :
+    """Read a station table from a .csv or .parquet file.
+
+    Args:
+        path_stations (PathLike): Path to the station table
+        id_column (str, optional): Column of the station identifiers. Defaults
+            to 'station_id'.
+        lat_column (str, optional): Column of the latitudes, in degrees.
+            Defaults to 'latitude'.
+        lon_column (str, optional): Column of the longitudes, in degrees (any
+            range). Defaults to 'longitude'.
+
+    Returns:
+        pd.DataFrame: Table with the `station_id`, `latitude` and `longitude`
+            columns
+    """
+    path_stations = Path(path_stations)
+    if path_stations.suffix == '.parquet':
+        table = pd.read_parquet(path_stations)
+    else:
+        table = pd.read_csv(path_stations)
+    table = table[[id_column, lat_column, lon_column]].rename(columns={
+        id_column: 'station_id',
+        lat_column: 'latitude',
+        lon_column: 'longitude',
+    })
+    if not np.all(np.abs(table['latitude']) <= 90) or not np.all(np.isfinite(table['longitude'])):
+        raise ValueError(f'Invalid station coordinates in {path_stations}')
+    return table
+
+def bilinear_indices(
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    grid_latitudes: np.ndarray,
+    grid_longitudes: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray] :
+    """Compute the grid indices and weights of the bilinear interpolation at
+    points, on a regular grid covering all longitudes (such as the 0.25° grid
+    of the forecast).
+
+    Args:
+        latitudes (np.ndarray): Latitudes of the points, in degrees
+        longitudes (np.ndarray): Longitudes of the points, in degrees (any
+            range)
+        grid_latitudes (np.ndarray): Latitudes of the grid, in degrees
+        grid_longitudes (np.ndarray): Longitudes of the grid, in degrees
+
+    Returns:
+        (rows, cols, weights) (tuple[np.ndarray, np.ndarray, np.ndarray]):
+            Arrays of shape (points, 4) with the latitude and longitude
+            indices of the 4 neighbours of each point, and their weights
+    """
+    n_lat, n_lon = len(grid_latitudes), len(grid_longitudes)
+    lat_step = grid_latitudes[1] - grid_latitudes[0]
+    lon_step = grid_longitudes[1] - grid_longitudes[0]
+    frac_rows = np.clip((latitudes - grid_latitudes[0]) / lat_step, 0, n_lat - 1)
+    frac_cols = ((longitudes - grid_longitudes[0]) % 360) / lon_step
+
+    row0 = np.minimum(np.floor(frac_rows).astype(np.int64), n_lat - 2)
+    col0 = np.floor(frac_cols).astype(np.int64)
+    wr = frac_rows - row0
+    wc = frac_cols - col0
+    col0 %= n_lon
+    col1 = (col0 + 1) % n_lon
+    rows = np.stack([row0, row0, row0 + 1, row0 + 1], axis=-1)
+    cols = np.stack([col0, col1, col0, col1], axis=-1)
+    weights = np.stack([(1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc], axis=-1)
+    return rows, cols, weights
+
+def cached_bilinear_indices(
+    stations: pd.DataFrame,
+    grid_latitudes: np.ndarray,
+    grid_longitudes: np.ndarray,
+    cache_dir: PathLike = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray] :
+    """Same as `bilinear_indices` for a station table, cached in `cache_dir`
+    by a hash of the station set and the grid.
+
+    Args:
+        stations (pd.DataFrame): Station table, as returned by `read_stations`
+        grid_latitudes (np.ndarray): Latitudes of the grid, in degrees
+        grid_longitudes (np.ndarray): Longitudes of the grid, in degrees
+        cache_dir (PathLike, optional): Cache directory. If not given, the
+            indices are always computed. Defaults to None.
+
+    Returns:
+        (rows, cols, weights) (tuple[np.ndarray, np.ndarray, np.ndarray]):
+            See `bilinear_indices`
+    """
+    logger = logging.getLogger(__name__)
+    latitudes = stations['latitude'].to_numpy(dtype=np.float64)
+    longitudes = stations['longitude'].to_numpy(dtype=np.float64)
+
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        key.update('\0'.join(stations['station_id'].astype(str)).encode('utf-8'))
+        for array in (latitudes, longitudes, grid_latitudes, grid_longitudes):
+            key.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        cache_path = Path(cache_dir) / f'{key.hexdigest()}.npz'
+        if cache_path.is_file():
+            logger.info(f'Loading the station interpolation weights from {cache_path}')
+            with np.load(cache_path) as data:
+                return data['rows'], data['cols'], data['weights']
+
+    rows, cols, weights = bilinear_indices(latitudes, longitudes, grid_latitudes, grid_longitudes)
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f'{cache_path.stem}.{os.getpid()}.tmp.npz')
+        np.savez(tmp_path, rows=rows, cols=cols, weights=weights)
+        os.replace(tmp_path, cache_path)
+    return rows, cols, weights
+
+def iter_station_batches(
+    ds: xr.Dataset,
+    stations: pd.DataFrame,
+    variables: Sequence[str] = None,
+    cache_dir: PathLike = None
+) -> Iterator[pd.DataFrame] :
+    """Interpolate a forecast at stations, one zarr time chunk at a time.
+
+    Args:
+        ds (xr.Dataset): Forecast dataset, opened without dask
+            (`xr.open_zarr(path, chunks=None)`) so that reads aren't split
+        stations (pd.DataFrame): Station table, as returned by `read_stations`
+        variables (Sequence[str], optional): Variables to extract. If not
+            given, all variables are extracted. Defaults to None.
+        cache_dir (PathLike, optional): Cache directory of the interpolation
+            weights. Defaults to None.
+
+    Yields:
+        pd.DataFrame: Rows of the stations for consecutive lead times, with
+            the `station_id`, `latitude`, `longitude` and `time` columns, then
+            a column per single level variable and per pressure level variable
+            and level (e.g. `temperature_850`)
+    """
+    variables = list(ds.data_vars) if variables is None else list(variables)
+    rows, cols, weights = cached_bilinear_indices(
+        stations,
+        ds['latitude'].to_numpy(),
+        ds['longitude'].to_numpy(),
+        cache_dir
+    )
+    # Only the band of latitudes containing stations is read
+    first_row, last_row = int(rows.min()), int(rows.max())
+    local_rows = rows - first_row
+    times = ds['time'].to_numpy()
+    levels = ds['level'].to_numpy().astype(int) if 'level' in ds.coords else []
+    n_stations = len(stations)
+
+    # All variables are read with the same time steps, so that batches are
+    # complete rows
+    time_chunk = min(
+        ds[v].encoding.get('preferred_chunks', {}).get('time', len(times)) for v in variables
+    )
+    for start in range(0, len(times), time_chunk):
+        batch_times = times[start:start + time_chunk]
+        columns = {
+            'station_id': np.tile(stations['station_id'].to_numpy(), len(batch_times)),
+            'latitude': np.tile(stations['latitude'].to_numpy(), len(batch_times)),
+            'longitude': np.tile(stations['longitude'].to_numpy(), len(batch_times)),
+            'time': np.repeat(batch_times, n_stations),
+        }
+        for variable in variables:
+            data = ds[variable].transpose('time', ..., 'latitude', 'longitude').isel(
+                time=slice(start, start + time_chunk),
+                latitude=slice(first_row, last_row + 1)
+            ).to_numpy()
+            # (time, [level], stations, 4) -> (time, [level], stations)
+            values = (data[..., local_rows, cols] * weights).sum(axis=-1).astype(np.float32)
+            if values.ndim == 2:
+                columns[variable] = values.reshape(-1)
+            else:
+                for i, level in enumerate(levels):
+                    columns[f'{variable}_{level}'] = values[:, i].reshape(-1)
+        yield pd.DataFrame(columns)
+
+def stations_to_parquet(
+    path_zarr: PathLike,
+    stations: pd.DataFrame,
+    path_destination: PathLike,
+    variables: Sequence[str] = None,
+    cache_dir: PathLike = None
+) -> None :
+    """Extract the point forecasts of stations from a decoded forecast .zarr
+    file into a Parquet file, with one row per station and lead time. The file
+    is written one row group per zarr time chunk, so that memory use doesn't
+    grow with the number of lead times.
+
+    Args:
+        path_zarr (PathLike): Path to the decoded forecast .zarr file
+        stations (pd.DataFrame): Station table, as returned by `read_stations`
+        path_destination (PathLike): Path to the destination .parquet file
+        variables (Sequence[str], optional): Variables to extract. If not
+            given, all variables are extracted. Defaults to None.
+        cache_dir (PathLike, optional): Cache directory of the interpolation
+            weights. Defaults to None.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    logger = logging.getLogger(__name__)
+    ds = xr.open_zarr(str(path_zarr), chunks=None)
+    logger.info(f'Extracting the forecast of {len(stations)} stations from {path_zarr}')
+
+    writer = None
+    try:
+        for batch in iter_station_batches(ds, stations, variables, cache_dir):
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(str(path_destination), table.schema, compression='zstd')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    logger.info(f'Station forecasts saved into {path_destination}')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Extract the point forecasts of stations from a decoded forecast into a Parquet file.'
+    )
+    parser.add_argument('zarr', help='Decoded forecast .zarr file')
+    parser.add_argument('stations', help='Station table (.csv or .parquet)')
+    parser.add_argument('output', help='Destination .parquet file')
+    parser.add_argument('--vars', default=None, help='Comma-separated variables to extract [default: all]')
+    parser.add_argument('--cache-dir', default=None, help='Cache directory of the interpolation weights')
+    parser.add_argument('--id-column', default='station_id', help='Column of the station identifiers')
+    parser.add_argument('--lat-column', default='latitude', help='Column of the station latitudes')
+    parser.add_argument('--lon-column', default='longitude', help='Column of the station longitudes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    stations_to_parquet(
+        args.zarr,
+        read_stations(args.stations, args.id_column, args.lat_column, args.lon_column),
+        args.output,
+        None if args.vars is None else args.vars.split(','),
+        args.cache_dir
+    )
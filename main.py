@@ -10,6 +10,7 @@ import json
 import os
 import io
 
+from datetime import datetime
 from pathlib import Path
 
 from appa.nn.autoencoder import AutoEncoder
@@ -19,6 +20,9 @@ from appa.save import safe_load
 
 from fetcher import processing
 from fetcher import data_sources
+from fetcher import runner
+from fetcher import scheduler
+from fetcher.cache import RawCache
 from fetcher.custom_data.solar_radiation import xarray_integrated_toa_solar_radiation
 
 import forecast
@@ -37,7 +41,31 @@ def main():
         datefmt='%Y-%m-%d %H:%M:%S',
         force=True
     )
-    
+
+    if args.watch:
+        # Long-running mode: the pipeline runs in this process as soon as the
+        # data of a new analysis time is published
+        scheduler.Scheduler(
+            lambda analysis_time: run_pipeline(args, analysis_time),
+            args.state_file,
+            poll_interval=args.poll_interval
+        ).run_forever()
+    else:
+        run_pipeline(args)
+
+def run_pipeline(args: argparse.Namespace, analysis_time: datetime = None) -> bool:
+    """Run the full pipeline once: fetch the latest data, forecast, and upload
+    the tiles and metadata.
+
+    Args:
+        args (argparse.Namespace): Launch arguments (see `parse_args`)
+        analysis_time (datetime, optional): Time of the IFS run to forecast
+            from, e.g. the one found by the scheduler. Defaults to None, for
+            the latest run.
+
+    Returns:
+        bool: Whether the pipeline succeeded
+    """
     with tempfile.TemporaryDirectory(dir=args.temp_dir) as temp_dir:
         try:
             #Make paths
@@ -49,7 +77,10 @@ def main():
             Path(tiles_output_dir).mkdir(parents=True, exist_ok=True)
             
             logger.info('Fetching weather data')
-            fetch_data(weather_data_dir)
+            raw_cache = None
+            if args.raw_cache_dir is not None:
+                raw_cache = RawCache(args.raw_cache_dir, int(args.raw_cache_size * 1024 ** 3))
+            fetch_data(weather_data_dir, args.raw_data_dir, raw_cache, analysis_time)
             
             logger.info('Starting the forecasting step')
             forecast_zarr_path = run_forecast(args.config_path,
@@ -83,6 +114,18 @@ def main():
             
             logger.info('Uploading tiles')
             upload_data(tiles_output_dir, f'tiles/{forecast_zarr_path.stem}')
+
+            if args.stations is not None:
+                logger.info('Extracting station forecasts')
+                stations_output_dir = os.path.join(temp_dir, 'stations')
+                Path(stations_output_dir).mkdir(parents=True, exist_ok=True)
+                forecast.stations.stations_to_parquet(
+                    forecast_zarr_path,
+                    forecast.stations.read_stations(args.stations),
+                    os.path.join(stations_output_dir, f'{forecast_zarr_path.stem}.parquet'),
+                    cache_dir=args.stations_cache_dir
+                )
+                upload_data(stations_output_dir, 'stations')
             
             metadata = {}
             metadata['latest'] = forecast_zarr_path.stem
@@ -101,12 +144,22 @@ def main():
             metadata['zoom_min'] = tiler.constants.ZOOM_MIN
             metadata['zoom_max'] = tiler.constants.ZOOM_MAX
             writefile('metadata.json', json.dumps(metadata, indent=2))
+
+            # Small pointer to the latest run, written last so that clients
+            # notified of its change (server `/events`) find the whole run
+            # published.
+            writefile('latest.json', json.dumps({
+                'latest': metadata['latest'],
+                'variables': list(metadata['variables'])
+            }))
+            return True
                     
         except Exception:
             # This makes sure the temp dir is deleted in the end, even if there
             # is an exception. This is important since this is the root temp from
             # which other temp dirs are created.
             logger.exception('Fatal exception')
+            return False
     
 def parse_args() -> argparse.Namespace:
     """Parse command line arguments into a argparse.Namespace object. Individual
@@ -131,17 +184,72 @@ def parse_args() -> argparse.Namespace:
                               'will be used. This directory must exist before '
                               'running this code. Files generated inside '
                               'this directory will be deleted when finished.'))
+    parser.add_argument('--stations',
+                        default=None,
+                        help=('Station table (.csv or .parquet, with station_id, '
+                              'latitude and longitude columns). If given, the '
+                              'point forecasts of the stations are uploaded as '
+                              'stations/{run}.parquet.'))
+    parser.add_argument('--stations-cache-dir',
+                        default=None,
+                        help=('Directory in which the interpolation weights of '
+                              'the stations are cached between runs.'))
+    parser.add_argument('--raw-data-dir',
+                        default=None,
+                        help=('If given, the downloaded data of each source is '
+                              'also written as NetCDF files into subfolders of '
+                              'this directory, and kept (for debugging). By '
+                              'default, it is passed to the processing in '
+                              'memory.'))
+    parser.add_argument('--raw-cache-dir',
+                        default=None,
+                        help=('Directory in which the downloaded data is cached '
+                              'between runs, so that data which hasn\'t changed '
+                              'since the previous run isn\'t downloaded again.'))
+    parser.add_argument('--raw-cache-size',
+                        type=float,
+                        default=20,
+                        help=('Maximum size of the cache of downloaded data, in '
+                              'GB. The least recently used data is removed '
+                              'beyond it.'))
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help=('Keep running, and run the pipeline as soon as the '
+                              'data of a new analysis time is published, instead '
+                              'of once.'))
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=scheduler.POLL_INTERVAL,
+                        help=('With --watch, seconds between two checks of the '
+                              'availability of the data.'))
+    parser.add_argument('--state-file',
+                        default='scheduler-state.json',
+                        help=('With --watch, file in which the analysis times '
+                              'already processed are kept across restarts. A '
+                              'lock file is created next to it.'))
     return parser.parse_args()
 
-def fetch_data(target_dir: os.PathLike):
+def fetch_data(target_dir: os.PathLike,
+               raw_data_dir: os.PathLike = None,
+               raw_cache: RawCache = None,
+               analysis_time: datetime = None):
     """Fetch the latest weather data from all relevant sources into a single
     zarr file.
 
     Args:
         target_dir (os.PathLike): Target directory for the processed/data.zarr
+        raw_data_dir (os.PathLike, optional): If given, the downloaded data is
+            also written as NetCDF files into this directory, and kept.
+            Defaults to None.
+        raw_cache (RawCache, optional): Cache of the downloaded data, looked
+            up by every source before downloading. Defaults to None.
+        analysis_time (datetime, optional): Time of the IFS run to fetch
+            instead of the latest one. Defaults to None.
     """
     
     with tempfile.TemporaryDirectory(dir=target_dir) as target_raw_dir:
+        if raw_data_dir is not None:
+            target_raw_dir = raw_data_dir
         target_tmp_dirs = {
             'ifs': Path(target_raw_dir) / 'ifs',
             'era5': Path(target_raw_dir) / 'era5',
@@ -151,23 +259,36 @@ def fetch_data(target_dir: os.PathLike):
         for path in target_tmp_dirs.values():
             path.mkdir(parents=True, exist_ok=True)
         
-        logger.info('Downloading the latest IFS data')
-        ifs_datetime = data_sources.ifs.download_latest(target_tmp_dirs['ifs'])
-        
-        logger.info('Downloading the latest ERA5 data (for SST)')
-        era5_datetime = data_sources.era5.download_latest(target_tmp_dirs['era5'])
-        
-        logger.info(f'Downloading IMERG data for datetime {ifs_datetime}')
-        data_sources.imerg_early.get_total_precipitation(ifs_datetime, target_tmp_dirs['imerg'])
+        # IFS, ERA5 (for SST) and IMERG (at the IFS datetime) are fetched
+        # concurrently, IMERG starting as soon as IFS is done
+        logger.info('Downloading the latest IFS, ERA5 and IMERG data')
+        results = runner.fetch_all(
+            {
+                'ifs': data_sources.ifs,
+                'era5': data_sources.era5,
+                'imerg': data_sources.imerg_early,
+            },
+            target_tmp_dirs,
+            options={
+                'write_files': raw_data_dir is not None,
+                'cache': raw_cache,
+                'analysis_time': analysis_time,
+            }
+        )
+        ifs_datetime = results['ifs']['datetime']
         
         logger.info(f'Computing TOA solar radiation for datetime {ifs_datetime}')
         toa_radiation = xarray_integrated_toa_solar_radiation(ifs_datetime, 1)
         
+        # The decoded datasets are processed directly, without being written
+        # to intermediate files
         logger.info('Processing the downloaded and computed data')
-        out_path = processing.process_data(
-            target_tmp_dirs['era5'],
-            target_tmp_dirs['ifs'],
-            target_tmp_dirs['imerg'],
+        out_path = processing.process_datasets(
+            ifs_datetime,
+            results['ifs']['pressure'],
+            results['ifs']['single'],
+            [ds for ds in (results['era5']['pressure'], results['era5']['single']) if ds is not None],
+            results['imerg']['precipitation'],
             toa_radiation,
             target_dir
         )
@@ -0,0 +1 @@
+from . import ranges, file_cache, pmtiles, tile_cache, zarr_tiles, point_query, sections, regions, metrics, events, compression, proxy, handler, workers
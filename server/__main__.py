@@ -1,31 +1,209 @@
 import http.server
-import socketserver
 import argparse
+import functools
+import socket
+import sys
 import os
 
-class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', '*')
-        super().end_headers()
+from server.handler import CORSRequestHandler, DEFAULT_CACHE_CONTROL
+from server.file_cache import MappedFileCache
+from server.pmtiles import ArchiveCache
+from server.tile_cache import TileCache
+from server.zarr_tiles import ZarrTileRenderer
+from server.point_query import PointQuery
+from server.sections import VerticalSection
+from server.metrics import Metrics
+from server.events import EventHub, RunWatcher
+from server.compression import CompressionCache
+from server.proxy import Origin, ProxyCache
+from server import workers
 
-    def do_OPTIONS(self):
-        self.send_response(204)
-        self.end_headers()
+class ThreadingHTTPServer(http.server.ThreadingHTTPServer):
+    # Bursts of connections (e.g. /events clients reconnecting after a restart)
+    # overflow the default backlog of 5
+    request_queue_size = workers.LISTEN_BACKLOG
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('port', nargs='?', type=int, default=8000, help='Port to serve on')
     parser.add_argument('-d', '--directory', default=os.getcwd(), help='Directory to serve')
     parser.add_argument('--bind', default='0.0.0.0', help='Specify alternate bind address [default: all interfaces]')
+    parser.add_argument('--max-mapped-files', type=int, default=256,
+                        help='Maximum number of files kept memory-mapped [default: 256]')
+    parser.add_argument('--no-file-cache', action='store_true',
+                        help='Open and read files on every request instead of memory-mapping them')
+    parser.add_argument('--cache-control', action='append', default=[], metavar='PATTERN=VALUE',
+                        help=('Cache-Control header value for the request paths matching '
+                              'PATTERN (fnmatch syntax). Can be repeated; the first match '
+                              'wins, and the defaults are tried last.'))
+    parser.add_argument('--tiles-dir', default='tiles',
+                        help=('Directory containing the {run}/{variable}/... PMTiles archives, '
+                              'relative to the served directory [default: tiles]'))
+    parser.add_argument('--preload-tiles', action='store_true',
+                        help='Parse the directories of the most recent archives at startup')
+    parser.add_argument('--zarr', action='append', default=[], metavar='PATH',
+                        help=('Forecast .zarr file from which tiles missing from the archives '
+                              'are rendered on request. Can be repeated.'))
+    parser.add_argument('--max-render-zoom', type=int, default=None,
+                        help='Maximum zoom rendered from --zarr files [default: tiler.constants.RENDER_ZOOM_MAX]')
+    parser.add_argument('--render-cache-dir', default=None,
+                        help='Directory of the on-disk cache of rendered tiles [default: memory only]')
+    parser.add_argument('--render-cache-memory', type=int, default=256,
+                        help='Size of the in-memory cache of rendered tiles, in MB [default: 256]')
+    parser.add_argument('--render-cache-disk', type=int, default=2048,
+                        help='Size of the on-disk cache of rendered tiles, in MB [default: 2048]')
+    parser.add_argument('--point-cache-memory', type=int, default=1024,
+                        help='Size of the cache of decoded chunks used by /point queries, in MB [default: 1024]')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='Disable request metrics and the /metrics endpoint')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Never compress responses')
+    parser.add_argument('--compression-cache', type=int, default=64,
+                        help='Size of the cache of compressed text files, in MB [default: 64]')
+    parser.add_argument('--run-pointer', default='latest.json',
+                        help=('File designating the latest run, relative to the served directory. '
+                              'Clients of /events are notified when it changes [default: latest.json]'))
+    parser.add_argument('--proxy', default=None, metavar='URL',
+                        help=('Serve files from this origin (e.g. the bucket to which runs are uploaded) '
+                              'through an on-disk cache, instead of from the served directory'))
+    parser.add_argument('--proxy-cache-dir', default=None,
+                        help='Directory of the on-disk cache of --proxy files (required with --proxy)')
+    parser.add_argument('--proxy-cache-size', type=int, default=10240,
+                        help='Size of the on-disk cache of --proxy files, in MB [default: 10240]')
+    parser.add_argument('--proxy-block-size', type=int, default=256,
+                        help='Size of the blocks cached from --proxy files, in KiB [default: 256]')
+    parser.add_argument('--proxy-revalidate', type=float, default=60,
+                        help='Seconds after which --proxy files are revalidated with the origin [default: 60]')
+    parser.add_argument('--workers', type=int, default=1,
+                        help=('Number of worker processes sharing the listening socket. With more than '
+                              'one, SIGHUP replaces the workers without dropping connections [default: 1]'))
+    # Set by the master process for its workers
+    parser.add_argument('--listen-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--ready-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-dir', default=None, help=argparse.SUPPRESS)
     args = parser.parse_args()
 
-    os.chdir(args.directory)
+    cache_control = []
+    for rule in args.cache_control:
+        pattern, sep, value = rule.partition('=')
+        if not sep:
+            parser.error(f'--cache-control expects PATTERN=VALUE, got {rule!r}')
+        cache_control.append((pattern, value))
+    cache_control += DEFAULT_CACHE_CONTROL
 
-    with socketserver.TCPServer((args.bind, args.port), CORSRequestHandler) as httpd:
+    if args.proxy is not None and args.proxy_cache_dir is None:
+        parser.error('--proxy requires --proxy-cache-dir')
+
+    if args.workers > 1 and args.listen_fd is None:
+        # The master only supervises the workers, which load everything
+        sock = workers.create_socket(args.bind, args.port)
+        print(f"Serving CORS-enabled HTTP on port {args.port} with {args.workers} workers "
+              f"(dir: {args.directory}, master: {os.getpid()})", flush=True)
+        workers.Master(sock, args.workers, sys.argv[1:]).run()
+        return
+
+    file_cache = MappedFileCache(args.max_mapped_files)
+    # The tile endpoint always reads archives from mapped files
+    archive_cache = ArchiveCache(file_cache, args.max_mapped_files)
+    if args.preload_tiles:
+        loaded = archive_cache.preload(os.path.join(args.directory, args.tiles_dir))
+        print(f'Preloaded the directories of {loaded} PMTiles archives')
+
+    metrics = None if args.no_metrics else Metrics()
+    if metrics is not None:
+        if not args.no_file_cache:
+            metrics.add_cache('files', file_cache)
+        metrics.add_cache('archives', archive_cache)
+
+    compression_cache = None if args.no_compression else CompressionCache(args.compression_cache * 1024 ** 2)
+    if metrics is not None and compression_cache is not None:
+        metrics.add_cache('compressed', compression_cache)
+
+    proxy_cache = None
+    if args.proxy is not None:
+        proxy_cache = ProxyCache(
+            Origin(args.proxy),
+            args.proxy_cache_dir,
+            max_bytes=args.proxy_cache_size * 1024 ** 2,
+            block_size=args.proxy_block_size * 1024,
+            revalidate_after=args.proxy_revalidate,
+            workers=args.workers
+        )
+        if metrics is not None:
+            metrics.add_cache('proxy_blocks', proxy_cache, {
+                'hit': 'hits',
+                'miss': 'misses',
+                'coalesced': 'coalesced',
+            })
+        print(f'Proxying files from {args.proxy} (cache: {args.proxy_cache_dir})')
+
+    event_hub = EventHub()
+    if proxy_cache is not None:
+        # Runs are published to the origin
+        run_watcher = RunWatcher('/' + args.run_pointer.lstrip('/'), event_hub, proxy_cache=proxy_cache)
+    else:
+        run_watcher = RunWatcher(os.path.join(args.directory, args.run_pointer), event_hub)
+    if metrics is not None:
+        metrics.add_gauge('appa_sse_clients', 'Open /events connections.', event_hub, 'clients')
+
+    tile_renderers = {}
+    point_queries = {}
+    sections = {}
+    if args.zarr:
+        render_cache = TileCache(
+            max_memory_bytes=args.render_cache_memory * 1024 ** 2,
+            disk_dir=args.render_cache_dir,
+            max_disk_bytes=args.render_cache_disk * 1024 ** 2
+        )
+        if metrics is not None:
+            metrics.add_cache('rendered_tiles', render_cache, {
+                'hit_memory': 'memory_hits',
+                'hit_disk': 'disk_hits',
+                'miss': 'misses',
+                'coalesced': 'coalesced',
+            })
+        for path in args.zarr:
+            renderer = ZarrTileRenderer(path, render_cache, max_zoom=args.max_render_zoom)
+            tile_renderers[renderer.run] = renderer
+            point_queries[renderer.run] = PointQuery(path, args.point_cache_memory * 1024 ** 2)
+            sections[renderer.run] = VerticalSection(point_queries[renderer.run])
+            if metrics is not None:
+                metrics.add_cache('point_chunks', point_queries[renderer.run])
+                metrics.add_cache('section_paths', sections[renderer.run])
+            print(f'Rendering tiles and answering /point, /profile and /section queries of run {renderer.run} (from {path})')
+
+    handler = functools.partial(
+        CORSRequestHandler,
+        directory=args.directory,
+        file_cache=None if args.no_file_cache else file_cache,
+        cache_control=cache_control,
+        archive_cache=archive_cache,
+        tiles_dir=args.tiles_dir,
+        tile_renderers=tile_renderers,
+        point_queries=point_queries,
+        sections=sections,
+        metrics=metrics,
+        event_hub=event_hub,
+        run_watcher=run_watcher,
+        compression_cache=compression_cache,
+        proxy_cache=proxy_cache
+    )
+
+    if args.listen_fd is not None:
+        if metrics is not None and args.metrics_dir is not None:
+            metrics.share(args.metrics_dir)
+        try:
+            workers.serve_worker(socket.socket(fileno=args.listen_fd), handler, args.ready_fd)
+        finally:
+            if metrics is not None:
+                metrics.unshare()
+        return
+
+    # One thread per connection, so that slow clients or long keep-alive
+    # connections don't block the others.
+    with ThreadingHTTPServer((args.bind, args.port), handler) as httpd:
         print(f"Serving CORS-enabled HTTP on port {args.port} (dir: {args.directory})")
         httpd.serve_forever()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
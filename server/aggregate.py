@@ -0,0 +1,66 @@
+# Aggregates a decoded forecast over regions (countries, custom polygons):
+# area-weighted means and maxima of every variable, for all lead times and
+# levels, written as a columnar table (Parquet, or CSV).
+#
+# The polygons are rasterized once per GeoJSON file and grid, and the masks are
+# cached in --mask-cache, so that aggregating the next runs over the same
+# regions only reads the forecast.
+#
+# Usage: python -m server.aggregate [-h] [--vars VARIABLES] [--name-property NAME]
+#                                   [--mask-cache DIR] ZARR REGIONS OUTPUT
+
+from pathlib import Path
+
+import argparse
+import time
+
+from server.regions import RegionMasks, aggregate
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate a forecast over the regions of a GeoJSON file.')
+    parser.add_argument('zarr', help='Decoded forecast .zarr file')
+    parser.add_argument('regions', help='GeoJSON file of the regions (Polygon and MultiPolygon features)')
+    parser.add_argument('output', help='Output file, .parquet or .csv')
+    parser.add_argument('--vars', default=None,
+                        help='Comma-separated variables to aggregate [default: all]')
+    parser.add_argument('--name-property', default='name',
+                        help='Feature property holding the region names [default: name]')
+    parser.add_argument('--mask-cache', default=None,
+                        help='Directory in which rasterized regions are cached [default: no cache]')
+    args = parser.parse_args()
+
+    import xarray as xr
+    import pandas as pd
+
+    output = Path(args.output)
+    if output.suffix not in ('.parquet', '.csv'):
+        parser.error('The output must be a .parquet or .csv file')
+
+    # Without dask, only the chunks that are indexed are read
+    dataset = xr.open_zarr(args.zarr, chunks=None)
+
+    start = time.perf_counter()
+    masks = RegionMasks.from_geojson(
+        args.regions,
+        dataset['latitude'].to_numpy(),
+        dataset['longitude'].to_numpy(),
+        cache_dir=args.mask_cache,
+        name_property=args.name_property
+    )
+    print(f'Masks of {len(masks.names)} regions ({len(masks.indices)} cells) '
+          f'in {time.perf_counter() - start:.2f} s')
+
+    start = time.perf_counter()
+    variables = None if args.vars is None else [v.strip() for v in args.vars.split(',') if v.strip()]
+    table = pd.DataFrame(aggregate(dataset, masks, variables))
+    table['run'] = Path(args.zarr).stem
+    print(f'Aggregated {len(table)} rows in {time.perf_counter() - start:.2f} s')
+
+    if output.suffix == '.parquet':
+        table.to_parquet(output, index=False)
+    else:
+        table.to_csv(output, index=False)
+    print(f'Wrote {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Benchmark of the server on synthetic archives, reproducing the small range
+# reads made by PMTiles clients (one header read per archive, then many tile
+# reads). The same workload is run against a server opening and reading files
+# for every request (`--no-file-cache`) and against the memory-mapped file cache,
+# with and without request metrics.
+#
+# Usage: python -m server.benchmark [-h] [--files N] [--file-size MB]
+#                                   [--clients N] [--duration SECONDS]
+
+from pathlib import Path
+
+import http.client
+import subprocess
+import threading
+import argparse
+import tempfile
+import socket
+import random
+import time
+import sys
+import os
+
+PMTILES_HEADER_SIZE = 16384
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server on synthetic range requests.')
+    parser.add_argument('--files', type=int, default=49, help='Number of synthetic archives [default: 49]')
+    parser.add_argument('--file-size', type=int, default=8, help='Size of each archive in MB [default: 8]')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent connections [default: 8]')
+    parser.add_argument('--duration', type=float, default=10, help='Duration of each run in seconds [default: 10]')
+    args = parser.parse_args()
+
+    configurations = {
+        'open/read per request': ['--no-file-cache'],
+        'memory-mapped cache': [],
+        'mapped, no metrics': ['--no-metrics'],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = make_archives(directory, args.files, args.file_size * 1024 * 1024)
+        print(f'{"configuration":<24} {"requests/s":>12} {"p50 (ms)":>10} {"p99 (ms)":>10} {"errors":>8}')
+        for name, extra_args in configurations.items():
+            with run_server(directory, extra_args) as port:
+                n_requests, latencies, errors = run_clients(port, files, args.clients, args.duration)
+            latencies.sort()
+            print(f'{name:<24} {n_requests / args.duration:>12.0f} '
+                  f'{percentile(latencies, 0.5) * 1000:>10.2f} '
+                  f'{percentile(latencies, 0.99) * 1000:>10.2f} {errors:>8}')
+
+def make_archives(directory: os.PathLike, n_files: int, size: int) -> list[tuple[str, int]]:
+    """Write `n_files` archives of random bytes into `directory`.
+
+    Returns:
+        list[tuple[str, int]]: (URL path, size) of each archive
+    """
+    files = []
+    for i in range(n_files):
+        path = Path(directory) / f'h{i}.pmtiles'
+        path.write_bytes(os.urandom(size))
+        files.append((f'/h{i}.pmtiles', size))
+    return files
+
+class run_server:
+    """Context manager running `python -m server` in a subprocess on a free
+    local port, which is returned when entering the context."""
+    def __init__(self, directory: os.PathLike, extra_args: list[str]):
+        self.directory = directory
+        self.extra_args = extra_args
+
+    def __enter__(self) -> int:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'server', str(port), '-d', str(self.directory),
+             '--bind', '127.0.0.1', *self.extra_args],
+            cwd=Path(__file__).resolve().parent.parent,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return port
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.process.kill()
+                    raise RuntimeError('The server did not start')
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+def run_clients(port: int,
+                files: list[tuple[str, int]],
+                n_clients: int,
+                duration: float) -> tuple[int, list[float], int]:
+    """Send range requests from `n_clients` persistent connections during
+    `duration` seconds.
+
+    Returns:
+        (n_requests, latencies, errors) (tuple[int, list[float], int]): Number
+            of successful requests, their latencies in seconds, and the number of
+            failed requests
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed: int):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        local = []
+        while time.monotonic() < deadline:
+            path, size = rng.choice(files)
+            if rng.random() < 0.1:
+                first, length = 0, PMTILES_HEADER_SIZE
+            else:
+                length = rng.randint(2 * 1024, 64 * 1024)
+                first = rng.randrange(0, size - length)
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path, headers={'Range': f'bytes={first}-{first + length - 1}'})
+                response = conn.getresponse()
+                body = response.read()
+                if response.status != 206 or len(body) != length:
+                    raise ValueError(f'Unexpected response {response.status}')
+            except (OSError, ValueError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                continue
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), latencies, errors[0]
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# Content negotiation and compression of static responses. Text files are
+# served with the best encoding accepted by the client (`Accept-Encoding`):
+# from a precompressed sibling file (`file.json.br`, `file.json.gz`) when one
+# is up to date, and otherwise compressed once and kept in a bounded cache.
+# Already compressed formats (PMTiles archives, PNG/WebP tiles) are never
+# compressed.
+#
+# Siblings can be written beforehand with `python -m server.precompress`.
+
+from collections import OrderedDict
+
+import threading
+import gzip
+import os
+
+from server.tile_cache import SingleFlight
+
+try:
+    import brotli
+except ImportError:
+    # Precompressed .br files are still served
+    brotli = None
+
+# Encodings, in order of preference, and the suffix of their sibling files
+ENCODINGS = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+}
+
+# Files smaller than this don't gain anything from compression
+MIN_SIZE = 1024
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+def is_compressible(content_type: str) -> bool:
+    """Whether responses of this type benefit from compression. Binary
+    formats, such as PMTiles archives or PNG/WebP tiles, are already
+    compressed."""
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+def negotiate(accept_encoding: str | None, encodings: list[str]) -> str | None:
+    """Choose an encoding according to an `Accept-Encoding` header.
+
+    Args:
+        accept_encoding (str | None): Value of the header
+        encodings (list[str]): Available encodings, in order of preference
+
+    Returns:
+        str | None: The preferred encoding among those with the highest
+            quality value, or `None` if the client accepts none of them.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def available_encodings() -> list[str]:
+    """Encodings with which files can be compressed on the fly."""
+    return [e for e in ENCODINGS if e != 'br' or brotli is not None]
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+def sibling_path(path: os.PathLike, encoding: str, mtime: float) -> str | None:
+    """Path of the precompressed sibling of a file, if it exists and isn't
+    older than the file."""
+    sibling = os.fspath(path) + ENCODINGS[encoding]
+    try:
+        if os.stat(sibling).st_mtime >= mtime:
+            return sibling
+    except OSError:
+        pass
+    return None
+
+class CompressionCache:
+    """Thread-safe LRU cache of compressed files, keyed by path, modification
+    time, size and encoding, so that changed files are compressed again.
+    Concurrent requests for the same file compress it once.
+
+    Args:
+        max_bytes (int, optional): Maximum total size of the compressed data.
+            Defaults to 64 MB.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def get(self, path: str, mtime: float, size: int, encoding: str, read) -> bytes:
+        """Get a compressed file.
+
+        Args:
+            path (str): Path of the file
+            mtime (float): Modification time of the file
+            size (int): Size of the file
+            encoding (str): Encoding, from `available_encodings()`
+            read (Callable[[], bytes]): Function reading the file's contents
+
+        Returns:
+            bytes: Compressed contents
+        """
+        key = (path, mtime, size, encoding)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+
+        def create() -> bytes:
+            data = compress(read(), encoding)
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = data
+                    self._bytes += len(data)
+                while self._bytes > self.max_bytes and self._entries:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+            return data
+
+        return self._single_flight.do(key, create)
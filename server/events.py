@@ -0,0 +1,236 @@
+from collections import deque
+
+import threading
+import selectors
+import socket
+import json
+import time
+import os
+
+from server.proxy import OriginError, ProxyCache
+
+class EventHub:
+    """Pushes Server-Sent Events to many connections from a single thread.
+
+    Connections are handed over by the request handler once the response
+    headers are sent, so that idle connections don't each hold a thread: they
+    only cost a socket and a (usually empty) output buffer. Clients that don't
+    read their events fast enough are disconnected.
+
+    Args:
+        heartbeat (float, optional): Seconds between the comments sent to all
+            clients, so that proxies don't close idle connections. Defaults to
+            15.
+        max_buffer (int, optional): Maximum number of bytes waiting to be sent
+            to a client before it is disconnected. Defaults to 256 KiB.
+    """
+    def __init__(self, heartbeat: float = 15, max_buffer: int = 256 * 1024):
+        self.heartbeat = heartbeat
+        self.max_buffer = max_buffer
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        # (socket, data) of new clients, or (None, data) of broadcasts
+        self._pending: deque[tuple[socket.socket | None, bytes]] = deque()
+        self._buffers: dict[socket.socket, bytearray] = {}
+        self._thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+        self._thread.start()
+
+    @property
+    def clients(self) -> int:
+        """Number of connected clients."""
+        return len(self._buffers)
+
+    def attach(self, sock: socket.socket, data: bytes = b''):
+        """Hand a connection over to the hub, after the response headers.
+
+        Args:
+            sock (socket.socket): Client connection, no longer used by its
+                request handler
+            data (bytes, optional): First bytes to send. Defaults to `b''`.
+        """
+        self._pending.append((sock, data))
+        self._wake()
+
+    def publish(self, event: str, data: dict, event_id: str = None):
+        """Send an event to all clients.
+
+        Args:
+            event (str): Event type
+            data (dict): JSON-serializable event data
+            event_id (str, optional): Event ID, sent back by clients in the
+                `Last-Event-ID` header when they reconnect. Defaults to `None`.
+        """
+        self._pending.append((None, format_event(event, data, event_id)))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b'\0')
+        except BlockingIOError:
+            # The hub is already woken up
+            pass
+
+    def _run(self):
+        last_heartbeat = time.monotonic()
+        while True:
+            timeout = max(0, last_heartbeat + self.heartbeat - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                sock = key.fileobj
+                if sock is self._wakeup_read:
+                    try:
+                        while sock.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ:
+                    # Clients don't send anything: this is a disconnection
+                    try:
+                        data = sock.recv(4096)
+                    except BlockingIOError:
+                        data = None
+                    except OSError:
+                        data = b''
+                    if data == b'':
+                        self._drop(sock)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(sock)
+
+            while self._pending:
+                sock, data = self._pending.popleft()
+                if sock is None:
+                    for client in list(self._buffers):
+                        self._send(client, data)
+                else:
+                    sock.setblocking(False)
+                    self._buffers[sock] = bytearray()
+                    self._selector.register(sock, selectors.EVENT_READ)
+                    self._send(sock, data)
+
+            if time.monotonic() >= last_heartbeat + self.heartbeat:
+                last_heartbeat = time.monotonic()
+                for client in list(self._buffers):
+                    self._send(client, b': keep-alive\n\n')
+
+    def _send(self, sock: socket.socket, data: bytes):
+        buffer = self._buffers[sock]
+        buffer += data
+        if len(buffer) > self.max_buffer:
+            self._drop(sock)
+        else:
+            self._flush(sock)
+
+    def _flush(self, sock: socket.socket):
+        buffer = self._buffers.get(sock)
+        if buffer is None:
+            return
+        try:
+            sent = sock.send(buffer) if buffer else 0
+            del buffer[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(sock)
+            return
+        # Only wait for the socket to be writable while data is pending
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if buffer else 0)
+        if self._selector.get_key(sock).events != events:
+            self._selector.modify(sock, events)
+
+    def _drop(self, sock: socket.socket):
+        self._buffers.pop(sock, None)
+        self._selector.unregister(sock)
+        sock.close()
+
+class RunWatcher:
+    """Watches the pointer to the latest published run, and publishes a `run`
+    event to an `EventHub` whenever it changes.
+
+    The pointer is a small JSON file, `{"latest": run, "variables": [...]}`,
+    written by the pipeline once all of the run's files are published, so that
+    clients are never told about a partially published run. It is polled with
+    `os.stat`, which costs nothing while it doesn't change. In proxy mode, runs
+    are published to the origin, and the pointer is polled through the proxy
+    cache instead, whose metadata is revalidated with a conditional request
+    once it is older than the cache's `revalidate_after`.
+
+    Args:
+        pointer_path (os.PathLike): Path to the run pointer. It may not exist
+            yet. With `proxy_cache`, its path on the origin, e.g.
+            `/latest.json`.
+        hub (EventHub): Hub to which events are published
+        interval (float, optional): Seconds between checks of the pointer.
+            Defaults to 1.
+        proxy_cache (ProxyCache, optional): Cache through which the pointer is
+            read from the origin. Defaults to `None`, for a local file.
+    """
+    def __init__(self, pointer_path: os.PathLike, hub: EventHub, interval: float = 1,
+                 proxy_cache: ProxyCache = None):
+        self.pointer_path = pointer_path
+        self.hub = hub
+        self.interval = interval
+        self.proxy_cache = proxy_cache
+        # Data of the last `run` event, sent to clients when they connect
+        self.event: dict | None = None
+        self._signature = None
+        self._check(publish=False)
+        self._thread = threading.Thread(target=self._run, name='run-watcher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self._check()
+
+    def _check(self, publish: bool = True):
+        """Publish an event if the pointer now designates another run."""
+        if self.proxy_cache is not None:
+            try:
+                obj = self.proxy_cache.stat(self.pointer_path)
+            except OriginError:
+                return
+            signature = obj.etag
+        else:
+            try:
+                st = os.stat(self.pointer_path)
+            except OSError:
+                return
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if signature == self._signature:
+            return
+        try:
+            if self.proxy_cache is not None:
+                pointer = json.loads(obj.read(0, obj.size - 1))
+            else:
+                with open(self.pointer_path, 'rb') as f:
+                    pointer = json.load(f)
+            run = pointer['latest']
+            variables = sorted(pointer.get('variables', []))
+        except (OSError, OriginError, ValueError, KeyError, TypeError):
+            # Partially written, or not fetched: check again later
+            return
+        self._signature = signature
+
+        previous = self.event
+        if previous is not None and previous['run'] == run:
+            return
+        previous_variables = [] if previous is None else previous['variables']
+        self.event = {
+            'run': run,
+            'previous': None if previous is None else previous['run'],
+            'variables': variables,
+            'added': [v for v in variables if v not in previous_variables],
+            'removed': [v for v in previous_variables if v not in variables],
+        }
+        if publish:
+            self.hub.publish('run', self.event, run)
+
+def format_event(event: str, data: dict, event_id: str = None) -> bytes:
+    """Encode an event in the `text/event-stream` format."""
+    lines = [] if event_id is None else [f'id: {event_id}']
+    lines += [f'event: {event}', f'data: {json.dumps(data, separators=(",", ":"))}']
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+import threading
+import mmap
+import os
+
+class OpenedFile:
+    """A file opened for the duration of a single request, read with
+    seek/read calls.
+
+    Args:
+        path (os.PathLike): Path to the file
+    """
+    def __init__(self, path: os.PathLike):
+        self.file = open(path, 'rb')
+        try:
+            self.stat = os.fstat(self.file.fileno())
+        except:
+            self.file.close()
+            raise
+        self.size = self.stat.st_size
+        self.mtime = self.stat.st_mtime
+        self.etag = make_etag(self.stat)
+
+    def read(self, first: int, last: int) -> bytes:
+        """Read the bytes from position `first` to `last`, both included."""
+        self.file.seek(first)
+        return self.file.read(last - first + 1)
+
+    def close(self):
+        self.file.close()
+
+class MappedFile(OpenedFile):
+    """A file kept open and memory-mapped, so that reads don't require any
+    system call once the pages are in the page cache. Reads are safe to perform
+    from multiple threads at once.
+
+    Args:
+        path (os.PathLike): Path to the file
+    """
+    def __init__(self, path: os.PathLike):
+        super().__init__(path)
+        if self.size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped
+            self.data = b''
+
+    def read(self, first: int, last: int) -> memoryview:
+        return memoryview(self.data)[first:last + 1]
+
+    def close(self):
+        # The mapping is deliberately not closed: other threads may still be
+        # reading from it. It is unmapped once the last reference is dropped.
+        pass
+
+class MappedFileCache:
+    """Thread-safe LRU cache of `MappedFile` objects. Entries are revalidated
+    with a `stat` call on each access, and replaced if the file on disk changed.
+
+    Args:
+        max_files (int, optional): Maximum number of files kept mapped at once.
+            Defaults to 256.
+    """
+    def __init__(self, max_files: int = 256):
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, MappedFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: os.PathLike) -> MappedFile:
+        """Get the mapped file for `path`, mapping it if needed.
+
+        Args:
+            path (os.PathLike): Path to a regular file
+
+        Raises:
+            OSError: If the file can't be opened
+
+        Returns:
+            MappedFile: Mapped file, up to date with the file on disk
+        """
+        path = os.fspath(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and _same_file(entry.stat, st):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Map outside of the lock, so that a slow disk doesn't block the hits
+        entry = MappedFile(path)
+        with self._lock:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_files:
+                self._entries.popitem(last=False)
+        return entry
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+def make_etag(st: os.stat_result) -> str:
+    """Build a strong entity tag from the identity, size and modification time
+    of a file.
+
+    Args:
+        st (os.stat_result): Result of `os.stat` for the file
+
+    Returns:
+        str: Quoted entity tag
+    """
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def _same_file(a: os.stat_result, b: os.stat_result) -> bool:
+    return (a.st_ino, a.st_dev, a.st_size, a.st_mtime_ns) == \
+        (b.st_ino, b.st_dev, b.st_size, b.st_mtime_ns)
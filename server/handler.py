@@ -0,0 +1,842 @@
+import http.server
+import email.utils
+import json
+import urllib.parse
+import fnmatch
+import hashlib
+import secrets
+import socket
+import struct
+import time
+import re
+import os
+
+from http import HTTPStatus
+
+from server import ranges, pmtiles, metrics, events, compression, proxy
+from server.zarr_tiles import ZarrTileRenderer
+from server.point_query import PointQuery
+from server.sections import VerticalSection
+from server.file_cache import MappedFileCache, OpenedFile
+
+# Byte ranges at least this large are sent with sendfile(2) rather than copied
+# from the memory mapping. Below this size, the extra system calls cost more
+# than the copy.
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# Byte ranges of files without a file descriptor (proxied files) are read and
+# written in chunks of this size
+READ_CHUNK_SIZE = 1024 * 1024
+
+# (pattern, Cache-Control value) pairs. The first pattern matching the request
+# path (with `fnmatch`) is used.
+DEFAULT_CACHE_CONTROL = [
+    ('*/metadata.json', 'no-cache'),
+    ('*.pmtiles', 'public, max-age=3600'),
+    ('*.png', 'public, max-age=3600'),
+    ('*.bundle', 'public, max-age=3600'),
+]
+
+# /{run}/{variable}/{level}/{hour}/{z}/{x}/{y}.png, where level is `lvl{i}` for
+# pressure level variables and `-` for single level variables, and hour is
+# `h{t}`, as in the tile directory layout written by `tiler.dataset_to_tiles`.
+TILE_PATH = re.compile(r'/(?P<run>[^/.][^/]*)/(?P<variable>[^/.][^/]*)/(?P<level>lvl\d+|-)/'
+                       r'(?P<hour>h\d+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png')
+
+# /{run}/{variable}/{level}/h{first}-{last}/{z}/{x}/{y}.bundle: the tile at
+# z/x/y for all hours from `first` to `last` (included), in one response.
+BUNDLE_PATH = re.compile(r'/(?P<run>[^/.][^/]*)/(?P<variable>[^/.][^/]*)/(?P<level>lvl\d+|-)/'
+                         r'h(?P<first>\d+)-(?P<last>\d+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.bundle')
+
+# Maximum number of hours in a bundle
+MAX_BUNDLE_HOURS = 256
+
+# Maximum number of buffers written with a single sendmsg(2) call
+MAX_IOVECS = 1024
+
+class Body:
+    """Body of a response, as returned by `send_head`.
+
+    Args:
+        source (OpenedFile | proxy.ProxiedObject): File from which the byte
+            ranges are read, or `None` if `parts` only contains bytes
+        parts (list[bytes | memoryview | tuple[int, int]]): Literal bytes
+            (possibly views of mapped files), or (first, last) byte positions
+            (both included) to send from `source`
+    """
+    def __init__(self, source: OpenedFile | proxy.ProxiedObject | None, parts: list[bytes | memoryview | tuple[int, int]]):
+        self.source = source
+        self.parts = parts
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """`SimpleHTTPRequestHandler` allowing CORS requests from any domain, with
+    support for HTTP/1.1 persistent connections, single or multiple byte range
+    requests (as used by PMTiles clients) and conditional requests.
+
+    Args:
+        file_cache (MappedFileCache, optional): Cache of memory-mapped files
+            from which files are served. If `None`, each file is opened and
+            read for every request. Defaults to `None`.
+        cache_control (list[tuple[str, str]], optional): (pattern,
+            Cache-Control value) pairs, the first pattern matching the request
+            path giving the header value. Defaults to `DEFAULT_CACHE_CONTROL`.
+        archive_cache (pmtiles.ArchiveCache, optional): Cache of parsed PMTiles
+            archives, used to serve single tiles on `TILE_PATH`. If `None`, the
+            tile endpoint is disabled. Defaults to `None`.
+        tiles_dir (os.PathLike, optional): Directory containing the
+            `{run}/{variable}/...` archives, relative to the served directory.
+            Defaults to `tiles`.
+        tile_renderers (dict[str, ZarrTileRenderer], optional): Renderers of
+            tiles from forecast `.zarr` files, by run identifier. Tiles of these
+            runs that are not in a PMTiles archive are rendered on request.
+            Defaults to `{}`.
+        point_queries (dict[str, PointQuery], optional): Point queries on
+            forecast `.zarr` files, by run identifier, answering `/point`
+            requests. Defaults to `{}`.
+        sections (dict[str, VerticalSection], optional): Vertical profiles and
+            cross-sections of forecast `.zarr` files, by run identifier,
+            answering `/profile` and `/section` requests. Defaults to `{}`.
+        metrics (metrics.Metrics, optional): Metrics recording every request,
+            exported on `/metrics`. If `None`, requests are not recorded and
+            the endpoint is disabled. Defaults to `None`.
+        event_hub (events.EventHub, optional): Hub to which `/events`
+            connections are handed over. If `None`, the endpoint is disabled.
+            Defaults to `None`.
+        run_watcher (events.RunWatcher, optional): Watcher of the latest run,
+            whose last event is sent to `/events` clients when they connect.
+            Defaults to `None`.
+        compression_cache (compression.CompressionCache, optional): Cache of
+            compressed text files. If `None`, responses are never compressed.
+            Defaults to `None`.
+        proxy_cache (proxy.ProxyCache, optional): Cache of the files of an
+            origin. If set, files are served from the origin through the cache
+            instead of from the served directory. Defaults to `None`.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Idle keep-alive connections are closed after this many seconds, so that
+    # they don't hold on to a thread forever.
+    timeout = 30
+
+    # Headers and body are written separately: without this, Nagle's algorithm
+    # delays small responses until the client acknowledges the headers.
+    disable_nagle_algorithm = True
+
+    def __init__(self,
+                 *args,
+                 file_cache: MappedFileCache = None,
+                 cache_control: list[tuple[str, str]] = DEFAULT_CACHE_CONTROL,
+                 archive_cache: pmtiles.ArchiveCache = None,
+                 tiles_dir: os.PathLike = 'tiles',
+                 tile_renderers: dict[str, ZarrTileRenderer] = {},
+                 point_queries: dict[str, PointQuery] = {},
+                 sections: dict[str, VerticalSection] = {},
+                 metrics: metrics.Metrics = None,
+                 event_hub: events.EventHub = None,
+                 run_watcher: events.RunWatcher = None,
+                 compression_cache: compression.CompressionCache = None,
+                 proxy_cache: proxy.ProxyCache = None,
+                 **kwargs):
+        # Set before calling the parent constructor, which handles the request
+        self.file_cache = file_cache
+        self.cache_control = cache_control
+        self.archive_cache = archive_cache
+        self.tiles_dir = tiles_dir
+        self.tile_renderers = tile_renderers
+        self.point_queries = point_queries
+        self.sections = sections
+        self.metrics = metrics
+        self.event_hub = event_hub
+        self.run_watcher = run_watcher
+        self.compression_cache = compression_cache
+        self.proxy_cache = proxy_cache
+        # Set for each request, for the metrics
+        self.path_class = 'other'
+        self._start = None
+        self._status = None
+        self._content_length = 0
+        super().__init__(*args, **kwargs)
+
+    def setup(self):
+        super().setup()
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+    def finish(self):
+        if self.metrics is not None:
+            self.metrics.connection_closed()
+        super().finish()
+
+    def parse_request(self) -> bool:
+        # Called once the request line is read, so that the time spent waiting
+        # for requests on idle connections isn't counted
+        self.path_class = 'other'
+        self._start = time.perf_counter()
+        self._status = None
+        self._content_length = 0
+        return super().parse_request()
+
+    def handle_one_request(self):
+        self._start = None
+        super().handle_one_request()
+        if self.metrics is not None and self._start is not None and self._status is not None:
+            sent_body = self.command != 'HEAD' and self._status not in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED)
+            self.metrics.observe(
+                self.path_class,
+                self._status,
+                time.perf_counter() - self._start,
+                self._content_length if sent_body else 0
+            )
+
+    def send_response(self, code: int, message: str = None):
+        self._status = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword: str, value: str):
+        if keyword == 'Content-Length':
+            self._content_length = int(value)
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if getattr(self.server, 'draining', False):
+            # The worker is stopping: let the client reconnect to another one
+            self.send_header('Connection', 'close')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', '*')
+        self.send_header('Access-Control-Expose-Headers',
+                         'Content-Length, Content-Range, Accept-Ranges, ETag')
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        self.path_class = 'options'
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        body = self.send_head()
+        if body is None:
+            return
+        try:
+            if isinstance(body, Body):
+                self.send_body(body)
+            else:
+                self.copyfile(body, self.wfile)
+        finally:
+            body.close()
+
+    def do_HEAD(self):
+        body = self.send_head()
+        if body is not None:
+            body.close()
+
+    def send_head(self):
+        url_path = urllib.parse.unquote(self.path.split('?', 1)[0].split('#', 1)[0])
+        if url_path == '/metrics' and self.metrics is not None:
+            self.path_class = 'metrics'
+            return self._send_metrics_head()
+        if url_path == '/events' and self.event_hub is not None:
+            self.path_class = 'events'
+            return self._send_events_head()
+        if url_path == '/point' and self.point_queries:
+            self.path_class = 'point'
+            return self._send_point_head()
+        if url_path in ('/profile', '/section') and self.sections:
+            self.path_class = url_path[1:]
+            return self._send_section_head(url_path[1:])
+
+        match = BUNDLE_PATH.fullmatch(url_path)
+        if match is not None and (self.archive_cache is not None or match['run'] in self.tile_renderers):
+            self.path_class = 'bundle'
+            return self._send_bundle_head(match)
+
+        match = TILE_PATH.fullmatch(url_path)
+        if match is not None:
+            # Pre-rendered tiles are cheaper to serve than rendering them
+            if self.archive_cache is not None:
+                archive_path = self._archive_path(match, match['hour'])
+                if os.path.isfile(archive_path):
+                    self.path_class = 'tile'
+                    return self._send_tile_head(archive_path, match)
+            if match['run'] in self.tile_renderers:
+                self.path_class = 'rendered_tile'
+                return self._send_rendered_tile_head(self.tile_renderers[match['run']], match)
+
+        self.path_class = _static_path_class(url_path)
+        if self.proxy_cache is not None:
+            return self._send_proxied_head(url_path)
+
+        path = self.translate_path(self.path)
+        # Directories (listings, index.html, redirects) and missing files are
+        # left to SimpleHTTPRequestHandler
+        if not os.path.isfile(path) or self.path.split('?', 1)[0].endswith('/'):
+            return super().send_head()
+
+        try:
+            if self.file_cache is None:
+                source = OpenedFile(path)
+            else:
+                source = self.file_cache.get(path)
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+
+        try:
+            content_type = self.guess_type(path)
+            if self.compression_cache is not None and compression.is_compressible(content_type):
+                return self._send_negotiated_head(path, source, content_type)
+            return self._send_file_head(source, content_type)
+        except:
+            source.close()
+            raise
+
+    def send_body(self, body: Body):
+        """Write the body of a file response, using sendfile(2) for large byte
+        ranges when it is available, and a single sendmsg(2) call for
+        consecutive literal parts when possible.
+
+        Args:
+            body (Body): Body returned by `send_head`
+        """
+        buffers = []
+        for part in body.parts:
+            if not isinstance(part, tuple):
+                buffers.append(part)
+                continue
+            self._send_buffers(buffers)
+            buffers = []
+            first, last = part
+            count = last - first + 1
+            if not isinstance(body.source, OpenedFile):
+                for start in range(first, last + 1, READ_CHUNK_SIZE):
+                    self.wfile.write(body.source.read(start, min(start + READ_CHUNK_SIZE - 1, last)))
+            elif count >= SENDFILE_MIN_SIZE and hasattr(os, 'sendfile'):
+                self.connection.sendfile(body.source.file, first, count)
+            else:
+                self.wfile.write(body.source.read(first, last))
+        self._send_buffers(buffers)
+
+    def _send_buffers(self, buffers: list[bytes | memoryview]):
+        """Write buffers with vectored writes (sendmsg), without joining them."""
+        if len(buffers) <= 1 or not hasattr(self.connection, 'sendmsg'):
+            for buffer in buffers:
+                self.wfile.write(buffer)
+            return
+        views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer) > 0]
+        i = 0
+        while i < len(views):
+            sent = self.connection.sendmsg(views[i:i + MAX_IOVECS])
+            # Skip what was sent, which may end in the middle of a buffer
+            while i < len(views) and sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            if sent > 0:
+                views[i] = views[i][sent:]
+
+    def _send_file_head(self,
+                        source: OpenedFile | proxy.ProxiedObject,
+                        content_type: str,
+                        negotiated: bool = False,
+                        encoding: str = None) -> Body | None:
+        """Send the headers of a file, or of the requested byte ranges.
+
+        Args:
+            source (OpenedFile | proxy.ProxiedObject): File to send, closed by
+                the caller of `send_head` once the body is sent
+            content_type (str): Content type of the response
+            negotiated (bool, optional): Whether the response depends on the
+                `Accept-Encoding` request header. Defaults to `False`.
+            encoding (str, optional): Content encoding of `source`, if it is a
+                precompressed file. Defaults to `None`.
+
+        Returns:
+            Body | None: Body of the response
+        """
+        last_modified = self.date_time_string(source.mtime)
+
+        if self._not_modified(source.etag, source.mtime):
+            source.close()
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self._send_encoding(negotiated, None)
+            self._send_validators(source.etag, last_modified)
+            self.end_headers()
+            return None
+
+        byte_ranges = None
+        range_header = self.headers.get('Range')
+        if range_header is not None and self._if_range_matches(source, last_modified):
+            try:
+                byte_ranges = ranges.parse_range_header(range_header, source.size)
+            except ranges.RangeNotSatisfiable:
+                source.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{source.size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+        if isinstance(source, proxy.ProxiedObject) and self.command != 'HEAD' and source.size > 0:
+            # Fetched before the headers, so that origin errors get a status
+            try:
+                source.prefetch(byte_ranges or [(0, source.size - 1)])
+            except proxy.OriginError as e:
+                self.send_error(e.status, str(e))
+                return None
+
+        if byte_ranges is None:
+            parts = [(0, source.size - 1)] if source.size > 0 else []
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', content_type)
+        elif len(byte_ranges) == 1:
+            first, last = byte_ranges[0]
+            parts = [(first, last)]
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{source.size}')
+        else:
+            boundary = secrets.token_hex(16)
+            parts = ranges.multipart_parts(byte_ranges, source.size, content_type, boundary)
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        self.send_header('Content-Length', str(ranges.parts_length(parts)))
+        self._send_encoding(negotiated, encoding)
+        self._send_validators(source.etag, last_modified)
+        self.end_headers()
+        return Body(source, parts)
+
+    def _send_negotiated_head(self, path: str, source: OpenedFile, content_type: str) -> Body | None:
+        """Send the headers of a text file, with the best encoding accepted by
+        the client: from a precompressed sibling file if there is an up to date
+        one, and otherwise compressed once and cached. Range requests get the
+        file itself."""
+        if 'Range' in self.headers or source.size < compression.MIN_SIZE:
+            return self._send_file_head(source, content_type, negotiated=True)
+
+        # Precompressed files can use encodings unavailable on the fly
+        siblings = {}
+        for encoding in compression.ENCODINGS:
+            sibling = compression.sibling_path(path, encoding, source.mtime)
+            if sibling is not None:
+                siblings[encoding] = sibling
+        available = compression.available_encodings()
+        encoding = compression.negotiate(
+            self.headers.get('Accept-Encoding'),
+            [e for e in compression.ENCODINGS if e in siblings or e in available]
+        )
+        if encoding is None:
+            return self._send_file_head(source, content_type, negotiated=True)
+
+        if encoding in siblings:
+            try:
+                if self.file_cache is None:
+                    sibling_source = OpenedFile(siblings[encoding])
+                else:
+                    sibling_source = self.file_cache.get(siblings[encoding])
+            except OSError:
+                return self._send_file_head(source, content_type, negotiated=True)
+            source.close()
+            return self._send_file_head(sibling_source, content_type, negotiated=True, encoding=encoding)
+
+        try:
+            etag = f'{source.etag[:-1]}-{encoding}"'
+            last_modified = self.date_time_string(source.mtime)
+            if self._not_modified(etag, source.mtime):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self._send_encoding(True, None)
+                self._send_validators(etag, last_modified)
+                self.end_headers()
+                return None
+
+            data = self.compression_cache.get(
+                path,
+                source.mtime,
+                source.size,
+                encoding,
+                lambda: bytes(source.read(0, source.size - 1))
+            )
+        finally:
+            source.close()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self._send_encoding(True, encoding)
+        self._send_validators(etag, last_modified)
+        self.end_headers()
+        return Body(None, [data])
+
+    def _send_encoding(self, negotiated: bool, encoding: str | None):
+        if negotiated:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+
+    def _archive_path(self, match: re.Match, hour: str) -> str:
+        """Path to the PMTiles archive holding the tiles of an hour (`h{t}`)
+        of a `TILE_PATH` or `BUNDLE_PATH` request."""
+        root = os.path.join(self.directory, self.tiles_dir)
+        parts = [match['run'], match['variable']]
+        if match['level'] != '-':
+            parts.append(match['level'])
+        return os.path.join(root, *parts, hour + '.pmtiles')
+
+    def _send_proxied_head(self, url_path: str) -> Body | None:
+        """Send the headers of a file of the origin, read through the proxy
+        cache. Directory listings aren't available from origins."""
+        if url_path.endswith('/'):
+            url_path += 'index.html'
+        try:
+            source = self.proxy_cache.stat(url_path)
+        except proxy.OriginError as e:
+            self.send_error(e.status, str(e))
+            return None
+        return self._send_file_head(source, source.content_type or self.guess_type(url_path))
+
+    def _send_tile_head(self, archive_path: str, match: re.Match) -> Body | None:
+        """Send the headers of a single tile, read from its PMTiles archive.
+        Tiles absent from the archive (e.g. empty tiles) get a 204 response
+        without any data read besides the cached directories."""
+        try:
+            archive = self.archive_cache.get(archive_path)
+        except (OSError, ValueError):
+            self.send_error(HTTPStatus.NOT_FOUND, 'Archive not found')
+            return None
+
+        z, x, y = int(match['z']), int(match['x']), int(match['y'])
+        try:
+            location = archive.find_tile(z, x, y)
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Invalid tile coordinates')
+            return None
+
+        source = archive.source
+        last_modified = self.date_time_string(source.mtime)
+        if location is None:
+            self.send_response(HTTPStatus.NO_CONTENT)
+            self.send_header('Content-Length', '0')
+            self._send_validators(source.etag, last_modified)
+            self.end_headers()
+            return None
+
+        # The archive's tag changes whenever any of its tiles does
+        etag = f'{source.etag[:-1]}-{z}-{x}-{y}"'
+        if self._not_modified(etag, source.mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self._send_validators(etag, last_modified)
+            self.end_headers()
+            return None
+
+        offset, length = location
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', archive.mime_type)
+        if archive.header.tile_compression == pmtiles.COMPRESSION_GZIP:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(length))
+        self._send_validators(etag, last_modified)
+        self.end_headers()
+        return Body(source, [(offset, offset + length - 1)] if length > 0 else [])
+
+    def _send_rendered_tile_head(self, renderer: ZarrTileRenderer, match: re.Match) -> Body | None:
+        """Send the headers of a single tile rendered from a forecast `.zarr`
+        file."""
+        variable = match['variable']
+        ilevel = None if match['level'] == '-' else int(match['level'].removeprefix('lvl'))
+        itime = int(match['hour'].removeprefix('h'))
+        z, x, y = int(match['z']), int(match['x']), int(match['y'])
+
+        if not renderer.has_slice(variable, ilevel, itime):
+            self.send_error(HTTPStatus.NOT_FOUND, 'Variable, level or hour not found')
+            return None
+        if z > renderer.max_zoom or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            self.send_error(HTTPStatus.NOT_FOUND, 'Tile out of bounds')
+            return None
+
+        etag = f'"{renderer.run}-{variable}-{match["level"]}-{itime}-{z}-{x}-{y}"'
+        last_modified = self.date_time_string(renderer.mtime)
+        if self._not_modified(etag, renderer.mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self._send_validators(etag, last_modified)
+            self.end_headers()
+            return None
+
+        data = renderer.get_tile(variable, ilevel, itime, z, x, y)
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self._send_validators(etag, last_modified)
+        self.end_headers()
+        return Body(None, [data])
+
+    def _send_bundle_head(self, match: re.Match) -> Body | None:
+        """Send the headers of a bundle of the tiles at z/x/y for a range of
+        hours, read from the PMTiles archives of each hour (or rendered, for
+        runs with a renderer and no archive). The body is a little-endian
+        uint32 count of hours, followed by a uint32 length and the tile data
+        for each hour. Tiles absent from an archive, or hours without an
+        archive, have a length of 0."""
+        first, last = int(match['first']), int(match['last'])
+        z, x, y = int(match['z']), int(match['x']), int(match['y'])
+        if last < first or last - first + 1 > MAX_BUNDLE_HOURS:
+            self.send_error(HTTPStatus.BAD_REQUEST, f'Invalid hours, at most {MAX_BUNDLE_HOURS} can be bundled')
+            return None
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Invalid tile coordinates')
+            return None
+
+        renderer = self.tile_renderers.get(match['run'])
+        ilevel = None if match['level'] == '-' else int(match['level'].removeprefix('lvl'))
+        # Archive, renderer or None for each hour, found before reading
+        # anything so that 304 responses are cheap
+        sources = []
+        validators = []
+        mtimes = []
+        for hour in range(first, last + 1):
+            source = None
+            archive_path = self._archive_path(match, f'h{hour}')
+            if self.archive_cache is not None and os.path.isfile(archive_path):
+                try:
+                    source = self.archive_cache.get(archive_path)
+                    validators.append(source.source.etag)
+                    mtimes.append(source.source.mtime)
+                except (OSError, ValueError):
+                    source = None
+            if source is None and renderer is not None and z <= renderer.max_zoom \
+                    and renderer.has_slice(match['variable'], ilevel, hour):
+                source = renderer
+                validators.append(f'{renderer.run}-{renderer.mtime}-{hour}')
+                mtimes.append(renderer.mtime)
+            sources.append(source)
+        if not validators:
+            self.send_error(HTTPStatus.NOT_FOUND, 'No archive found for these hours')
+            return None
+
+        digest = hashlib.sha1('\n'.join(validators).encode('utf-8')).hexdigest()[:24]
+        etag = f'"{digest}-{z}-{x}-{y}"'
+        mtime = max(mtimes)
+        last_modified = self.date_time_string(mtime)
+        if self._not_modified(etag, mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self._send_validators(etag, last_modified)
+            self.end_headers()
+            return None
+
+        parts = [struct.pack('<I', len(sources))]
+        for hour, source in zip(range(first, last + 1), sources):
+            data = b''
+            if isinstance(source, pmtiles.Archive):
+                location = source.find_tile(z, x, y)
+                if location is not None and location[1] > 0:
+                    offset, length = location
+                    # A view of the mapped archive: the data isn't copied
+                    data = source.source.read(offset, offset + length - 1)
+            elif source is not None:
+                data = source.get_tile(match['variable'], ilevel, hour, z, x, y)
+            parts += [struct.pack('<I', len(data)), data]
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(ranges.parts_length(parts)))
+        self._send_validators(etag, last_modified)
+        self.end_headers()
+        return Body(None, parts)
+
+    def _send_point_head(self) -> Body | None:
+        """Send the headers of a `/point` query, whose parameters are:
+
+        - `lat`, `lon`: Comma-separated coordinates of the points (required)
+        - `vars`: Comma-separated variables (default: all)
+        - `levels`: Comma-separated pressure levels in hPa (default: all)
+        - `method`: `bilinear` (default) or `nearest`
+        - `run`: Run identifier (default: the latest run)
+        """
+        query = urllib.parse.urlsplit(self.path).query
+        params = {key: ','.join(values) for key, values in urllib.parse.parse_qs(query).items()}
+
+        def split(name: str) -> list[str] | None:
+            if name not in params:
+                return None
+            return [value.strip() for value in params[name].split(',') if value.strip()]
+
+        try:
+            run = params.get('run', max(self.point_queries))
+            if run not in self.point_queries:
+                raise ValueError(f'Unknown run {run}')
+            levels = split('levels')
+            result = self.point_queries[run].query(
+                latitudes=[float(v) for v in split('lat') or []],
+                longitudes=[float(v) for v in split('lon') or []],
+                variables=split('vars'),
+                levels=None if levels is None else [int(level) for level in levels],
+                method=params.get('method', 'bilinear')
+            )
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return None
+
+        data = json.dumps(result, separators=(',', ':')).encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        return Body(None, [data])
+
+    def _send_section_head(self, kind: str) -> Body | None:
+        """Send the headers of a `/profile` or `/section` query, whose
+        parameters are:
+
+        - `lat`, `lon`: Coordinates of the point (`/profile`), or
+          comma-separated coordinates of the vertices of the path (`/section`)
+          (required)
+        - `hour`: Index of the lead time (default: 0)
+        - `samples`: Number of points along the path (`/section` only,
+          default: 100)
+        - `vars`: Comma-separated variables (default: all pressure level
+          variables)
+        - `method`: `bilinear` (default) or `nearest`
+        - `run`: Run identifier (default: the latest run)
+        """
+        query = urllib.parse.urlsplit(self.path).query
+        params = {key: ','.join(values) for key, values in urllib.parse.parse_qs(query).items()}
+
+        def split(name: str) -> list[str] | None:
+            if name not in params:
+                return None
+            return [value.strip() for value in params[name].split(',') if value.strip()]
+
+        try:
+            run = params.get('run', max(self.sections))
+            if run not in self.sections:
+                raise ValueError(f'Unknown run {run}')
+            latitudes = [float(v) for v in split('lat') or []]
+            longitudes = [float(v) for v in split('lon') or []]
+            hour = int(params.get('hour', 0))
+            method = params.get('method', 'bilinear')
+            if kind == 'profile':
+                if len(latitudes) != 1 or len(longitudes) != 1:
+                    raise ValueError('lat and lon must have a single value')
+                result = self.sections[run].profile(latitudes[0], longitudes[0], hour, split('vars'), method)
+            else:
+                if len(latitudes) != len(longitudes) or len(latitudes) < 2:
+                    raise ValueError('lat and lon must have the same number of values, at least 2')
+                result = self.sections[run].section(
+                    list(zip(latitudes, longitudes)),
+                    hour,
+                    int(params.get('samples', 100)),
+                    split('vars'),
+                    method
+                )
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return None
+
+        data = json.dumps(result, separators=(',', ':')).encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        return Body(None, [data])
+
+    def _send_events_head(self) -> None:
+        """Start a Server-Sent Events stream of `run` events, and hand the
+        connection over to the event hub. The latest run is sent first, unless
+        the client already knows it (`Last-Event-ID`)."""
+        if self.command == 'HEAD':
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            return None
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        # The stream ends when the connection is closed
+        self.close_connection = True
+        self.end_headers()
+
+        data = b'retry: 10000\n\n'
+        event = None if self.run_watcher is None else self.run_watcher.event
+        if event is not None and self.headers.get('Last-Event-ID') != event['run']:
+            data += events.format_event('run', event, event['run'])
+        # The handler's socket object is detached, so that closing it when
+        # the request ends leaves the connection open
+        self.event_hub.attach(socket.socket(fileno=self.connection.detach()), data)
+        return None
+
+    def _send_metrics_head(self) -> Body:
+        data = self.metrics.render()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        return Body(None, [data])
+
+    def _send_validators(self, etag: str, last_modified: str):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        url_path = self.path.split('?', 1)[0]
+        for pattern, value in self.cache_control:
+            if fnmatch.fnmatchcase(url_path, pattern):
+                self.send_header('Cache-Control', value)
+                break
+
+    def _not_modified(self, etag: str, mtime: float) -> bool:
+        """Whether the client's cached copy is up to date, according to the
+        `If-None-Match` or (if absent) `If-Modified-Since` headers.
+
+        Args:
+            etag (str): Entity tag of the response
+            mtime (float): Modification time of the response's source file
+
+        Returns:
+            bool: `True` if a 304 response must be sent
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # Weak comparison, as required for If-None-Match
+            return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return int(mtime) <= since.timestamp()
+
+    def _if_range_matches(self, source: OpenedFile | proxy.ProxiedObject, last_modified: str) -> bool:
+        """Whether the `If-Range` precondition of the request (if any) holds, in
+        which case the Range header must be honored.
+
+        Args:
+            source (OpenedFile | proxy.ProxiedObject): Requested file
+            last_modified (str): Last-Modified date of the requested file
+
+        Returns:
+            bool: `False` if the file changed since the client cached its part
+        """
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', 'W/')):
+            # Strong comparison: weak tags never match
+            return if_range == source.etag
+        return if_range == last_modified
+
+def _static_path_class(url_path: str) -> str:
+    """Kind of a static file path, as reported in the metrics."""
+    if url_path.endswith('.pmtiles'):
+        return 'pmtiles'
+    if url_path.endswith('/metadata.json'):
+        return 'metadata'
+    return 'static'
@@ -0,0 +1,369 @@
+# Load test of the server, replaying the requests made by the visualizer for
+# simulated users. Each user opens up to 6 persistent connections, like a
+# browser, and reads the PMTiles archives the way the `pmtiles` JavaScript
+# client does: one 16 KiB request for the header and root directory of each
+# archive, one request per leaf directory, and one range request per tile,
+# with headers and directories cached until the variable changes. As in
+# `visualizer/js/layerManager.js`, the layers of the current time and of the
+# next LOOK_AHEAD_LAYERS times load the tiles of the viewport.
+#
+# Users pan, zoom, play, seek in time and switch variables, with exponentially
+# distributed pauses between actions. The server is run on synthetic archives
+# laid out like the uploaded tiles.
+#
+# Usage: python -m server.loadtest [-h] [--users N] [--duration SECONDS]
+#                                  [--think-time SECONDS] [--hours N]
+#                                  [--zoom-max Z] [--seed SEED]
+#                                  [--processes N] [--server-args ARGS]
+
+from collections import defaultdict
+from pathlib import Path
+
+import multiprocessing
+import argparse
+import tempfile
+import asyncio
+import random
+import shlex
+import gzip
+import json
+import math
+import time
+import os
+
+from server import pmtiles
+from server.benchmark import run_server, percentile
+
+# As in visualizer/js/config.js
+LOOK_AHEAD_LAYERS = 4
+
+# Browsers open at most this many HTTP/1.1 connections per host
+CONNECTIONS_PER_USER = 6
+
+VIEWPORT_WIDTH = 1280
+VIEWPORT_HEIGHT = 800
+TILE_SIZE = 256
+
+# Zoom levels above the archives' maximum zoom that users can reach
+# (Leaflet upscales the tiles of the maximum zoom)
+OVERZOOM = 2
+
+SURFACE_VARIABLES = ['2m_temperature', 'total_precipitation']
+LEVEL_VARIABLES = ['temperature', 'specific_humidity']
+LEVELS = [500, 850]
+
+# action -> weight
+ACTIONS = {
+    'play': 0.5,
+    'pan': 0.2,
+    'zoom': 0.15,
+    'seek': 0.05,
+    'switch variable': 0.1,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay visualizer playback against the server.')
+    parser.add_argument('--users', type=int, default=20, help='Number of simulated users [default: 20]')
+    parser.add_argument('--duration', type=float, default=30, help='Duration of the test in seconds [default: 30]')
+    parser.add_argument('--think-time', type=float, default=1.0,
+                        help='Mean pause between the actions of a user, in seconds [default: 1.0]')
+    parser.add_argument('--hours', type=int, default=12, help='Lead time of the synthetic run, in hours [default: 12]')
+    parser.add_argument('--zoom-max', type=int, default=3,
+                        help='Maximum zoom of the synthetic archives [default: 3, as tiler.constants.ZOOM_MAX]')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed [default: 0]')
+    parser.add_argument('--processes', type=int, default=1,
+                        help=('Number of client processes the users are spread over, so that the '
+                              'load generator is not the bottleneck [default: 1]'))
+    parser.add_argument('--server-args', default='', help='Extra arguments of `python -m server`, e.g. "--no-file-cache"')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print('Writing synthetic archives...')
+        make_run(directory, args.hours, args.zoom_max, random.Random(args.seed))
+        with run_server(directory, shlex.split(args.server_args)) as port:
+            # Process i simulates the users i, i + processes, ...
+            jobs = [(port, range(i, args.users, args.processes), args.duration, args.think_time, args.seed)
+                    for i in range(args.processes)]
+            with multiprocessing.Pool(args.processes) as pool:
+                stats = Stats()
+                for process_stats in pool.starmap(run_process, jobs):
+                    stats.merge(process_stats)
+    print_report(stats, args.duration)
+
+def make_run(directory: os.PathLike, hours: int, zoom_max: int, rng: random.Random):
+    """Write a `metadata.json` and the `tiles/{run}/...` archives of a
+    synthetic run, with random tiles of 2 to 30 KiB."""
+    run = f'2025-07-24T06Z_PT{hours}H'
+    pool = os.urandom(64 * 1024)
+    subdirs = [Path(variable) for variable in SURFACE_VARIABLES]
+    subdirs += [Path(variable) / f'lvl{i}' for variable in LEVEL_VARIABLES for i in range(len(LEVELS))]
+    for subdir in subdirs:
+        archive_dir = Path(directory) / 'tiles' / run / subdir
+        archive_dir.mkdir(parents=True)
+        for hour in range(hours + 1):
+            tiles = {}
+            for z in range(zoom_max + 1):
+                for x in range(2 ** z):
+                    for y in range(2 ** z):
+                        size = rng.randint(2 * 1024, 30 * 1024)
+                        start = rng.randrange(0, len(pool) - size)
+                        tiles[z, x, y] = pool[start:start + size]
+            pmtiles.write_archive(archive_dir / f'h{hour}.pmtiles', tiles)
+
+    variables = {v: {'is_level': False} for v in SURFACE_VARIABLES}
+    variables |= {v: {'is_level': True} for v in LEVEL_VARIABLES}
+    metadata = {
+        'latest': run,
+        'variables': variables,
+        'levels': LEVELS,
+        'zoom_min': 0,
+        'zoom_max': zoom_max,
+    }
+    (Path(directory) / 'metadata.json').write_text(json.dumps(metadata))
+
+class Stats:
+    """Latencies, bytes and errors of the requests, by kind (`metadata`,
+    `header`, `leaf`, `tile`)."""
+    def __init__(self):
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.bytes: defaultdict[str, int] = defaultdict(int)
+        self.errors: defaultdict[str, int] = defaultdict(int)
+
+    def merge(self, other: 'Stats'):
+        for kind, latencies in other.latencies.items():
+            self.latencies[kind] += latencies
+        for kind, n_bytes in other.bytes.items():
+            self.bytes[kind] += n_bytes
+        for kind, errors in other.errors.items():
+            self.errors[kind] += errors
+
+class Connection:
+    """Persistent HTTP/1.1 connection sending GET requests one at a time."""
+    def __init__(self, port: int):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def get(self, path: str, byte_range: tuple[int, int] = None) -> tuple[int, bytes]:
+        """Send a GET request, reconnecting if needed.
+
+        Returns:
+            (status, body) (tuple[int, bytes])
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{self.port}\r\n'
+        if byte_range is not None:
+            request += f'Range: bytes={byte_range[0]}-{byte_range[1]}\r\n'
+        self.writer.write((request + '\r\n').encode('latin-1'))
+        try:
+            status = int((await self.reader.readline()).split()[1])
+            length = 0
+            keep_alive = True
+            while (line := await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                name = name.strip().lower()
+                if name == 'content-length':
+                    length = int(value)
+                elif name == 'connection' and value.strip().lower() == 'close':
+                    keep_alive = False
+            body = await self.reader.readexactly(length)
+        except BaseException:
+            self.close()
+            raise
+        if not keep_alive:
+            self.close()
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class User:
+    """Simulated visualizer user."""
+    def __init__(self, port: int, stats: Stats, rng: random.Random, think_time: float):
+        self.stats = stats
+        self.rng = rng
+        self.think_time = think_time
+        self.connections = asyncio.Queue()
+        for _ in range(CONNECTIONS_PER_USER):
+            self.connections.put_nowait(Connection(port))
+        # archive path -> task returning (header, root directory)
+        self.archives: dict[str, asyncio.Task] = {}
+        # (archive path, leaf offset) -> task returning the leaf directory
+        self.leaves: dict[tuple[str, int], asyncio.Task] = {}
+        # time index -> tiles currently displayed by the layer
+        self.layers: dict[int, set[tuple[int, int, int]]] = {}
+
+    async def run(self, deadline: float):
+        status, body = await self.fetch('metadata', '/metadata.json')
+        if status != 200:
+            return
+        self.metadata = json.loads(body)
+        self.n_times = int(self.metadata['latest'].split('_PT')[1].rstrip('H')) + 1
+        self.zoom = self.rng.randint(2, self.metadata['zoom_max'] + 1)
+        self.center = (self.rng.random(), self.rng.uniform(0.3, 0.7)) # Web Mercator, in [0, 1)
+        self.time = 0
+        self.switch_variable()
+
+        while time.monotonic() < deadline:
+            await self.show()
+            await asyncio.sleep(self.rng.expovariate(1 / self.think_time))
+            action = self.rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+            if action == 'play':
+                self.time = (self.time + 1) % self.n_times
+            elif action == 'seek':
+                self.time = self.rng.randrange(self.n_times)
+            elif action == 'pan':
+                world = TILE_SIZE * 2 ** self.zoom
+                dx = self.rng.uniform(-1, 1) * VIEWPORT_WIDTH / world
+                dy = self.rng.uniform(-1, 1) * VIEWPORT_HEIGHT / world
+                self.center = ((self.center[0] + dx) % 1, min(max(self.center[1] + dy, 0), 0.999))
+            elif action == 'zoom':
+                zoom_max = self.metadata['zoom_max'] + OVERZOOM
+                self.zoom = min(max(self.zoom + self.rng.choice([-1, 1]), 0), zoom_max)
+            else:
+                self.switch_variable()
+
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+
+    def switch_variable(self):
+        """Show a random variable (and level), dropping all cached archives
+        and layers, as `showVariable` does."""
+        variable = self.rng.choice(list(self.metadata['variables']))
+        self.prefix = f'/tiles/{self.metadata["latest"]}/{variable}/'
+        if self.metadata['variables'][variable]['is_level']:
+            self.prefix += f'lvl{self.rng.randrange(len(self.metadata["levels"]))}/'
+        self.archives.clear()
+        self.leaves.clear()
+        self.layers.clear()
+
+    async def show(self):
+        """Load the viewport tiles missing from the current and look-ahead
+        layers, removing the layers outside of them."""
+        visible = range(self.time, min(self.time + LOOK_AHEAD_LAYERS + 1, self.n_times))
+        self.layers = {t: tiles for t, tiles in self.layers.items() if t in visible}
+        viewport = self.viewport_tiles()
+        requests = []
+        for t in visible:
+            # Leaflet prunes the tiles that left the viewport
+            displayed = self.layers.setdefault(t, set()) & viewport
+            self.layers[t] = viewport
+            requests += [self.get_tile(t, *tile) for tile in viewport - displayed]
+        await asyncio.gather(*requests)
+
+    def viewport_tiles(self) -> set[tuple[int, int, int]]:
+        """Tiles of the archives covering the viewport."""
+        z = min(self.zoom, self.metadata['zoom_max'])
+        n = 2 ** z
+        tile_size = TILE_SIZE * 2 ** (self.zoom - z)
+        cx, cy = self.center[0] * n, self.center[1] * n
+        half_width = VIEWPORT_WIDTH / 2 / tile_size
+        half_height = VIEWPORT_HEIGHT / 2 / tile_size
+        tiles = set()
+        for x in range(math.floor(cx - half_width), math.floor(cx + half_width) + 1):
+            for y in range(max(math.floor(cy - half_height), 0), min(math.floor(cy + half_height), n - 1) + 1):
+                tiles.add((z, x % n, y))
+        return tiles
+
+    async def get_tile(self, t: int, z: int, x: int, y: int):
+        path = f'{self.prefix}h{t}.pmtiles'
+        if path not in self.archives:
+            self.archives[path] = asyncio.ensure_future(self.read_root(path))
+        try:
+            header, directory = await self.archives[path]
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            return
+        tile_id = pmtiles.zxy_to_tile_id(z, x, y)
+        for _ in range(pmtiles.MAX_DIRECTORY_DEPTH):
+            entry = pmtiles.find_entry(directory, tile_id)
+            if entry is None:
+                return
+            _, offset, length, run_length = entry
+            if run_length > 0:
+                first = header.data_offset + offset
+                await self.fetch('tile', path, (first, first + length - 1))
+                return
+            key = (path, offset)
+            if key not in self.leaves:
+                first = header.leaf_offset + offset
+                self.leaves[key] = asyncio.ensure_future(self.read_directory('leaf', path, first, length))
+            try:
+                directory = await self.leaves[key]
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                return
+
+    async def read_root(self, path: str) -> tuple[pmtiles.Header, list]:
+        status, data = await self.fetch('header', path, (0, pmtiles.ROOT_REQUEST_SIZE - 1))
+        if status not in (200, 206):
+            raise ValueError(f'Unexpected status {status}')
+        header = pmtiles.Header(data)
+        root = data[header.root_offset:header.root_offset + header.root_length]
+        return header, pmtiles.deserialize_directory(gzip.decompress(root))
+
+    async def read_directory(self, kind: str, path: str, first: int, length: int) -> list:
+        status, data = await self.fetch(kind, path, (first, first + length - 1))
+        if status not in (200, 206):
+            raise ValueError(f'Unexpected status {status}')
+        return pmtiles.deserialize_directory(gzip.decompress(data))
+
+    async def fetch(self, kind: str, path: str, byte_range: tuple[int, int] = None) -> tuple[int, bytes]:
+        """Send a request on one of the user's connections, recording its
+        latency (excluding the wait for a free connection) or error."""
+        connection = await self.connections.get()
+        start = time.perf_counter()
+        try:
+            status, body = await connection.get(path, byte_range)
+        except (OSError, ValueError, asyncio.IncompleteReadError, IndexError):
+            self.stats.errors[kind] += 1
+            return 0, b''
+        finally:
+            self.connections.put_nowait(connection)
+        if status >= 400 or (byte_range is not None and len(body) != byte_range[1] - byte_range[0] + 1):
+            self.stats.errors[kind] += 1
+        else:
+            self.stats.latencies[kind].append(time.perf_counter() - start)
+            self.stats.bytes[kind] += len(body)
+        return status, body
+
+def run_process(port: int, user_ids: range, duration: float, think_time: float, seed: int) -> Stats:
+    return asyncio.run(run_users(port, user_ids, duration, think_time, seed))
+
+async def run_users(port: int, user_ids: range, duration: float, think_time: float, seed: int) -> Stats:
+    stats = Stats()
+    deadline = time.monotonic() + duration
+    users = [User(port, stats, random.Random(seed + i), think_time) for i in user_ids]
+
+    async def start(i: int, user: User):
+        # Users arrive over the first second rather than all at once
+        await asyncio.sleep(i / len(users))
+        await user.run(deadline)
+
+    await asyncio.gather(*(start(i, user) for i, user in enumerate(users)))
+    return stats
+
+def print_report(stats: Stats, duration: float):
+    kinds = sorted(set(stats.latencies) | set(stats.errors))
+    print(f'{"requests":<10} {"count":>8} {"req/s":>8} {"MB/s":>8} {"p50 (ms)":>9} '
+          f'{"p90 (ms)":>9} {"p99 (ms)":>9} {"errors":>7} {"error %":>8}')
+    all_latencies = []
+    for kind in kinds + ['total']:
+        if kind == 'total':
+            latencies = sorted(all_latencies)
+            n_bytes = sum(stats.bytes.values())
+            errors = sum(stats.errors.values())
+        else:
+            latencies = sorted(stats.latencies[kind])
+            all_latencies += latencies
+            n_bytes = stats.bytes[kind]
+            errors = stats.errors[kind]
+        count = len(latencies) + errors
+        print(f'{kind:<10} {count:>8} {count / duration:>8.0f} {n_bytes / duration / 1e6:>8.1f} '
+              f'{percentile(latencies, 0.5) * 1000:>9.2f} {percentile(latencies, 0.9) * 1000:>9.2f} '
+              f'{percentile(latencies, 0.99) * 1000:>9.2f} {errors:>7} '
+              f'{100 * errors / max(count, 1):>7.2f}%')
+
+if __name__ == '__main__':
+    main()
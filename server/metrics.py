@@ -0,0 +1,254 @@
+from collections import defaultdict
+from pathlib import Path
+
+import threading
+import bisect
+import json
+import time
+import os
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds between two snapshots of the metrics of a worker, shared with the
+# other workers
+SHARE_INTERVAL = 1
+
+# Snapshots not updated for this number of intervals are of workers that are
+# gone
+STALE_AFTER = 10
+
+class Metrics:
+    """Request metrics of the server, exported in the Prometheus text format.
+
+    Recording a request only takes a lock and updates a few counters, so that
+    metrics can stay enabled at any request rate. Cache counters are read from
+    the cache objects when the metrics are rendered, so caches don't need to
+    know about metrics.
+
+    With several workers, each one shares snapshots of its metrics (see
+    `share`), so that `/metrics` reports all of them whichever worker answers
+    it, rather than counters jumping between the values of different workers.
+
+    Args:
+        buckets (tuple[float], optional): Upper bounds of the latency histogram
+            buckets, in seconds. Defaults to `LATENCY_BUCKETS`.
+    """
+    def __init__(self, buckets: tuple[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.connections = 0
+        self._requests: defaultdict[tuple[str, int], int] = defaultdict(int) # (class, status)
+        self._bytes: defaultdict[str, int] = defaultdict(int)
+        # class -> [count per bucket (+Inf last), sum of latencies]
+        self._latencies: dict[str, list] = {}
+        self._caches: list[tuple[str, object, dict[str, str]]] = []
+        self._gauges: list[tuple[str, str, object, str]] = []
+        self._lock = threading.Lock()
+        self._shared_dir: Path | None = None
+        self._share_interval = SHARE_INTERVAL
+
+    def observe(self, path_class: str, status: int, seconds: float, n_bytes: int):
+        """Record a request.
+
+        Args:
+            path_class (str): Kind of the requested path (e.g. `tile`), with
+                few distinct values
+            status (int): Response status code
+            seconds (float): Time taken to handle the request
+            n_bytes (int): Size of the response body
+        """
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._requests[path_class, status] += 1
+            self._bytes[path_class] += n_bytes
+            latencies = self._latencies.get(path_class)
+            if latencies is None:
+                latencies = self._latencies[path_class] = [[0] * (len(self.buckets) + 1), 0.0]
+            latencies[0][index] += 1
+            latencies[1] += seconds
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections -= 1
+
+    def add_cache(self, name: str, cache: object, counters: dict[str, str] = None):
+        """Export the counters of a cache. Caches added with the same name are
+        summed.
+
+        Args:
+            name (str): Value of the `cache` label
+            cache (object): Cache object
+            counters (dict[str, str], optional): Value of the `result` label ->
+                name of the counter attribute of `cache`. Defaults to
+                `{'hit': 'hits', 'miss': 'misses'}`.
+        """
+        counters = {'hit': 'hits', 'miss': 'misses'} if counters is None else counters
+        self._caches.append((name, cache, counters))
+
+    def add_gauge(self, name: str, help: str, source: object, attribute: str):
+        """Export an attribute of an object as a gauge.
+
+        Args:
+            name (str): Metric name
+            help (str): Description of the metric
+            source (object): Object holding the value
+            attribute (str): Name of the attribute holding the value
+        """
+        self._gauges.append((name, help, source, attribute))
+
+    def share(self, directory: os.PathLike, interval: float = SHARE_INTERVAL):
+        """Share the metrics with the other workers of the server, so that any
+        of them reports the metrics of all of them, each one with a `worker`
+        label (its pid). A snapshot of the metrics is written to the directory
+        every `interval` seconds.
+
+        Args:
+            directory (os.PathLike): Directory shared by the workers
+            interval (float, optional): Seconds between two snapshots.
+                Defaults to `SHARE_INTERVAL`.
+        """
+        self._shared_dir = Path(directory)
+        self._share_interval = interval
+        self._write_snapshot()
+        thread = threading.Thread(target=self._share, name='metrics-share', daemon=True)
+        thread.start()
+
+    def unshare(self):
+        """Remove the snapshot of this worker, e.g. when it exits."""
+        if self._shared_dir is not None:
+            self._snapshot_path().unlink(missing_ok=True)
+
+    def _share(self):
+        while True:
+            time.sleep(self._share_interval)
+            try:
+                self._write_snapshot()
+            except OSError:
+                pass
+
+    def _snapshot_path(self) -> Path:
+        return self._shared_dir / f'{os.getpid()}.json'
+
+    def _write_snapshot(self):
+        path = self._snapshot_path()
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        tmp_path.write_text(json.dumps(self.snapshot()))
+        os.replace(tmp_path, path)
+
+    def _read_snapshots(self) -> dict[str, dict]:
+        """Snapshots of the other workers, by pid. Those that aren't updated
+        anymore (e.g. of a worker killed) are removed."""
+        snapshots = {}
+        own = self._snapshot_path()
+        for path in self._shared_dir.glob('*.json'):
+            if path == own:
+                continue
+            try:
+                if time.time() - path.stat().st_mtime > self._share_interval * STALE_AFTER:
+                    path.unlink()
+                    continue
+                snapshots[path.stem] = json.loads(path.read_text())
+            except (OSError, ValueError):
+                # Removed or replaced in the meantime
+                continue
+        return snapshots
+
+    def snapshot(self) -> dict:
+        """Current values of the metrics, JSON-serializable."""
+        with self._lock:
+            requests = [[path_class, status, count] for (path_class, status), count in self._requests.items()]
+            n_bytes = dict(self._bytes)
+            latencies = {k: [list(counts), total] for k, (counts, total) in self._latencies.items()}
+            connections = self.connections
+
+        cache_counts: defaultdict[tuple[str, str], int] = defaultdict(int)
+        for name, cache, counters in self._caches:
+            for result, attribute in counters.items():
+                cache_counts[name, result] += getattr(cache, attribute)
+        return {
+            'requests': requests,
+            'bytes': n_bytes,
+            'latencies': latencies,
+            'connections': connections,
+            'gauges': {name: [help, getattr(source, attribute)] for name, help, source, attribute in self._gauges},
+            'caches': [[name, result, count] for (name, result), count in cache_counts.items()],
+        }
+
+    def render(self) -> bytes:
+        """Current metrics, in the Prometheus text exposition format. When
+        shared, the metrics of all the workers, with a `worker` label."""
+        if self._shared_dir is None:
+            snapshots = {None: self.snapshot()}
+        else:
+            snapshots = {str(os.getpid()): self.snapshot(), **self._read_snapshots()}
+        workers = sorted(snapshots, key=lambda worker: worker or '')
+
+        def labels(worker: str | None, values: dict = None) -> str:
+            values = values or {}
+            if worker is not None:
+                values = {'worker': worker, **values}
+            if not values:
+                return ''
+            return '{' + ','.join(f'{name}="{value}"' for name, value in values.items()) + '}'
+
+        lines = [
+            '# HELP appa_http_requests_total Requests handled, by path class and status code.',
+            '# TYPE appa_http_requests_total counter',
+        ]
+        for worker in workers:
+            for path_class, status, count in sorted(snapshots[worker]['requests']):
+                lines.append(f'appa_http_requests_total{labels(worker, {"class": path_class, "status": status})} {count}')
+
+        lines += [
+            '# HELP appa_http_response_bytes_total Bytes of response bodies sent, by path class.',
+            '# TYPE appa_http_response_bytes_total counter',
+        ]
+        for worker in workers:
+            for path_class, count in sorted(snapshots[worker]['bytes'].items()):
+                lines.append(f'appa_http_response_bytes_total{labels(worker, {"class": path_class})} {count}')
+
+        lines += [
+            '# HELP appa_http_request_duration_seconds Time taken to handle requests, by path class.',
+            '# TYPE appa_http_request_duration_seconds histogram',
+        ]
+        for worker in workers:
+            for path_class, (counts, total) in sorted(snapshots[worker]['latencies'].items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'appa_http_request_duration_seconds_bucket'
+                                 f'{labels(worker, {"class": path_class, "le": bound})} {cumulative}')
+                lines.append(f'appa_http_request_duration_seconds_sum{labels(worker, {"class": path_class})} {total}')
+                lines.append(f'appa_http_request_duration_seconds_count{labels(worker, {"class": path_class})} {cumulative}')
+
+        lines += [
+            '# HELP appa_http_connections Open client connections.',
+            '# TYPE appa_http_connections gauge',
+        ]
+        for worker in workers:
+            lines.append(f'appa_http_connections{labels(worker)} {snapshots[worker]["connections"]}')
+        for name, help, _, _ in self._gauges:
+            lines += [
+                f'# HELP {name} {help}',
+                f'# TYPE {name} gauge',
+            ]
+            for worker in workers:
+                if name in snapshots[worker]['gauges']:
+                    lines.append(f'{name}{labels(worker)} {snapshots[worker]["gauges"][name][1]}')
+
+        if any(snapshots[worker]['caches'] for worker in workers):
+            lines += [
+                '# HELP appa_cache_requests_total Cache lookups, by cache and result.',
+                '# TYPE appa_cache_requests_total counter',
+            ]
+            for worker in workers:
+                for name, result, count in sorted(snapshots[worker]['caches']):
+                    lines.append(f'appa_cache_requests_total{labels(worker, {"cache": name, "result": result})} {count}')
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
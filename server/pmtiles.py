@@ -0,0 +1,356 @@
+# Minimal reader for PMTiles v3 archives, as written by `pmtiles convert` in
+# `tiler.gen_tiles`. Only what is needed to find the byte range of a tile is
+# implemented, along with a writer of simple archives used to generate
+# synthetic data for load tests. Specification:
+#   https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+from collections import OrderedDict
+from pathlib import Path
+
+import threading
+import struct
+import gzip
+import os
+
+from server.file_cache import MappedFile, MappedFileCache
+
+HEADER_SIZE = 127
+
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+
+TILE_TYPE_MIME = {
+    1: 'application/vnd.mapbox-vector-tile',
+    2: 'image/png',
+    3: 'image/jpeg',
+    4: 'image/webp',
+    5: 'image/avif',
+}
+
+# Directories are nested at most this deep (root + 3 levels of leaves)
+MAX_DIRECTORY_DEPTH = 4
+
+# Clients read the header and root directory with a single request of this
+# many bytes, so the root directory must fit in it
+ROOT_REQUEST_SIZE = 16384
+
+class Header:
+    """Fields of the fixed-size PMTiles header that are required to read tiles.
+
+    Args:
+        data (bytes): First `HEADER_SIZE` bytes of the archive
+
+    Raises:
+        ValueError: If `data` is not a PMTiles v3 header
+    """
+    def __init__(self, data: bytes):
+        if len(data) < HEADER_SIZE or data[:7] != b'PMTiles' or data[7] != 3:
+            raise ValueError('Not a PMTiles v3 archive')
+        (self.root_offset, self.root_length,
+         self.metadata_offset, self.metadata_length,
+         self.leaf_offset, self.leaf_length,
+         self.data_offset, self.data_length,
+         self.addressed_tiles, self.tile_entries, self.tile_contents) = \
+            struct.unpack_from('<11Q', data, 8)
+        (self.clustered, self.internal_compression, self.tile_compression,
+         self.tile_type, self.min_zoom, self.max_zoom) = struct.unpack_from('<6B', data, 96)
+
+class Archive:
+    """A PMTiles archive whose directories are parsed on demand and kept in
+    memory, so that finding a tile doesn't require any read besides the tile
+    itself once the directories are cached.
+
+    Args:
+        source (MappedFile): Memory-mapped archive
+
+    Raises:
+        ValueError: If the file is not a supported PMTiles archive
+    """
+    def __init__(self, source: MappedFile):
+        self.source = source
+        self.header = Header(bytes(source.read(0, HEADER_SIZE - 1)))
+        self.mime_type = TILE_TYPE_MIME.get(self.header.tile_type, 'application/octet-stream')
+        self.root = self._read_directory(self.header.root_offset, self.header.root_length)
+        self._leaves: dict[int, list[tuple[int, int, int, int]]] = {}
+        self._lock = threading.Lock()
+
+    def find_tile(self, z: int, x: int, y: int) -> tuple[int, int] | None:
+        """Find where the tile at (z, x, y) is stored.
+
+        Args:
+            z (int): Zoom level
+            x (int): Tile column
+            y (int): Tile row (XYZ scheme, 0 at the top)
+
+        Returns:
+            tuple[int, int] | None: (offset, length) of the tile data in the
+                archive, or `None` if the archive doesn't contain the tile.
+        """
+        if z < self.header.min_zoom or z > self.header.max_zoom:
+            return None
+        tile_id = zxy_to_tile_id(z, x, y)
+        directory = self.root
+        for _ in range(MAX_DIRECTORY_DEPTH):
+            entry = find_entry(directory, tile_id)
+            if entry is None:
+                return None
+            _, offset, length, run_length = entry
+            if run_length > 0:
+                return self.header.data_offset + offset, length
+            directory = self._leaf(offset, length)
+        return None
+
+    def _leaf(self, offset: int, length: int) -> list[tuple[int, int, int, int]]:
+        leaf = self._leaves.get(offset)
+        if leaf is None:
+            leaf = self._read_directory(self.header.leaf_offset + offset, length)
+            with self._lock:
+                self._leaves[offset] = leaf
+        return leaf
+
+    def _read_directory(self, offset: int, length: int) -> list[tuple[int, int, int, int]]:
+        data = bytes(self.source.read(offset, offset + length - 1))
+        if self.header.internal_compression == COMPRESSION_GZIP:
+            data = gzip.decompress(data)
+        elif self.header.internal_compression != COMPRESSION_NONE:
+            raise ValueError('Unsupported PMTiles internal compression '
+                             f'{self.header.internal_compression}')
+        return deserialize_directory(data)
+
+class ArchiveCache:
+    """Thread-safe LRU cache of parsed `Archive` objects. Archives are re-parsed
+    when the underlying file changes on disk.
+
+    Args:
+        file_cache (MappedFileCache): Cache from which archives are mapped
+        max_archives (int, optional): Maximum number of parsed archives kept in
+            memory. Defaults to 256.
+    """
+    def __init__(self, file_cache: MappedFileCache, max_archives: int = 256):
+        self.file_cache = file_cache
+        self.max_archives = max_archives
+        self.hits = 0
+        self.misses = 0
+        self._archives: OrderedDict[str, Archive] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: os.PathLike) -> Archive:
+        """Get the parsed archive at `path`.
+
+        Raises:
+            OSError: If the file can't be opened
+            ValueError: If the file is not a supported PMTiles archive
+        """
+        path = os.fspath(path)
+        source = self.file_cache.get(path)
+        with self._lock:
+            archive = self._archives.get(path)
+            if archive is not None and archive.source is source:
+                self._archives.move_to_end(path)
+                self.hits += 1
+                return archive
+            self.misses += 1
+
+        archive = Archive(source)
+        with self._lock:
+            self._archives[path] = archive
+            self._archives.move_to_end(path)
+            while len(self._archives) > self.max_archives:
+                self._archives.popitem(last=False)
+        return archive
+
+    def preload(self, directory: os.PathLike) -> int:
+        """Parse every `.pmtiles` archive under `directory`, most recently
+        modified first, until the cache is full.
+
+        Returns:
+            int: Number of archives loaded
+        """
+        paths = sorted(Path(directory).rglob('*.pmtiles'),
+                       key=lambda p: p.stat().st_mtime, reverse=True)
+        loaded = 0
+        for path in paths[:self.max_archives]:
+            try:
+                self.get(path)
+                loaded += 1
+            except (OSError, ValueError):
+                pass
+        return loaded
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """Read an unsigned LEB128 varint.
+
+    Returns:
+        (value, pos) (tuple[int, int]): Decoded value and position after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def deserialize_directory(data: bytes) -> list[tuple[int, int, int, int]]:
+    """Decode a (decompressed) PMTiles directory.
+
+    Returns:
+        list[tuple[int, int, int, int]]: (tile_id, offset, length, run_length)
+            entries, sorted by tile ID. A run length of 0 denotes a leaf
+            directory.
+    """
+    n, pos = read_varint(data, 0)
+    tile_ids = [0] * n
+    run_lengths = [0] * n
+    lengths = [0] * n
+    offsets = [0] * n
+
+    last_id = 0
+    for i in range(n):
+        delta, pos = read_varint(data, pos)
+        last_id += delta
+        tile_ids[i] = last_id
+    for i in range(n):
+        run_lengths[i], pos = read_varint(data, pos)
+    for i in range(n):
+        lengths[i], pos = read_varint(data, pos)
+    for i in range(n):
+        value, pos = read_varint(data, pos)
+        if value == 0 and i > 0:
+            # Tile data directly follows the previous entry
+            offsets[i] = offsets[i - 1] + lengths[i - 1]
+        else:
+            offsets[i] = value - 1
+    return list(zip(tile_ids, offsets, lengths, run_lengths))
+
+def find_entry(entries: list[tuple[int, int, int, int]],
+               tile_id: int) -> tuple[int, int, int, int] | None:
+    """Binary search of the directory entry containing `tile_id`, which is
+    either a tile run or a leaf directory."""
+    low, high = 0, len(entries) - 1
+    while low <= high:
+        mid = (low + high) >> 1
+        diff = tile_id - entries[mid][0]
+        if diff > 0:
+            low = mid + 1
+        elif diff < 0:
+            high = mid - 1
+        else:
+            return entries[mid]
+    if high >= 0:
+        entry = entries[high]
+        if entry[3] == 0 or tile_id - entry[0] < entry[3]:
+            return entry
+    return None
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    """Convert tile coordinates to a PMTiles tile ID (position on the Hilbert
+    curve of zoom `z`, offset by the number of tiles of all lower zooms).
+
+    Raises:
+        ValueError: If the coordinates are out of bounds
+    """
+    n = 1 << z
+    if z > 31 or not (0 <= x < n and 0 <= y < n):
+        raise ValueError(f'Invalid tile coordinates {z}/{x}/{y}')
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+def write_varint(out: bytearray, value: int):
+    """Append an unsigned LEB128 varint to `out`."""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def serialize_directory(entries: list[tuple[int, int, int, int]]) -> bytes:
+    """Encode a PMTiles directory (uncompressed), the reverse of
+    `deserialize_directory`."""
+    out = bytearray()
+    write_varint(out, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(out, tile_id - last_id)
+        last_id = tile_id
+    for entry in entries:
+        write_varint(out, entry[3])
+    for entry in entries:
+        write_varint(out, entry[2])
+    for i, (_, offset, _, _) in enumerate(entries):
+        previous = entries[i - 1] if i > 0 else None
+        if previous is not None and offset == previous[1] + previous[2]:
+            write_varint(out, 0)
+        else:
+            write_varint(out, offset + 1)
+    return bytes(out)
+
+def write_archive(path: os.PathLike,
+                  tiles: dict[tuple[int, int, int], bytes],
+                  tile_type: int = 2):
+    """Write a clustered PMTiles archive with gzip-compressed directories,
+    split into leaf directories when the root directory would not fit in
+    `ROOT_REQUEST_SIZE`. Tiles are not deduplicated.
+
+    Args:
+        path (os.PathLike): Path of the archive
+        tiles (dict[tuple[int, int, int], bytes]): (z, x, y) -> tile data
+        tile_type (int, optional): PMTiles tile type. Defaults to 2 (PNG).
+    """
+    ordered = sorted((zxy_to_tile_id(*zxy), data) for zxy, data in tiles.items())
+    entries = []
+    offset = 0
+    for tile_id, data in ordered:
+        entries.append((tile_id, offset, len(data), 1))
+        offset += len(data)
+
+    root = gzip.compress(serialize_directory(entries), mtime=0)
+    leaves = b''
+    leaf_size = 4096
+    while len(root) > ROOT_REQUEST_SIZE - HEADER_SIZE:
+        leaf_data = bytearray()
+        root_entries = []
+        for i in range(0, len(entries), leaf_size):
+            leaf = gzip.compress(serialize_directory(entries[i:i + leaf_size]), mtime=0)
+            root_entries.append((entries[i][0], len(leaf_data), len(leaf), 0))
+            leaf_data += leaf
+        root = gzip.compress(serialize_directory(root_entries), mtime=0)
+        leaves = bytes(leaf_data)
+        leaf_size *= 2
+
+    metadata = gzip.compress(b'{}', mtime=0)
+    zooms = [z for z, _, _ in tiles] or [0]
+    root_offset = HEADER_SIZE
+    metadata_offset = root_offset + len(root)
+    leaf_offset = metadata_offset + len(metadata)
+    data_offset = leaf_offset + len(leaves)
+    header = b'PMTiles' + bytes([3]) + struct.pack(
+        '<11Q6B4iB2i',
+        root_offset, len(root),
+        metadata_offset, len(metadata),
+        leaf_offset, len(leaves),
+        data_offset, offset,
+        len(entries), len(entries), len(entries),
+        1, COMPRESSION_GZIP, COMPRESSION_NONE, tile_type, min(zooms), max(zooms),
+        -1800000000, -850511287, 1800000000, 850511287,
+        0, 0, 0
+    )
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(root)
+        f.write(metadata)
+        f.write(leaves)
+        for _, data in ordered:
+            f.write(data)
@@ -0,0 +1,249 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import threading
+import math
+import os
+
+from server.tile_cache import SingleFlight
+
+INTERPOLATION_METHODS = ['bilinear', 'nearest']
+
+class PointQuery:
+    """Extracts the values of a decoded forecast `.zarr` file at arbitrary
+    points, for all lead times at once. Decoded zarr chunks are kept in a
+    bounded LRU cache, so that repeated queries in the same region don't read
+    or decompress anything.
+
+    This requires `xarray` and `numpy`, which are only imported when a query
+    object is created.
+
+    Args:
+        zarr_path (os.PathLike): Path to the forecast `.zarr` file. Its stem is
+            the run identifier.
+        max_cache_bytes (int, optional): Maximum total size of the decoded
+            chunks kept in memory. Defaults to 1 GB.
+    """
+    def __init__(self, zarr_path: os.PathLike, max_cache_bytes: int = 1024 ** 3):
+        import xarray as xr
+
+        self.run = Path(zarr_path).stem
+        # Without dask, indexing only reads the chunks that are needed
+        self.dataset = xr.open_zarr(zarr_path, chunks=None)
+        self.max_cache_bytes = max_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self.latitudes = self.dataset['latitude'].to_numpy()
+        self.longitudes = self.dataset['longitude'].to_numpy()
+        self.levels = [int(level) for level in self.dataset['level'].to_numpy()] \
+            if 'level' in self.dataset.coords else []
+        self.times = [str(t)[:19] + 'Z' for t in self.dataset['time'].to_numpy()]
+
+        self._blocks: OrderedDict[tuple, object] = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def query(self,
+              latitudes: list[float],
+              longitudes: list[float],
+              variables: list[str] = None,
+              levels: list[int] = None,
+              method: str = 'bilinear') -> dict:
+        """Get the values of variables at the given points, for all times.
+
+        Args:
+            latitudes (list[float]): Latitudes of the points, in degrees
+            longitudes (list[float]): Longitudes of the points, in degrees (any
+                range)
+            variables (list[str], optional): Variables to extract. If `None`,
+                all variables are extracted. Defaults to `None`.
+            levels (list[int], optional): Pressure levels (hPa) to extract for
+                pressure level variables. If `None`, all levels are extracted.
+                Defaults to `None`.
+            method (str, optional): `bilinear` or `nearest`. Defaults to
+                'bilinear'.
+
+        Raises:
+            ValueError: If an argument is invalid
+
+        Returns:
+            dict: JSON-serializable result, with `values[variable][point][time]`
+                for single level variables and
+                `values[variable][level][point][time]` for pressure level
+                variables. Missing values are `None`.
+        """
+        import numpy as np
+
+        if method not in INTERPOLATION_METHODS:
+            raise ValueError(f'Unknown interpolation method {method}')
+        if len(latitudes) != len(longitudes) or not latitudes:
+            raise ValueError('lat and lon must have the same, non-zero number of values')
+        lats = np.asarray(latitudes, dtype=float)
+        lons = np.asarray(longitudes, dtype=float)
+        if not np.all(np.abs(lats) <= 90) or not np.all(np.isfinite(lons)):
+            raise ValueError('Invalid coordinates')
+
+        variables = list(self.dataset.data_vars) if variables is None else variables
+        for variable in variables:
+            if variable not in self.dataset.data_vars:
+                raise ValueError(f'Unknown variable {variable}')
+        levels = self.levels if levels is None else levels
+        for level in levels:
+            if level not in self.levels:
+                raise ValueError(f'Unknown level {level}')
+
+        rows, cols, weights = self.interpolation_indices(lats, lons, method)
+
+        values = {}
+        for variable in variables:
+            if 'level' in self.dataset[variable].dims:
+                values[variable] = {
+                    str(level): _to_json(self._interpolate(
+                        variable, self.levels.index(level), rows, cols, weights))
+                    for level in levels
+                }
+            else:
+                values[variable] = _to_json(self._interpolate(variable, None, rows, cols, weights))
+
+        return {
+            'run': self.run,
+            'method': method,
+            'times': self.times,
+            'points': [{'lat': float(lat), 'lon': float(lon)} for lat, lon in zip(lats, lons)],
+            'units': {v: self.dataset[v].attrs.get('units') for v in variables},
+            'values': values,
+        }
+
+    def interpolation_indices(self, lats, lons, method: str = 'bilinear'):
+        """Compute the grid indices and weights used to interpolate at points.
+        **This expects a regular grid covering all longitudes.**
+
+        Args:
+            lats (np.ndarray): 1D array of latitudes
+            lons (np.ndarray): 1D array of longitudes
+            method (str, optional): `bilinear` or `nearest`. Defaults to
+                'bilinear'.
+
+        Returns:
+            (rows, cols, weights) (tuple[np.ndarray, np.ndarray, np.ndarray]):
+                Arrays of shape (points, neighbours), with 4 neighbours for
+                bilinear interpolation and 1 for nearest.
+        """
+        import numpy as np
+
+        n_lat, n_lon = len(self.latitudes), len(self.longitudes)
+        lat_step = self.latitudes[1] - self.latitudes[0]
+        lon_step = self.longitudes[1] - self.longitudes[0]
+        frac_rows = np.clip((lats - self.latitudes[0]) / lat_step, 0, n_lat - 1)
+        frac_cols = ((lons - self.longitudes[0]) % 360) / lon_step
+
+        if method == 'nearest':
+            rows = np.clip(np.rint(frac_rows).astype(int), 0, n_lat - 1)[:, None]
+            cols = (np.rint(frac_cols).astype(int) % n_lon)[:, None]
+            return rows, cols, np.ones(rows.shape)
+
+        row0 = np.minimum(np.floor(frac_rows).astype(int), n_lat - 2)
+        col0 = np.floor(frac_cols).astype(int)
+        wr = frac_rows - row0
+        wc = frac_cols - col0
+        col0 %= n_lon
+        col1 = (col0 + 1) % n_lon
+        rows = np.stack([row0, row0, row0 + 1, row0 + 1], axis=-1)
+        cols = np.stack([col0, col1, col0, col1], axis=-1)
+        weights = np.stack([(1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc], axis=-1)
+        return rows, cols, weights
+
+    def _interpolate(self, variable: str, ilevel: int | None, rows, cols, weights):
+        """Interpolated values of a variable, of shape (points, times)."""
+        neighbours = self.gather(variable, ilevel, rows, cols) # (times, points, neighbours)
+        return (neighbours * weights[None]).sum(axis=-1).T
+
+    def gather(self, variable: str, ilevel: int | None, rows, cols, itime: int = None):
+        """Values of a variable at grid indices, for all times or a single one.
+
+        Args:
+            variable (str): Variable name
+            ilevel (int | None): Index of the pressure level, or `None` for
+                single level variables
+            rows (np.ndarray): Latitude indices
+            cols (np.ndarray): Longitude indices, of the same shape as `rows`
+            itime (int, optional): Index of the time to read. Only the chunks
+                holding this time are read. If `None`, all times are read.
+                Defaults to `None`.
+
+        Returns:
+            np.ndarray: Array of shape (times, *rows.shape), with a single time
+                if `itime` is given
+        """
+        import numpy as np
+
+        chunks = self._chunk_sizes(variable)
+        n_times = len(self.times)
+        if itime is None:
+            time_chunks = range(math.ceil(n_times / chunks['time']))
+        else:
+            time_chunks = [itime // chunks['time']]
+        flat_rows, flat_cols = rows.ravel(), cols.ravel()
+        out = np.empty((n_times if itime is None else 1, flat_rows.size), dtype=np.float64)
+
+        n_lon_chunks = math.ceil(len(self.longitudes) / chunks['longitude'])
+        block_ids = (flat_rows // chunks['latitude']) * n_lon_chunks + flat_cols // chunks['longitude']
+        level_chunk = None if ilevel is None else ilevel // chunks['level']
+        for block_id in np.unique(block_ids):
+            selected = block_ids == block_id
+            lat_chunk, lon_chunk = divmod(int(block_id), n_lon_chunks)
+            local_rows = flat_rows[selected] - lat_chunk * chunks['latitude']
+            local_cols = flat_cols[selected] - lon_chunk * chunks['longitude']
+            for time_chunk in time_chunks:
+                block = self._block(variable, time_chunk, level_chunk, lat_chunk, lon_chunk)
+                if ilevel is not None:
+                    block = block[:, ilevel - level_chunk * chunks['level']]
+                first = time_chunk * chunks['time']
+                if itime is None:
+                    out[first:first + block.shape[0], selected] = block[:, local_rows, local_cols]
+                else:
+                    out[0, selected] = block[itime - first, local_rows, local_cols]
+        return out.reshape((out.shape[0],) + rows.shape)
+
+    def _chunk_sizes(self, variable: str) -> dict[str, int]:
+        data = self.dataset[variable]
+        preferred = data.encoding.get('preferred_chunks', {})
+        chunks = data.encoding.get('chunks') or data.shape
+        return {dim: preferred.get(dim, size) for dim, size in zip(data.dims, chunks)}
+
+    def _block(self, variable: str, time_chunk: int, level_chunk: int | None,
+               lat_chunk: int, lon_chunk: int):
+        """Decoded zarr chunk of a variable, from the cache if possible."""
+        key = (variable, time_chunk, level_chunk, lat_chunk, lon_chunk)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        def read():
+            chunks = self._chunk_sizes(variable)
+            indexers = {
+                'time': slice(time_chunk * chunks['time'], (time_chunk + 1) * chunks['time']),
+                'latitude': slice(lat_chunk * chunks['latitude'], (lat_chunk + 1) * chunks['latitude']),
+                'longitude': slice(lon_chunk * chunks['longitude'], (lon_chunk + 1) * chunks['longitude']),
+            }
+            if level_chunk is not None:
+                indexers['level'] = slice(level_chunk * chunks['level'], (level_chunk + 1) * chunks['level'])
+            block = self.dataset[variable].isel(indexers).transpose('time', ...).to_numpy()
+            with self._lock:
+                self._blocks[key] = block
+                self._cache_bytes += block.nbytes
+                while self._cache_bytes > self.max_cache_bytes and len(self._blocks) > 1:
+                    _, evicted = self._blocks.popitem(last=False)
+                    self._cache_bytes -= evicted.nbytes
+            return block
+
+        return self._single_flight.do(key, read)
+
+def _to_json(values) -> list[list[float | None]]:
+    """Convert a 2D float array to nested lists, with NaN values as `None`."""
+    return [[None if math.isnan(v) else v for v in row] for row in values.tolist()]
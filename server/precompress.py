@@ -0,0 +1,33 @@
+# Writes the precompressed siblings (`file.json.gz`, `file.json.br`) of the
+# text files of a directory, which the server sends instead of compressing
+# the files itself. Brotli siblings are only written if `brotli` is installed.
+#
+# Usage: python -m server.precompress [-h] DIRECTORY
+
+from pathlib import Path
+
+import mimetypes
+import argparse
+
+from server.compression import ENCODINGS, MIN_SIZE, available_encodings, compress, is_compressible
+
+def main():
+    parser = argparse.ArgumentParser(description='Write precompressed siblings of the text files of a directory.')
+    parser.add_argument('directory', help='Directory to process recursively')
+    args = parser.parse_args()
+
+    suffixes = tuple(ENCODINGS.values())
+    for path in sorted(Path(args.directory).rglob('*')):
+        if not path.is_file() or path.suffix in suffixes or path.stat().st_size < MIN_SIZE:
+            continue
+        content_type, _ = mimetypes.guess_type(path)
+        if content_type is None or not is_compressible(content_type):
+            continue
+        data = path.read_bytes()
+        for encoding in available_encodings():
+            compressed = compress(data, encoding)
+            Path(str(path) + ENCODINGS[encoding]).write_bytes(compressed)
+            print(f'{path}{ENCODINGS[encoding]}: {len(data)} -> {len(compressed)} bytes')
+
+if __name__ == '__main__':
+    main()
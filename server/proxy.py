@@ -0,0 +1,465 @@
+# Caching reverse-proxy mode of the server. Files are fetched from an origin
+# (e.g. the S3 bucket to which the pipeline uploads) instead of the served
+# directory, with byte range requests, and kept in a sparse on-disk cache:
+# only the fixed-size blocks that were requested are stored, so that serving
+# a few tiles of a large PMTiles archive doesn't download the whole archive.
+#
+# - Blocks are evicted in least recently used order once the cache exceeds its
+#   size. The order is kept across restarts, and shared by the workers, with the
+#   files' modification times. Each worker may write its share of the free
+#   space before scanning the directory again, which counts the blocks written
+#   by all the workers and evicts the least recently used ones.
+# - Concurrent requests needing the same blocks wait for the fetch in progress
+#   instead of fetching them again, and the missing blocks of a request are
+#   fetched with one origin request per contiguous run.
+# - The metadata of each file (size, ETag) is revalidated with a conditional
+#   request once it is older than a few seconds. Blocks are keyed by path and
+#   ETag, so a changed file never mixes old and new blocks.
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+import email.utils
+import http.client
+import urllib.parse
+import threading
+import hashlib
+import time
+import os
+
+from server.tile_cache import SingleFlight
+
+# Size of the cached blocks. PMTiles clients mostly request directories and
+# tiles of a few KiB to a few hundred KiB.
+BLOCK_SIZE = 256 * 1024
+
+# Seconds after which the metadata of a file is revalidated with the origin
+REVALIDATE_AFTER = 60
+
+# Maximum number of bytes fetched before sending a response's headers, so that
+# origin errors can still be reported with a status code. The rest of larger
+# responses is fetched while it is sent.
+PREFETCH_MAX = 16 * 1024 ** 2
+
+# Maximum number of blocks fetched with a single origin request
+MAX_FETCH_BLOCKS = 64
+
+# Fraction of the cache size to which it is evicted after a scan, so that the
+# directory isn't scanned again on every new block
+EVICT_TO = 0.9
+
+ORIGIN_TIMEOUT = 30
+
+class OriginError(Exception):
+    """Raised when the origin doesn't return a file.
+
+    Args:
+        status (int): Status code to send to the client
+        message (str): Description of the error
+    """
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class Origin:
+    """HTTP client of the origin, keeping one persistent connection per thread.
+
+    Args:
+        url (str): Base URL of the origin (`http` or `https`), to which request
+            paths are appended
+        timeout (float, optional): Socket timeout in seconds. Defaults to
+            `ORIGIN_TIMEOUT`.
+    """
+    def __init__(self, url: str, timeout: float = ORIGIN_TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'Invalid origin URL {url}')
+        self.url = url
+        self.timeout = timeout
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self._netloc = parts.netloc
+        self._base_path = parts.path.rstrip('/')
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, headers: dict[str, str]) -> tuple[int, http.client.HTTPMessage, bytes]:
+        """Send a request to the origin.
+
+        Args:
+            method (str): `GET` or `HEAD`
+            path (str): Path of the file, relative to the origin's URL
+            headers (dict[str, str]): Request headers
+
+        Raises:
+            OriginError: If the origin can't be reached
+
+        Returns:
+            tuple[int, http.client.HTTPMessage, bytes]: Status code, headers
+                and body of the response
+        """
+        url = self._base_path + urllib.parse.quote(path)
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            reused = connection is not None
+            if connection is None:
+                connection = self._connection_class(self._netloc, timeout=self.timeout)
+                self._local.connection = connection
+            try:
+                connection.request(method, url, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                self._local.connection = None
+                # The origin may have closed an idle keep-alive connection
+                if reused and attempt == 0:
+                    continue
+                raise OriginError(502, f'Origin request failed: {e}') from e
+            if response.will_close:
+                connection.close()
+                self._local.connection = None
+            return response.status, response.headers, body
+
+class ProxiedObject:
+    """A file of the origin, as known from its last validation. It can be
+    served like an `OpenedFile`, its reads going through the cache.
+
+    Args:
+        cache (ProxyCache): Cache from which it is read
+        path (str): Path of the file
+        size (int): Size of the file, in bytes
+        etag (str): Entity tag of the file, given by the origin
+        mtime (float): Modification time of the file
+        content_type (str | None): Content type given by the origin
+    """
+    def __init__(self, cache: 'ProxyCache', path: str, size: int, etag: str, mtime: float, content_type: str | None):
+        self.cache = cache
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.mtime = mtime
+        self.content_type = content_type
+        self.checked = time.monotonic()
+        # Blocks of different versions of the file never share a key
+        self.digest = hashlib.sha1(f'{path}\0{etag}'.encode('utf-8')).hexdigest()
+
+    def read(self, first: int, last: int) -> bytes:
+        """Read the bytes from position `first` to `last`, both included."""
+        return self.cache.read(self, first, last)
+
+    def prefetch(self, byte_ranges: list[tuple[int, int]]):
+        """Make sure that the first `PREFETCH_MAX` bytes of the ranges are
+        cached, fetching the missing blocks before the response is sent."""
+        budget = PREFETCH_MAX
+        for first, last in byte_ranges:
+            if budget <= 0:
+                break
+            last = min(last, first + budget - 1)
+            budget -= last - first + 1
+            self.cache.get_blocks(self, first // self.cache.block_size, last // self.cache.block_size, keep=False)
+
+    def close(self):
+        pass
+
+class ProxyCache:
+    """Sparse, block-aligned on-disk LRU cache of the files of an origin.
+
+    Args:
+        origin (Origin): Origin from which files are fetched
+        disk_dir (os.PathLike): Directory of the cache
+        max_bytes (int, optional): Maximum total size of the cached blocks.
+            Defaults to 10 GB.
+        block_size (int, optional): Size of the blocks, in bytes. Defaults to
+            `BLOCK_SIZE`.
+        revalidate_after (float, optional): Seconds after which the metadata of
+            a file is revalidated. Defaults to `REVALIDATE_AFTER`.
+        max_objects (int, optional): Maximum number of files whose metadata is
+            kept in memory. Defaults to 65536.
+        workers (int, optional): Number of processes sharing the directory.
+            Defaults to 1.
+    """
+    def __init__(self,
+                 origin: Origin,
+                 disk_dir: os.PathLike,
+                 max_bytes: int = 10 * 1024 ** 3,
+                 block_size: int = BLOCK_SIZE,
+                 revalidate_after: float = REVALIDATE_AFTER,
+                 max_objects: int = 65536,
+                 workers: int = 1):
+        self.origin = origin
+        self.disk_dir = Path(disk_dir)
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.revalidate_after = revalidate_after
+        self.max_objects = max_objects
+        self.workers = workers
+        # Block lookups
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.revalidations = 0
+        self._objects: OrderedDict[str, ProxiedObject] = OrderedDict()
+        self._blocks: OrderedDict[Path, int] = OrderedDict() # path -> size
+        self._bytes = 0
+        # Bytes this process may write before the directory is scanned again
+        self._allowance = 0
+        # Blocks written since the last scan started
+        self._written: set[Path] = set()
+        self._in_flight: dict[Path, Future] = {}
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        # Rebuild the LRU order from the access times of a previous run,
+        # stored as modification times
+        self._evict()
+
+    def stat(self, path: str) -> ProxiedObject:
+        """Get the metadata of a file, revalidated with the origin if needed.
+
+        Args:
+            path (str): Path of the file, e.g. `/tiles/run/sst/h0.pmtiles`
+
+        Raises:
+            OriginError: If the origin doesn't have the file, or can't be
+                reached
+
+        Returns:
+            ProxiedObject: The file
+        """
+        with self._lock:
+            obj = self._objects.get(path)
+            if obj is not None:
+                self._objects.move_to_end(path)
+        if obj is not None and time.monotonic() - obj.checked < self.revalidate_after:
+            return obj
+        return self._single_flight.do(path, lambda: self._validate(path, obj))
+
+    def _validate(self, path: str, obj: ProxiedObject | None) -> ProxiedObject:
+        headers = {} if obj is None else {'If-None-Match': obj.etag}
+        status, response_headers, _ = self.origin.request('HEAD', path, headers)
+        with self._lock:
+            self.revalidations += 1
+        if status == 304 and obj is not None:
+            obj.checked = time.monotonic()
+            return obj
+        if status != 200:
+            with self._lock:
+                self._objects.pop(path, None)
+            if status in (403, 404):
+                raise OriginError(404, 'File not found')
+            raise OriginError(502, f'Origin responded with status {status}')
+
+        try:
+            size = int(response_headers['Content-Length'])
+        except (TypeError, ValueError):
+            raise OriginError(502, 'Origin response without Content-Length')
+        last_modified = response_headers.get('Last-Modified')
+        try:
+            mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            mtime = time.time()
+        # Origins without entity tags still identify versions by date and size
+        etag = response_headers.get('ETag') or f'"{size:x}-{int(mtime):x}"'
+        new = ProxiedObject(self, path, size, etag, mtime, response_headers.get('Content-Type'))
+
+        with self._lock:
+            self._objects[path] = new
+            self._objects.move_to_end(path)
+            while len(self._objects) > self.max_objects:
+                self._objects.popitem(last=False)
+            if obj is not None and obj.digest != new.digest:
+                # The old version's blocks will never be read again
+                for block_path in list(self._blocks):
+                    if block_path.name.startswith(obj.digest):
+                        self._remove(block_path)
+        return new
+
+    def read(self, obj: ProxiedObject, first: int, last: int) -> bytes:
+        """Read the bytes from position `first` to `last` (both included) of a
+        file, fetching the missing blocks from the origin."""
+        first_block, last_block = first // self.block_size, last // self.block_size
+        data = b''.join(self.get_blocks(obj, first_block, last_block))
+        offset = first - first_block * self.block_size
+        return data[offset:offset + last - first + 1]
+
+    def get_blocks(self, obj: ProxiedObject, first_block: int, last_block: int, keep: bool = True) -> list[bytes]:
+        """Get consecutive blocks of a file.
+
+        Args:
+            obj (ProxiedObject): File
+            first_block (int): Index of the first block
+            last_block (int): Index of the last block (included)
+            keep (bool, optional): Whether to return the blocks. If `False`,
+                they are only cached. Defaults to `True`.
+
+        Raises:
+            OriginError: If the blocks can't be fetched
+
+        Returns:
+            list[bytes]: Data of the blocks, or an empty list if `keep` is
+                `False`
+        """
+        cached = []
+        waiting: dict[int, Future] = {}
+        claimed: dict[int, Future] = {}
+        with self._lock:
+            for block in range(first_block, last_block + 1):
+                path = self._block_path(obj, block)
+                if path in self._blocks:
+                    self._blocks.move_to_end(path)
+                    self.hits += 1
+                    cached.append(block)
+                elif path in self._in_flight:
+                    self.coalesced += 1
+                    waiting[block] = self._in_flight[path]
+                else:
+                    self.misses += 1
+                    claimed[block] = self._in_flight[path] = Future()
+
+        blocks = {}
+        try:
+            self._fetch(obj, claimed, blocks)
+        finally:
+            with self._lock:
+                for block, future in claimed.items():
+                    del self._in_flight[self._block_path(obj, block)]
+                    if not future.done():
+                        future.set_exception(OriginError(502, 'Block fetch failed'))
+
+        for block in cached:
+            path = self._block_path(obj, block)
+            try:
+                data = path.read_bytes() if keep else None
+                os.utime(path)
+            except OSError:
+                # Evicted in the meantime (e.g. by another worker)
+                with self._lock:
+                    self._remove(path)
+                data = self.get_blocks(obj, block, block, keep)
+                data = data[0] if keep else None
+            if keep and len(data) != self._block_length(obj, block):
+                # Short, e.g. cut by a full disk: fetched again rather than served
+                with self._lock:
+                    self._remove(path)
+                data = self.get_blocks(obj, block, block)[0]
+            blocks[block] = data
+        for block, future in waiting.items():
+            blocks[block] = future.result()
+
+        if not keep:
+            return []
+        return [blocks[block] for block in range(first_block, last_block + 1)]
+
+    def _fetch(self, obj: ProxiedObject, claimed: dict[int, Future], blocks: dict[int, bytes]):
+        """Fetch the claimed blocks, with one origin request per contiguous
+        run of at most `MAX_FETCH_BLOCKS` blocks."""
+        runs = []
+        for block in sorted(claimed):
+            if runs and runs[-1][-1] == block - 1 and len(runs[-1]) < MAX_FETCH_BLOCKS:
+                runs[-1].append(block)
+            else:
+                runs.append([block])
+
+        for run in runs:
+            first = run[0] * self.block_size
+            last = min((run[-1] + 1) * self.block_size, obj.size) - 1
+            status, _, data = self.origin.request('GET', obj.path, {
+                'Range': f'bytes={first}-{last}',
+                'If-Match': obj.etag,
+            })
+            if status == 200 and len(data) == obj.size:
+                # The origin ignored the range
+                data = data[first:last + 1]
+            elif status == 412 or (status == 206 and len(data) != last - first + 1):
+                # The file changed since it was validated
+                obj.checked = -self.revalidate_after
+                raise OriginError(502, 'File changed on the origin, retry')
+            elif status != 206:
+                raise OriginError(502, f'Origin responded with status {status}')
+
+            for i, block in enumerate(run):
+                block_data = data[i * self.block_size:(i + 1) * self.block_size]
+                self._put(self._block_path(obj, block), block_data)
+                blocks[block] = block_data
+                claimed[block].set_result(block_data)
+
+    def _put(self, path: Path, data: bytes):
+        path.parent.mkdir(exist_ok=True)
+        # Unique across the workers sharing the directory
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            added = len(data) - self._blocks.pop(path, 0)
+            self._bytes += added
+            self._allowance -= added
+            self._blocks[path] = len(data)
+            self._written.add(path)
+            scan = self._allowance < 0
+        if scan:
+            self._evict()
+
+    def _evict(self):
+        """Count the blocks on disk, including those written by the other
+        workers, and evict the least recently used ones down to `EVICT_TO` of
+        the size if it is exceeded."""
+        # A single scan at a time, the other threads going on meanwhile
+        if not self._scan_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                self._written = set()
+            files = []
+            for entry in self._scan(self.disk_dir):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Evicted by another worker
+                    continue
+                files.append((stat.st_mtime, Path(entry.path), stat.st_size))
+            files.sort()
+            with self._lock:
+                # Blocks written by this process during the scan stay last
+                scanned = {path for _, path, _ in files}
+                written = [(path, self._blocks[path]) for path in self._written
+                           if path not in scanned and path in self._blocks]
+                self._blocks.clear()
+                self._bytes = 0
+                for path, size in [(path, size) for _, path, size in files] + written:
+                    self._blocks[path] = size
+                    self._bytes += size
+                if self._bytes > self.max_bytes:
+                    while self._bytes > self.max_bytes * EVICT_TO and self._blocks:
+                        self._remove(next(iter(self._blocks)))
+                # The other workers may write as much in the meantime
+                self._allowance = (self.max_bytes - self._bytes) // self.workers
+        finally:
+            self._scan_lock.release()
+
+    @staticmethod
+    def _scan(disk_dir: Path):
+        with os.scandir(disk_dir) as directories:
+            for directory in directories:
+                if not directory.is_dir():
+                    continue
+                try:
+                    with os.scandir(directory.path) as entries:
+                        yield from (entry for entry in entries if entry.name.endswith('.block'))
+                except OSError:
+                    continue
+
+    def _remove(self, path: Path):
+        # Must be called with the lock held
+        self._bytes -= self._blocks.pop(path, 0)
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+    def _block_length(self, obj: ProxiedObject, block: int) -> int:
+        return min(self.block_size, obj.size - block * self.block_size)
+
+    def _block_path(self, obj: ProxiedObject, block: int) -> Path:
+        return self.disk_dir / obj.digest[:2] / f'{obj.digest}.{block}.block'
@@ -0,0 +1,87 @@
+import re
+
+# Only the `bytes` unit is supported, which is the only one defined by RFC 9110
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+class RangeNotSatisfiable(ValueError):
+    """Raised when a syntactically valid Range header contains no range that
+    overlaps the resource."""
+
+def parse_range_header(header: str, size: int) -> list[tuple[int, int]] | None:
+    """Parse the value of an HTTP `Range` header into a list of byte ranges.
+
+    Args:
+        header (str): Value of the `Range` header, e.g. `bytes=0-499,-500`
+        size (int): Size of the resource, in bytes
+
+    Raises:
+        RangeNotSatisfiable: If no range of the header overlaps the resource
+
+    Returns:
+        list[tuple[int, int]] | None: List of (first, last) byte positions, both
+            included, in the order in which they were requested. `None` if the
+            header is malformed or uses another unit, in which case it must be
+            ignored and the full resource sent.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = _RANGE_SPEC.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first == '' and last == '':
+            return None
+
+        if first == '':
+            # Suffix range: the last `last` bytes of the resource
+            suffix = int(last)
+            if suffix == 0 or size == 0:
+                continue
+            first, last = max(0, size - suffix), size - 1
+        else:
+            first = int(first)
+            if last != '' and int(last) < first:
+                return None
+            if first >= size:
+                continue
+            last = size - 1 if last == '' else min(int(last), size - 1)
+        ranges.append((first, last))
+
+    if not ranges:
+        raise RangeNotSatisfiable(header)
+    return ranges
+
+def multipart_parts(ranges: list[tuple[int, int]],
+                    size: int,
+                    content_type: str,
+                    boundary: str) -> list[bytes | tuple[int, int]]:
+    """Build the parts of a `multipart/byteranges` body.
+
+    Args:
+        ranges (list[tuple[int, int]]): Satisfiable (first, last) byte ranges
+        size (int): Size of the complete resource, in bytes
+        content_type (str): Content type of the complete resource
+        boundary (str): Multipart boundary, not contained in the resource
+
+    Returns:
+        list[bytes | tuple[int, int]]: Alternating part headers and byte ranges,
+            followed by the closing boundary
+    """
+    parts = []
+    for first, last in ranges:
+        parts.append((f'\r\n--{boundary}\r\n'
+                      f'Content-Type: {content_type}\r\n'
+                      f'Content-Range: bytes {first}-{last}/{size}\r\n'
+                      '\r\n').encode('latin-1'))
+        parts.append((first, last))
+    parts.append(f'\r\n--{boundary}--\r\n'.encode('latin-1'))
+    return parts
+
+def parts_length(parts: list[bytes | memoryview | tuple[int, int]]) -> int:
+    """Total length in bytes of the parts returned by `multipart_parts`, or of
+    any list of literal parts and (first, last) byte ranges."""
+    return sum(p[1] - p[0] + 1 if isinstance(p, tuple) else len(p) for p in parts)
@@ -0,0 +1,260 @@
+from pathlib import Path
+
+import hashlib
+import json
+import math
+import os
+
+class RegionMasks:
+    """Area-weight masks of regions (countries, custom polygons) on the
+    forecast grid, stored sparsely: the flat indices of the grid cells whose
+    center lies in each region, and their cos(latitude) area weights. All
+    regions are concatenated, so that they can be aggregated together with
+    `np.ufunc.reduceat`.
+
+    This requires `numpy`, which is only imported when masks are created.
+
+    Args:
+        names (list[str]): Names of the regions
+        offsets (np.ndarray): Start of each region's cells in `indices`, with
+            the total number of cells appended
+        indices (np.ndarray): Flat (`row * n_lon + col`) indices of the cells
+        weights (np.ndarray): Area weight of each cell
+        shape (tuple[int, int]): Shape (latitude, longitude) of the grid
+    """
+    def __init__(self, names: list[str], offsets, indices, weights, shape: tuple[int, int]):
+        self.names = names
+        self.offsets = offsets
+        self.indices = indices
+        self.weights = weights
+        self.shape = shape
+
+    @classmethod
+    def from_geojson(cls,
+                     geojson_path: os.PathLike,
+                     latitudes,
+                     longitudes,
+                     cache_dir: os.PathLike = None,
+                     name_property: str = 'name') -> 'RegionMasks':
+        """Rasterize the polygons of a GeoJSON file, or load them from the
+        cache if the same file was already rasterized on the same grid.
+
+        Args:
+            geojson_path (os.PathLike): GeoJSON file holding a `Feature`, a
+                `FeatureCollection` or a geometry, whose `Polygon` and
+                `MultiPolygon` geometries are the regions
+            latitudes (np.ndarray): Latitudes of the grid, in degrees
+            longitudes (np.ndarray): Longitudes of the grid, in degrees,
+                regularly spaced and covering all longitudes
+            cache_dir (os.PathLike, optional): Directory in which masks are
+                cached. If `None`, masks are not cached. Defaults to `None`.
+            name_property (str, optional): Property holding the name of each
+                feature. Features without it are named after their `id`, or
+                their position in the file. Defaults to `name`.
+
+        Returns:
+            RegionMasks: Masks of the regions, in the order of the file
+        """
+        import numpy as np
+
+        data = Path(geojson_path).read_bytes()
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        key = hashlib.sha1()
+        for part in (data, name_property.encode('utf-8'), latitudes.tobytes(), longitudes.tobytes()):
+            key.update(part)
+        cache_path = None if cache_dir is None else Path(cache_dir) / f'{key.hexdigest()}.npz'
+        if cache_path is not None and cache_path.is_file():
+            return cls.load(cache_path)
+
+        regions = _geojson_regions(json.loads(data), name_property)
+        if not regions:
+            raise ValueError(f'No polygons in {geojson_path}')
+        cell_weights = np.cos(np.radians(latitudes))
+        names, offsets, indices = [], [0], []
+        for name, polygons in regions:
+            cells = np.unique(np.concatenate([rasterize(rings, latitudes, longitudes) for rings in polygons]))
+            if cells.size == 0:
+                # Smaller than a cell: use the cell nearest to its vertices'
+                # center
+                points = np.concatenate([np.asarray(rings[0], dtype=np.float64) for rings in polygons])
+                row = np.abs(latitudes - points[:, 1].mean()).argmin()
+                col = np.abs((longitudes - points[:, 0].mean() + 180) % 360 - 180).argmin()
+                cells = np.array([row * len(longitudes) + col])
+            names.append(name)
+            indices.append(cells)
+            offsets.append(offsets[-1] + cells.size)
+        indices = np.concatenate(indices)
+        masks = cls(
+            names,
+            np.asarray(offsets, dtype=np.int64),
+            indices,
+            cell_weights[indices // len(longitudes)],
+            (len(latitudes), len(longitudes))
+        )
+        if cache_path is not None:
+            masks.save(cache_path)
+        return masks
+
+    def save(self, path: os.PathLike):
+        import numpy as np
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written atomically, as several processes may share the cache
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp.npz')
+        np.savez(tmp_path, names=np.array(self.names), offsets=self.offsets, indices=self.indices,
+                 weights=self.weights, shape=np.array(self.shape))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: os.PathLike) -> 'RegionMasks':
+        import numpy as np
+
+        with np.load(path) as data:
+            return cls([str(n) for n in data['names']], data['offsets'], data['indices'],
+                       data['weights'], tuple(int(n) for n in data['shape']))
+
+def rasterize(rings: list, latitudes, longitudes):
+    """Flat indices of the grid cells whose center lies in a polygon, with the
+    even-odd rule (so that inner rings are holes).
+
+    Args:
+        rings (list): Rings of the polygon, as lists of [lon, lat] positions
+        latitudes (np.ndarray): Latitudes of the grid, in degrees
+        longitudes (np.ndarray): Longitudes of the grid, in degrees, regularly
+            spaced and covering all longitudes
+
+    Returns:
+        np.ndarray: Flat (`row * n_lon + col`) indices of the cells
+    """
+    import numpy as np
+
+    n_lon = len(longitudes)
+    lon_step = longitudes[1] - longitudes[0]
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)[:, :2]
+        edges.append(np.concatenate([ring[:-1], ring[1:]], axis=1))
+        if not np.array_equal(ring[0], ring[-1]):
+            edges.append(np.concatenate([ring[-1:], ring[:1]], axis=1))
+    x0, y0, x1, y1 = np.concatenate(edges).T
+    # Horizontal edges never cross a scanline
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+
+    cells = []
+    rows = np.nonzero((latitudes >= min(y0.min(), y1.min())) & (latitudes <= max(y0.max(), y1.max())))[0]
+    for row in rows:
+        lat = latitudes[row]
+        crossing = (y0 <= lat) != (y1 <= lat)
+        xs = np.sort(x0[crossing] + (lat - y0[crossing]) * (x1[crossing] - x0[crossing]) / (y1[crossing] - y0[crossing]))
+        # Cells whose center is in [start, end), between pairs of crossings
+        for start, end in zip(xs[::2], xs[1::2]):
+            first = math.ceil((start - longitudes[0]) / lon_step)
+            last = math.ceil((end - longitudes[0]) / lon_step)
+            cols = np.arange(first, min(last, first + n_lon)) % n_lon
+            cells.append(row * n_lon + cols)
+    if not cells:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(cells).astype(np.int64)
+
+def aggregate(dataset, masks: RegionMasks, variables: list[str] = None) -> dict:
+    """Area-weighted means and maxima of variables over regions, for all
+    times and levels.
+
+    Each variable is read once, one time chunk at a time and only within the
+    latitudes covered by the regions, and all regions, levels and times of a
+    chunk are aggregated with a few vectorized operations. NaN values are
+    ignored.
+
+    Args:
+        dataset (xr.Dataset): Forecast, on the grid of `masks`
+        masks (RegionMasks): Regions
+        variables (list[str], optional): Variables to aggregate. If `None`,
+            all variables are aggregated. Defaults to `None`.
+
+    Returns:
+        dict[str, np.ndarray]: Columns `region`, `variable`, `level` (hPa, -1
+            for single level variables), `time`, `mean` and `max`, with one
+            row per region, variable, level and time
+    """
+    import numpy as np
+
+    n_lat, n_lon = masks.shape
+    if (len(dataset['latitude']), len(dataset['longitude'])) != masks.shape:
+        raise ValueError('The masks were computed on another grid')
+    variables = list(dataset.data_vars) if variables is None else variables
+
+    # Only the band of latitudes covered by the regions is read
+    rows = masks.indices // n_lon
+    first_row, last_row = int(rows.min()), int(rows.max())
+    indices = masks.indices - first_row * n_lon
+    starts = masks.offsets[:-1]
+    n_regions = len(masks.names)
+    times = dataset['time'].to_numpy()
+    levels = dataset['level'].to_numpy() if 'level' in dataset.coords else np.empty(0, dtype=np.int64)
+
+    columns = {'region': [], 'variable': [], 'level': [], 'time': [], 'mean': [], 'max': []}
+    for variable in variables:
+        data = dataset[variable].transpose('time', ..., 'latitude', 'longitude')
+        chunks = data.encoding.get('preferred_chunks', {})
+        time_chunk = chunks.get('time', len(times))
+        means, maxima = [], []
+        for start in range(0, len(times), time_chunk):
+            block = data.isel(
+                time=slice(start, start + time_chunk),
+                latitude=slice(first_row, last_row + 1)
+            ).to_numpy()
+            values = block.reshape(block.shape[:-2] + (-1,))[..., indices]
+            finite = np.isfinite(values)
+            weights = np.where(finite, masks.weights, 0)
+            sums = np.add.reduceat(np.where(finite, values, 0) * weights, starts, axis=-1)
+            total_weights = np.add.reduceat(weights, starts, axis=-1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means.append(sums / total_weights)
+            maxima.append(np.fmax.reduceat(values, starts, axis=-1).astype(np.float64))
+        # (time, [level], region)
+        means = np.concatenate(means)
+        maxima = np.concatenate(maxima)
+
+        if means.ndim == 2:
+            means, maxima = means[:, None], maxima[:, None]
+            variable_levels = np.array([-1])
+        else:
+            variable_levels = levels
+        n_rows = means.size
+        grid_times, grid_levels, grid_regions = np.meshgrid(
+            np.arange(len(times)), np.arange(len(variable_levels)), np.arange(n_regions), indexing='ij')
+        columns['region'].append(np.asarray(masks.names, dtype=object)[grid_regions.ravel()])
+        columns['variable'].append(np.full(n_rows, variable, dtype=object))
+        columns['level'].append(variable_levels[grid_levels.ravel()].astype(np.int64))
+        columns['time'].append(times[grid_times.ravel()])
+        columns['mean'].append(means.ravel())
+        columns['max'].append(maxima.ravel())
+
+    return {name: np.concatenate(values) for name, values in columns.items()}
+
+def _geojson_regions(geojson: dict, name_property: str) -> list[tuple[str, list]]:
+    """(name, polygons) of the regions of a GeoJSON object, each polygon being
+    a list of rings."""
+    if geojson.get('type') == 'FeatureCollection':
+        features = geojson.get('features', [])
+    elif geojson.get('type') == 'Feature':
+        features = [geojson]
+    else:
+        features = [{'type': 'Feature', 'geometry': geojson}]
+
+    regions = []
+    for i, feature in enumerate(features):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        properties = feature.get('properties') or {}
+        name = properties.get(name_property, feature.get('id', i))
+        regions.append((str(name), [rings for rings in polygons if rings]))
+    return regions
@@ -0,0 +1,213 @@
+from collections import OrderedDict
+
+import threading
+import math
+
+from server.point_query import PointQuery, INTERPOLATION_METHODS, _to_json
+
+EARTH_RADIUS_KM = 6371.0
+
+# Maximum number of points sampled along a cross-section path
+MAX_SAMPLES = 1000
+
+class VerticalSection:
+    """Vertical profiles and cross-sections of the pressure level variables of
+    a forecast, at a single lead time.
+
+    Values are read through a `PointQuery`, so that only the zarr chunks
+    holding the requested time and points are read, and they are kept in its
+    chunk cache. The interpolation indices of each path are also cached, so
+    that repeated requests along the same path (e.g. when stepping through
+    lead times) only gather and weight already decoded values.
+
+    Args:
+        point_query (PointQuery): Point query on the forecast `.zarr` file
+        max_paths (int, optional): Maximum number of paths whose interpolation
+            indices are kept in memory. Defaults to 256.
+    """
+    def __init__(self, point_query: PointQuery, max_paths: int = 256):
+        self.point_query = point_query
+        self.run = point_query.run
+        self.max_paths = max_paths
+        self.hits = 0
+        self.misses = 0
+        self._paths: OrderedDict[tuple, tuple] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def level_variables(self) -> list[str]:
+        """Variables defined on pressure levels."""
+        dataset = self.point_query.dataset
+        return [v for v in dataset.data_vars if 'level' in dataset[v].dims]
+
+    def profile(self,
+                latitude: float,
+                longitude: float,
+                hour: int,
+                variables: list[str] = None,
+                method: str = 'bilinear') -> dict:
+        """Get the vertical profile (sounding) of variables at a point.
+
+        Args:
+            latitude (float): Latitude of the point, in degrees
+            longitude (float): Longitude of the point, in degrees
+            hour (int): Index of the lead time, as in the `h{t}` tiles
+            variables (list[str], optional): Variables to extract. If `None`,
+                all pressure level variables are extracted. Defaults to `None`.
+            method (str, optional): `bilinear` or `nearest`. Defaults to
+                'bilinear'.
+
+        Raises:
+            ValueError: If an argument is invalid
+
+        Returns:
+            dict: JSON-serializable result, with `values[variable][level]` for
+                pressure level variables and `values[variable]` for single
+                level variables. Missing values are `None`.
+        """
+        result = self.section([(latitude, longitude)], hour, 1, variables, method)
+        result['point'] = result.pop('points')[0]
+        del result['point']['distance_km']
+        result['values'] = {
+            variable: values[0] if variable not in self.level_variables else [row[0] for row in values]
+            for variable, values in result['values'].items()
+        }
+        return result
+
+    def section(self,
+                path: list[tuple[float, float]],
+                hour: int,
+                samples: int = 100,
+                variables: list[str] = None,
+                method: str = 'bilinear') -> dict:
+        """Get a vertical cross-section of variables along a path made of
+        great-circle segments.
+
+        Args:
+            path (list[tuple[float, float]]): (latitude, longitude) of the
+                vertices of the path, in degrees
+            hour (int): Index of the lead time, as in the `h{t}` tiles
+            samples (int, optional): Number of points sampled along the path,
+                evenly spaced in distance and including both ends. Defaults to
+                100.
+            variables (list[str], optional): Variables to extract. If `None`,
+                all pressure level variables are extracted. Defaults to `None`.
+            method (str, optional): `bilinear` or `nearest`. Defaults to
+                'bilinear'.
+
+        Raises:
+            ValueError: If an argument is invalid
+
+        Returns:
+            dict: JSON-serializable result, with `values[variable][level][point]`
+                for pressure level variables and `values[variable][point]` for
+                single level variables. Missing values are `None`.
+        """
+        import numpy as np
+
+        query = self.point_query
+        if method not in INTERPOLATION_METHODS:
+            raise ValueError(f'Unknown interpolation method {method}')
+        if not path:
+            raise ValueError('The path must have at least one point')
+        if not all(abs(lat) <= 90 and math.isfinite(lon) for lat, lon in path):
+            raise ValueError('Invalid coordinates')
+        if not 0 <= hour < len(query.times):
+            raise ValueError(f'Invalid hour, the forecast has {len(query.times)} lead times')
+        if not 1 <= samples <= MAX_SAMPLES or (samples == 1 and len(path) > 1):
+            raise ValueError(f'samples must be between 2 and {MAX_SAMPLES}')
+
+        variables = self.level_variables if variables is None else variables
+        for variable in variables:
+            if variable not in query.dataset.data_vars:
+                raise ValueError(f'Unknown variable {variable}')
+
+        lats, lons, distances, rows, cols, weights = self._path_indices(path, samples, method)
+
+        values = {}
+        for variable in variables:
+            if 'level' in query.dataset[variable].dims:
+                profile = np.stack([
+                    (query.gather(variable, ilevel, rows, cols, hour)[0] * weights).sum(axis=-1)
+                    for ilevel in range(len(query.levels))
+                ])
+                values[variable] = _to_json(profile)
+            else:
+                surface = (query.gather(variable, None, rows, cols, hour)[0] * weights).sum(axis=-1)
+                values[variable] = _to_json(surface[None])[0]
+
+        return {
+            'run': self.run,
+            'method': method,
+            'hour': hour,
+            'time': query.times[hour],
+            'levels': query.levels,
+            'points': [
+                {'lat': float(lat), 'lon': float(lon), 'distance_km': float(distance)}
+                for lat, lon, distance in zip(lats, lons, distances)
+            ],
+            'units': {v: query.dataset[v].attrs.get('units') for v in variables},
+            'values': values,
+        }
+
+    def _path_indices(self, path: list[tuple[float, float]], samples: int, method: str) -> tuple:
+        """Sampled points of a path and their interpolation indices, from the
+        cache if possible."""
+        key = (tuple((float(lat), float(lon)) for lat, lon in path), samples, method)
+        with self._lock:
+            indices = self._paths.get(key)
+            if indices is not None:
+                self._paths.move_to_end(key)
+                self.hits += 1
+                return indices
+            self.misses += 1
+
+        lats, lons, distances = great_circle_path(path, samples)
+        indices = (lats, lons, distances, *self.point_query.interpolation_indices(lats, lons, method))
+        with self._lock:
+            self._paths[key] = indices
+            while len(self._paths) > self.max_paths:
+                self._paths.popitem(last=False)
+        return indices
+
+def great_circle_path(path: list[tuple[float, float]], samples: int):
+    """Sample points evenly spaced along a path made of great-circle segments.
+
+    Args:
+        path (list[tuple[float, float]]): (latitude, longitude) of the vertices
+            of the path, in degrees
+        samples (int): Number of points, including both ends of the path
+
+    Returns:
+        (lats, lons, distances) (tuple[np.ndarray, np.ndarray, np.ndarray]):
+            Coordinates of the points in degrees, and their distance along the
+            path in kilometers
+    """
+    import numpy as np
+
+    lat = np.radians([p[0] for p in path])
+    lon = np.radians([p[1] for p in path])
+    vertices = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+    # Angle of each segment
+    angles = np.arccos(np.clip((vertices[:-1] * vertices[1:]).sum(axis=-1), -1, 1))
+    cumulative = np.concatenate([[0], np.cumsum(angles)])
+
+    targets = np.linspace(0, cumulative[-1], samples)
+    segments = np.clip(np.searchsorted(cumulative, targets, side='right') - 1, 0, max(len(angles) - 1, 0))
+    if len(angles) == 0:
+        points = np.repeat(vertices[:1], samples, axis=0)
+    else:
+        start, end, angle = vertices[segments], vertices[segments + 1], angles[segments]
+        t = np.where(angle > 0, (targets - cumulative[segments]) / np.where(angle > 0, angle, 1), 0)
+        # Spherical linear interpolation, falling back to the start of
+        # zero-length segments
+        sin_angle = np.sin(angle)
+        safe = sin_angle > 1e-12
+        a = np.where(safe, np.sin((1 - t) * angle) / np.where(safe, sin_angle, 1), 1 - t)
+        b = np.where(safe, np.sin(t * angle) / np.where(safe, sin_angle, 1), t)
+        points = a[:, None] * start + b[:, None] * end
+        points /= np.linalg.norm(points, axis=-1, keepdims=True)
+
+    lats = np.degrees(np.arcsin(np.clip(points[:, 2], -1, 1)))
+    lons = np.degrees(np.arctan2(points[:, 1], points[:, 0]))
+    return lats, lons, targets * EARTH_RADIUS_KM
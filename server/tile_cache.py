@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Hashable, TypeVar
+
+import threading
+import hashlib
+import os
+
+T = TypeVar('T')
+
+class SingleFlight:
+    """Coalesces identical concurrent calls: while `fn` is running for a given
+    key, other callers with the same key wait for its result instead of calling
+    `fn` themselves."""
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        """Call `fn`, or wait for the result of the ongoing call for `key`.
+
+        Args:
+            key (Hashable): Identifies calls that return the same result
+            fn (Callable[[], T]): Function to call
+
+        Returns:
+            T: Result of `fn`. Exceptions raised by `fn` are raised to all
+                callers.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+class TileCache:
+    """Two-level LRU cache of rendered tiles: a bounded in-memory cache, backed
+    by an optional bounded on-disk cache that survives restarts. Tiles missing
+    from both are created once, even when requested concurrently.
+
+    Args:
+        max_memory_bytes (int, optional): Maximum total size of the tiles kept
+            in memory. Defaults to 256 MB.
+        disk_dir (os.PathLike, optional): Directory of the on-disk cache. If
+            `None`, tiles are only cached in memory. Defaults to `None`.
+        max_disk_bytes (int, optional): Maximum total size of the on-disk cache.
+            Defaults to 2 GB.
+    """
+    def __init__(self,
+                 max_memory_bytes: int = 256 * 1024 ** 2,
+                 disk_dir: os.PathLike = None,
+                 max_disk_bytes: int = 2 * 1024 ** 3):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = None if disk_dir is None else Path(disk_dir)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[Path, int] = OrderedDict() # path -> size
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            # Rebuild the LRU order from the access times of a previous run,
+            # stored as modification times
+            files = [(p.stat().st_mtime, p) for p in self.disk_dir.glob('*/*.tile')]
+            for _, path in sorted(files):
+                size = path.stat().st_size
+                self._disk[path] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    @property
+    def coalesced(self) -> int:
+        return self._single_flight.coalesced
+
+    def get_or_create(self, key: str, create: Callable[[], bytes]) -> bytes:
+        """Get the tile for `key`, creating and caching it if needed.
+
+        Args:
+            key (str): Unique identifier of the tile's contents
+            create (Callable[[], bytes]): Function creating the tile
+
+        Returns:
+            bytes: The tile
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        def create_and_put() -> bytes:
+            # Another thread may have created it since the lookup above
+            data = self.get(key, count=False)
+            if data is None:
+                data = create()
+                self.put(key, data)
+            return data
+
+        with self._lock:
+            self.misses += 1
+        return self._single_flight.do(key, create_and_put)
+
+    def get(self, key: str, count: bool = True) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                if count:
+                    self.memory_hits += 1
+                return data
+            path = self._disk_path(key)
+            if path is None or path not in self._disk:
+                return None
+            self._disk.move_to_end(path)
+
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            if count:
+                self.disk_hits += 1
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+        path = self._disk_path(key)
+        if path is None:
+            return
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(path, 0)
+            self._disk[path] = len(data)
+            self._evict_disk()
+
+    def _put_memory(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        # Must be called with the lock held
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            path, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _disk_path(self, key: str) -> Path | None:
+        if self.disk_dir is None:
+            return None
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return self.disk_dir / digest[:2] / f'{digest}.tile'
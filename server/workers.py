@@ -0,0 +1,186 @@
+# Pre-forked multi-process mode of the server. A master process binds the
+# listening socket and starts worker processes (`python -m server ...
+# --listen-fd FD`) that inherit it and accept connections from the same queue,
+# so that requests are spread over all cores despite the GIL.
+#
+# The socket is never closed while the master runs, so connections waiting in
+# its queue are not lost when workers are replaced:
+#   - SIGHUP (reload): new workers are started, and old workers are stopped
+#     gracefully once the new ones are ready. New workers run the current code
+#     and reload all files.
+#   - SIGTERM, SIGINT: all workers are stopped gracefully, then the master exits.
+#   - Workers that exit unexpectedly are restarted.
+# A worker stopped gracefully stops accepting connections, finishes the
+# requests in progress, closes keep-alive connections after their next
+# response, and exits once all of its connections are closed.
+#
+# The workers share snapshots of their metrics through a directory created by
+# the master (`--metrics-dir`), so that `/metrics` reports all of them.
+
+import http.server
+import subprocess
+import threading
+import tempfile
+import shutil
+import selectors
+import signal
+import socket
+import time
+import sys
+import os
+
+# Seconds to wait for new workers to be ready before stopping the old ones
+READY_TIMEOUT = 120
+
+# Maximum number of connections waiting to be accepted
+LISTEN_BACKLOG = 1024
+
+class WorkerHTTPServer(http.server.ThreadingHTTPServer):
+    """`ThreadingHTTPServer` accepting connections from an inherited listening
+    socket, which waits for its connections to close when stopped.
+
+    Args:
+        sock (socket.socket): Bound and listening socket
+        handler (type): Request handler class
+    """
+    # Non-daemon connection threads are joined by `server_close`
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, sock: socket.socket, handler: type):
+        super().__init__(sock.getsockname()[:2], handler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        # Set when stopping: handlers then close connections after responding
+        self.draining = False
+
+    def stop(self):
+        """Stop accepting connections. Can be called from a signal handler."""
+        self.draining = True
+        # shutdown() waits for serve_forever() to return, which would deadlock
+        # if called from the serving thread
+        threading.Thread(target=self.shutdown).start()
+
+def serve_worker(sock: socket.socket, handler: type, ready_fd: int = None):
+    """Serve requests as a worker until SIGTERM or SIGINT is received.
+
+    Args:
+        sock (socket.socket): Inherited listening socket
+        handler (type): Request handler class
+        ready_fd (int, optional): File descriptor to which a byte is written
+            once the worker accepts connections. Defaults to `None`.
+    """
+    httpd = WorkerHTTPServer(sock, handler)
+    signal.signal(signal.SIGTERM, lambda *_: httpd.stop())
+    signal.signal(signal.SIGINT, lambda *_: httpd.stop())
+    # Reloading is the master's job
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+class Master:
+    """Master process of the multi-worker mode.
+
+    Args:
+        sock (socket.socket): Bound and listening socket shared by the workers
+        n_workers (int): Number of worker processes
+        worker_args (list[str]): Arguments of `python -m server` for the
+            workers, to which `--listen-fd`, `--ready-fd` and `--metrics-dir`
+            are added
+    """
+    def __init__(self, sock: socket.socket, n_workers: int, worker_args: list[str]):
+        self.sock = sock
+        self.n_workers = n_workers
+        self.worker_args = worker_args
+        self.workers: list[subprocess.Popen] = []
+        self.metrics_dir = None
+        self._reload = False
+        self._stop = False
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM or SIGINT."""
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+
+        self.metrics_dir = tempfile.mkdtemp(prefix='appa-metrics-')
+        self.workers = self._start_workers(self.n_workers)
+        print(f'Started workers: {[w.pid for w in self.workers]}', flush=True)
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            for i, worker in enumerate(self.workers):
+                if worker.poll() is not None:
+                    print(f'Worker {worker.pid} exited with code {worker.returncode}, restarting it', flush=True)
+                    self.workers[i] = self._start_workers(1)[0]
+            time.sleep(0.2)
+
+        self._stop_workers(self.workers)
+        self.sock.close()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def reload(self):
+        """Replace all workers without closing the listening socket."""
+        print('Reloading workers', flush=True)
+        old_workers = self.workers
+        self.workers = self._start_workers(self.n_workers)
+        self._stop_workers(old_workers)
+        print(f'Reloaded workers: {[w.pid for w in self.workers]}', flush=True)
+
+    def _start_workers(self, n: int) -> list[subprocess.Popen]:
+        """Start `n` workers and wait until they are ready, or have exited."""
+        workers = []
+        selector = selectors.DefaultSelector()
+        for _ in range(n):
+            read_fd, write_fd = os.pipe()
+            worker = subprocess.Popen(
+                [sys.executable, '-m', 'server', *self.worker_args,
+                 '--listen-fd', str(self.sock.fileno()), '--ready-fd', str(write_fd),
+                 '--metrics-dir', self.metrics_dir],
+                pass_fds=(self.sock.fileno(), write_fd)
+            )
+            os.close(write_fd)
+            selector.register(read_fd, selectors.EVENT_READ)
+            workers.append(worker)
+
+        # A worker that fails before being ready closes its end of the pipe
+        deadline = time.monotonic() + READY_TIMEOUT
+        pending = len(workers)
+        while pending and time.monotonic() < deadline:
+            for key, _ in selector.select(timeout=1):
+                os.read(key.fd, 1)
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                pending -= 1
+        for key in list(selector.get_map().values()):
+            os.close(key.fd)
+        selector.close()
+        return workers
+
+    def _stop_workers(self, workers: list[subprocess.Popen]):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+
+    def _on_reload(self, *_):
+        self._reload = True
+
+    def _on_stop(self, *_):
+        self._stop = True
+
+def create_socket(bind: str, port: int) -> socket.socket:
+    """Create the listening socket shared by the workers."""
+    sock = socket.create_server((bind, port), backlog=LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import threading
+import os
+
+from server.tile_cache import SingleFlight, TileCache
+
+class ZarrTileRenderer:
+    """Renders tiles on request from a decoded forecast `.zarr` file, instead
+    of reading them from pre-rendered PMTiles archives. Rendered tiles are kept
+    in a `TileCache`, and concurrent requests for the same tile render it once.
+
+    This requires the dependencies of the pipeline (`xarray`, `numpy`,
+    `matplotlib`, `pillow`), which are only imported when a renderer is created.
+
+    Args:
+        zarr_path (os.PathLike): Path to the forecast `.zarr` file. Its stem is
+            the run identifier used in tile URLs, as for uploaded tiles.
+        cache (TileCache): Cache of the rendered tiles
+        max_zoom (int, optional): Maximum zoom level rendered. If `None`,
+            `tiler.constants.RENDER_ZOOM_MAX` is used. Defaults to `None`.
+        qmin (float, optional): Minimum quantile to represent. Defaults to 0.01.
+        qmax (float, optional): Maximum quantile to represent. Defaults to 0.99
+        max_slices (int, optional): Number of (variable, level, time) slices
+            kept in memory, so that the tiles of a viewport don't each read the
+            slice again. Defaults to 16.
+    """
+    def __init__(self,
+                 zarr_path: os.PathLike,
+                 cache: TileCache,
+                 max_zoom: int = None,
+                 qmin: float = 0.01,
+                 qmax: float = 0.99,
+                 max_slices: int = 16):
+        import xarray as xr
+        import tiler
+
+        self._tiler = tiler
+        self.run = Path(zarr_path).stem
+        self.mtime = os.stat(zarr_path).st_mtime
+        self.dataset = xr.open_zarr(zarr_path)
+        self.cache = cache
+        self.max_zoom = tiler.constants.RENDER_ZOOM_MAX if max_zoom is None else max_zoom
+        self.qmin = qmin
+        self.qmax = qmax
+        self.max_slices = max_slices
+        self.latitudes = self.dataset['latitude'].to_numpy()
+        self.longitudes = self.dataset['longitude'].to_numpy()
+        self.n_levels = len(self.dataset['level']) if 'level' in self.dataset.coords else 0
+        self.n_times = len(self.dataset['time'])
+
+        self._bounds: dict[tuple[str, int | None], tuple[float, float]] = {}
+        self._slices: OrderedDict[tuple[str, int | None, int], object] = OrderedDict()
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def has_slice(self, variable: str, ilevel: int | None, itime: int) -> bool:
+        """Whether the dataset contains the given variable, level and time."""
+        if variable not in self.dataset.data_vars or not 0 <= itime < self.n_times:
+            return False
+        is_level = 'level' in self.dataset[variable].dims
+        if is_level:
+            return ilevel is not None and 0 <= ilevel < self.n_levels
+        return ilevel is None
+
+    def get_tile(self, variable: str, ilevel: int | None, itime: int, z: int, x: int, y: int) -> bytes:
+        """Get the PNG tile of a slice of the dataset, rendering it if needed.
+        `has_slice` must be checked first.
+
+        Args:
+            variable (str): Name of the variable
+            ilevel (int | None): Index of the pressure level, or `None` for
+                single level variables
+            itime (int): Index of the time step
+            z (int): Zoom level, at most `max_zoom`
+            x (int): Tile column
+            y (int): Tile row (XYZ scheme)
+
+        Returns:
+            bytes: PNG-encoded tile
+        """
+        cmap = self._tiler.constants.CMAP_MAPPINGS.get(variable, self._tiler.constants.CMAP_DEFAULT)
+        key = f'{self.run}/{variable}/{ilevel}/{itime}/{cmap}/{self.qmin}/{self.qmax}/{z}/{x}/{y}'
+
+        def render() -> bytes:
+            data_min, data_max = self._get_bounds(variable, ilevel)
+            return self._tiler.render.render_tile(
+                self._get_slice(variable, ilevel, itime),
+                self.latitudes,
+                self.longitudes,
+                z,
+                x,
+                y,
+                data_min,
+                data_max,
+                cmap
+            )
+
+        return self.cache.get_or_create(key, render)
+
+    def _get_bounds(self, variable: str, ilevel: int | None) -> tuple[float, float]:
+        """Represented (min, max) values of a variable (at a level), as
+        computed by `tiler.dataset_to_tiles`, so that colors match the legends."""
+        key = (variable, ilevel)
+        bounds = self._bounds.get(key)
+        if bounds is not None:
+            return bounds
+
+        def compute() -> tuple[float, float]:
+            data = self.dataset[variable]
+            if ilevel is not None:
+                data = data.isel(level=ilevel)
+            quantiles = data.quantile([self.qmin, self.qmax], dim=['time', 'latitude', 'longitude'])
+            bounds = tuple(float(q) for q in quantiles.to_numpy())
+            self._bounds[key] = bounds
+            return bounds
+
+        return self._single_flight.do(('bounds', key), compute)
+
+    def _get_slice(self, variable: str, ilevel: int | None, itime: int):
+        key = (variable, ilevel, itime)
+        with self._lock:
+            data = self._slices.get(key)
+            if data is not None:
+                self._slices.move_to_end(key)
+                return data
+
+        def read():
+            data = self.dataset[variable].isel(time=itime)
+            if ilevel is not None:
+                data = data.isel(level=ilevel)
+            data = data.to_numpy()
+            with self._lock:
+                self._slices[key] = data
+                while len(self._slices) > self.max_slices:
+                    self._slices.popitem(last=False)
+            return data
+
+        return self._single_flight.do(('slice', key), read)
@@ -19,4 +19,9 @@ CMAP_DEFAULT = 'jet'
 ZOOM_MIN = 0
 
 # A value of 2 gives ~2GB of tile data. A value of 3, ~8GB.
-ZOOM_MAX = 3
\ No newline at end of file
+ZOOM_MAX = 3
+
+# Maximum zoom rendered on demand by the server from the forecast zarr
+# (`python -m server --zarr`). Tiles are only rendered when requested, so this
+# can be higher than ZOOM_MAX at no cost for unviewed tiles.
+RENDER_ZOOM_MAX = 8
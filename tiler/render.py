@@ -0,0 +1,77 @@
+from tiler import colormap
+from PIL import Image
+
+import numpy as np
+import io
+
+TILE_SIZE = 256
+
+def tile_pixel_coordinates(z: int,
+                           x: int,
+                           y: int,
+                           tile_size: int = TILE_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    """Get the latitude and longitude at the center of each pixel row and column
+    of a Web Mercator (EPSG:3857) tile, in the XYZ scheme.
+
+    Args:
+        z (int): Zoom level
+        x (int): Tile column
+        y (int): Tile row, 0 being the northernmost row
+        tile_size (int, optional): Tile width and height in pixels. Defaults to
+            `TILE_SIZE`.
+
+    Returns:
+        (latitudes, longitudes) (tuple[np.ndarray, np.ndarray]): 1D arrays of
+            the latitudes of the pixel rows (north to south) and longitudes of
+            the pixel columns (west to east, in the -180 to 180 range).
+    """
+    n = 2 ** z
+    offsets = (np.arange(tile_size) + 0.5) / tile_size
+    longitudes = (x + offsets) / n * 360 - 180
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    return latitudes, longitudes
+
+def render_tile(data: np.ndarray,
+                latitudes: np.ndarray,
+                longitudes: np.ndarray,
+                z: int,
+                x: int,
+                y: int,
+                data_min: float,
+                data_max: float,
+                cmap: str = 'viridis',
+                tile_size: int = TILE_SIZE) -> bytes:
+    """Render a single PNG web tile from 2D grid data, reprojected with nearest
+    neighbour sampling (like the `-r near` option used by `gen_tiles`).
+    **This function expects a regular grid, covering all longitudes**.
+
+    Args:
+        data (np.ndarray): 2D (lat, lon) data array
+        latitudes (np.ndarray): 1D (lat) latitudes array, regularly spaced
+        longitudes (np.ndarray): 1D (lon) longitudes array, regularly spaced
+        z (int): Zoom level
+        x (int): Tile column
+        y (int): Tile row (XYZ scheme)
+        data_min (float): Minimum data value to represent.
+        data_max (float): Maximum data value to represent.
+        cmap (str, optional): Colormap available in `matplotlib.cm`. Defaults to 'viridis'.
+        tile_size (int, optional): Tile width and height in pixels. Defaults to
+            `TILE_SIZE`.
+
+    Returns:
+        bytes: PNG-encoded tile
+    """
+    tile_lats, tile_lons = tile_pixel_coordinates(z, x, y, tile_size)
+
+    lat_step = latitudes[1] - latitudes[0]
+    lon_step = longitudes[1] - longitudes[0]
+    rows = np.rint((tile_lats - latitudes[0]) / lat_step).astype(int)
+    rows = np.clip(rows, 0, len(latitudes) - 1)
+    cols = np.rint(((tile_lons - longitudes[0]) % 360) / lon_step).astype(int) % len(longitudes)
+
+    window = data[np.ix_(rows, cols)]
+    rgb = colormap.array_to_rgb_u8(window, data_min, data_max, cmap)
+
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(np.moveaxis(rgb, 0, -1)), 'RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
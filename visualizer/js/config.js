@@ -12,4 +12,8 @@ export const CONFIG = {
     // Opacity of the weather data layer that is displayed above the continental
     // map data
     LAYER_OPACITY: 0.8,
+
+    // URL of the `/events` endpoint of the server (`python -m server`), to
+    // reload the page when a new run is published. Disabled if null.
+    EVENTS_URL: null,
 };
\ No newline at end of file
@@ -1,7 +1,16 @@
 import { setupMap } from './mapSetup.js';
+import { CONFIG } from './config.js';
 
 setupMap().then(({ map, metadata }) => {
     console.log('Map initialized successfully');
+    if (CONFIG.EVENTS_URL) {
+        const events = new EventSource(CONFIG.EVENTS_URL);
+        events.addEventListener('run', (event) => {
+            if (JSON.parse(event.data).run !== metadata.latest) {
+                location.reload();
+            }
+        });
+    }
 }).catch(error => {
     console.error('Failed to initialize map:', error);
 });
\ No newline at end of file